@@ -0,0 +1,125 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import pathlib
+import tempfile
+import subprocess
+import contextlib
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from gqc import structs
+
+# Benchmark of how the linker gets the persistent section onto a 4 KB sector
+#  boundary, on games with read-only items it can move past the persistent
+#  section to close the gap, across a whole sector: the padding left before
+#  the persistent section with and without moving them, how many were moved,
+#  and how long placing the symbols and generating the image take. That the
+#  result is correct is checked by tests/test_cart_packing.py. Each game is
+#  built in its own process, as the compiler's state is global. Needs ffmpeg
+#  on the PATH for the animations. Run with: python benchmarks/cart_packing.py
+
+SKEL = pathlib.Path(__file__).parent.parent / 'examples' / 'skel'
+
+GAME_TEMPLATE = '''
+game {{
+    id = 0;
+    title := "Packing test";
+    author := "duplico";
+    starting_stage = start;
+}}
+
+persistent {{
+    int high_score = 0;
+}}
+
+volatile {{
+    int score = 0;
+}}
+
+{assets}
+
+stage start {{
+    {bganim}
+    event enter {{
+{filler}
+    }}
+}}
+
+{stages}
+'''
+
+ASSETS = '''
+animations {
+    hearts <- "heart_anim.gif";
+    pop <- "bwcircles.gif" {
+        frame_rate = 10;
+    }
+}
+
+lightcues {
+    flash <- "flash.gqcue";
+}
+
+menus {
+    restart {
+        1: "Yes";
+        0: "No";
+    }
+}
+'''
+
+def game_source(filler : int, extra_stages : int, assets : bool) -> str:
+    return GAME_TEMPLATE.format(
+        assets=ASSETS if assets else '',
+        bganim='bganim hearts; menu restart;' if assets else '',
+        filler='\n'.join(['        score = 1;'] * filler),
+        stages='\n'.join(f'stage extra{index} {{ event enter {{ score = 2; }} }}' for index in range(extra_stages)),
+    )
+
+def link(game_path : pathlib.Path) -> dict:
+    from gqc import parser, linker
+    from gqc.datamodel import Game
+
+    Game.game_name = game_path.stem
+    linker.create_reserved_variables()
+    with open(game_path, 'r') as f:
+        parsed = parser.parse(f)
+    linker.load_assets()
+    map_file = io.StringIO()
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        symbol_table = linker.create_symbol_table(table_dest=map_file, cmd_dest=io.StringIO())
+        output = linker.generate_code(parsed, symbol_table)
+        link_time = time.perf_counter() - start
+
+    padding, unpacked_padding = map(int, re.search(r'(\d+) bytes of padding before it; (\d+) without', map_file.getvalue()).groups())
+    vars_ptr = structs.gq_ptr_get_addr(Game.game.persistent_var_ptr)
+    return dict(padding=padding, unpacked_padding=unpacked_padding, code_end=vars_ptr - padding, size=len(output), relocated=len(symbol_table['.rodata']), link=link_time)
+
+def build(workspace : pathlib.Path, name : str, source : str) -> dict:
+    game_path = workspace / 'games' / f'{name}.gq'
+    game_path.write_text(source)
+    result = subprocess.run([sys.executable, __file__, '--link', str(game_path.relative_to(workspace))], cwd=workspace, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise AssertionError(f"{name} failed:\n{result.stdout}\n{result.stderr}")
+    return json.loads(result.stdout.splitlines()[-1])
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        workspace = pathlib.Path(tmp_dir) / 'skel'
+        shutil.copytree(SKEL, workspace)
+
+        print(f"{'game':24} {'code end':>9} {'padding':>8} {'unpacked':>9} {'moved':>6} {'cart':>7} {'link':>8}")
+        for fill in range(0, 400, 30):
+            result = build(workspace, f'assets_{fill}', game_source(fill, 0, True))
+            print(f"{'assets + ' + str(fill) + ' statements':24} {result['code_end']:#9x} {result['padding']:8} {result['unpacked_padding']:9} {result['relocated']:6} {result['size']:7} {result['link'] * 1e3:6.1f}ms")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '--link':
+        print(json.dumps(link(pathlib.Path(sys.argv[2]))))
+    else:
+        main()
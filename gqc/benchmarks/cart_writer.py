@@ -0,0 +1,98 @@
+import io
+import os
+import sys
+import time
+import contextlib
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from gqc import linker, structs
+
+# Benchmark of linker.generate_code against the concatenating writer it
+#  replaced, on synthetic carts of increasing size up to a nearly full 16 MB
+#  cart. The legacy writer is quadratic, so it's only run on the smaller carts
+#  by default. Run with: python benchmarks/cart_writer.py [max legacy MB]
+
+class Blob:
+    # Stands in for a linked symbol: just an address and some bytes.
+    def __init__(self, addr : int, data : bytes):
+        self.addr = addr
+        self.data = data
+
+    def to_bytes(self):
+        return self.data
+
+    def size(self):
+        return len(self.data)
+
+    def __repr__(self) -> str:
+        return f"Blob({len(self.data)})"
+
+def synthetic_symbol_table(cart_size : int) -> dict:
+    # Mostly frame data in 128x128 uncompressed frames, then the 4 KB aligned
+    #  persistent variables and their write-through cache.
+    frame_size = 2048
+    addr = structs.gq_ptr_apply_ns(structs.GQ_PTR_NS_CART, 0x000000)
+    framedata = dict()
+    frame_count = (cart_size - 0x3000) // frame_size
+    for i in range(frame_count):
+        framedata[addr] = Blob(addr, bytes([i & 0xFF]) * frame_size)
+        addr += frame_size
+
+    # A few odd-sized symbols so .var doesn't start on a boundary.
+    init = dict()
+    for i in range(5):
+        init[addr] = Blob(addr, bytes(structs.GQ_OP_SIZE))
+        addr += structs.GQ_OP_SIZE
+
+    addr += 0x1000 - addr % 0x1000
+    var = dict()
+    for i in range(0x2000 // structs.GQ_INT_SIZE):
+        var[addr] = Blob(addr, i.to_bytes(structs.GQ_INT_SIZE, 'little'))
+        addr += structs.GQ_INT_SIZE
+
+    return {'.framedata' : framedata, '.init' : init, '.var' : var}
+
+def legacy_generate_code(symbol_table : dict):
+    output = bytes()
+    next_expected_addr = structs.gq_ptr_apply_ns(structs.GQ_PTR_NS_CART, 0x000000)
+    for section_name, table in symbol_table.items():
+        if section_name == '.var':
+            next_4kb_boundary = next_expected_addr + (0x1000 - next_expected_addr % 0x1000)
+            while next_expected_addr < next_4kb_boundary:
+                output += bytes([0xFF])
+                next_expected_addr += 1
+        for addr, symbol in table.items():
+            if addr != next_expected_addr:
+                raise ValueError(f"Expected address {next_expected_addr:#0{10}x} but got {addr:#0{10}x}")
+            next_expected_addr += symbol.size()
+            output += symbol.to_bytes()
+    return output
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+def main():
+    max_legacy_mb = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+    cart_sizes_mb = [1, 2, 4, 8, 15.9]
+
+    print(f"{'cart':>8} {'symbols':>8} {'legacy':>10} {'streaming':>10}")
+    for size_mb in cart_sizes_mb:
+        symbol_table = synthetic_symbol_table(int(size_mb * (1 << 20)))
+        symbol_count = sum(len(table) for table in symbol_table.values())
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            new_time, new_output = timed(linker.generate_code, None, symbol_table)
+
+        if size_mb <= max_legacy_mb:
+            legacy_time, legacy_output = timed(legacy_generate_code, symbol_table)
+            assert bytes(new_output) == legacy_output
+            legacy_col = f"{legacy_time:9.3f}s"
+        else:
+            legacy_col = f"{'skipped':>10}"
+
+        print(f"{size_mb:6.1f}MB {symbol_count:8} {legacy_col} {new_time:9.3f}s")
+
+if __name__ == '__main__':
+    main()
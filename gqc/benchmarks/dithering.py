@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import pathlib
+import tempfile
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import numpy as np
+from PIL import Image, ImageDraw
+from rich.progress import Progress
+
+from gqc import anim, dither
+
+# Benchmark of the in-process (NumPy) dithering against ffmpeg's paletteuse,
+#  for every dithering algorithm: time to convert each animation both ways,
+#  and the share of pixels that come out the same. Frames are converted with
+#  source_timing, so the two conversions' frames line up one to one.
+#
+# The synthetic animation is already 128x128, so nothing is scaled and any
+#  difference is down to the dithering itself; the example animations are
+#  also scaled, by ffmpeg's and by Pillow's bicubic filters respectively. Needs
+#  ffmpeg on the PATH. Run with: python benchmarks/dithering.py
+
+EXAMPLE_ANIMATIONS = pathlib.Path(__file__).parent.parent / 'examples' / 'skel' / 'assets' / 'animations'
+
+def synthetic_gif(path : pathlib.Path):
+    # Gradients and flat colors, where the dithering patterns show the most.
+    frames = []
+    gradient = np.linspace(0, 255, 128, dtype=np.uint8)
+    for index in range(8):
+        pixels = np.zeros((128, 128, 3), dtype=np.uint8)
+        pixels[..., 0] = gradient[np.newaxis, :]
+        pixels[..., 1] = gradient[:, np.newaxis]
+        pixels[..., 2] = 32 * index
+        img = Image.fromarray(pixels)
+        draw = ImageDraw.Draw(img)
+        draw.ellipse((16 + 4 * index, 16, 112, 112 - 4 * index), fill=(128, 128, 128))
+        draw.rectangle((0, 96, 40, 127), fill=(200, 40, 40))
+        frames.append(img)
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=100, loop=0)
+
+def convert(convert_fn, src_path : pathlib.Path, method : str) -> tuple[float, list[np.ndarray]]:
+    with tempfile.TemporaryDirectory() as output_dir, Progress(disable=True) as progress:
+        start = time.perf_counter()
+        frames = [np.asarray(frame) for frame in convert_fn(progress, src_path, pathlib.Path(output_dir), method, write_frames=False, write_gif=False, source_timing=True)]
+        return time.perf_counter() - start, frames
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        synthetic_path = pathlib.Path(tmp_dir) / 'gradients.gif'
+        synthetic_gif(synthetic_path)
+        sources = [synthetic_path] + sorted(EXAMPLE_ANIMATIONS.glob('*.gif'))
+
+        print(f"{'animation':16} {'dithering':16} {'frames':>6} {'ffmpeg':>9} {'numpy':>9} {'agreement':>10}")
+        for src_path in sources:
+            for method in dither.DITHERS:
+                ffmpeg_time, ffmpeg_frames = convert(anim.make_animation_from_video, src_path, method)
+                numpy_time, numpy_frames = convert(anim.make_animation_from_image_sequence, src_path, method)
+                assert len(ffmpeg_frames) == len(numpy_frames)
+                agreement = np.mean([np.mean(a == b) for a, b in zip(ffmpeg_frames, numpy_frames)])
+                print(f"{src_path.name:16} {method:16} {len(numpy_frames):6} {ffmpeg_time * 1e3:7.1f}ms {numpy_time * 1e3:7.1f}ms {agreement:9.2%}")
+
+if __name__ == '__main__':
+    main()
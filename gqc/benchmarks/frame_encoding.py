@@ -0,0 +1,119 @@
+import os
+import sys
+import timeit
+import warnings
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from PIL import Image, ImageDraw
+
+from gqc import encoding
+
+# Benchmark of the NumPy frame encoders against the per-pixel loops that
+#  Frame used to run. That their output is identical is checked by
+#  tests/test_encoding.py. Run with: python benchmarks/frame_encoding.py
+
+def legacy_uncompressed_bytes(image):
+    run = 0
+    val = 0
+    out_bytes = []
+    row_run = 0
+
+    for pixel_raw in image.getdata():
+        pixel = 1 if pixel_raw else 0
+
+        if run == 8 or row_run == image.width:
+            out_bytes.append(val)
+            run = 0
+            val = 0
+            if row_run == image.width:
+                row_run = 0
+
+        if pixel:
+            val |= (0b10000000 >> run)
+
+        run += 1
+        row_run += 1
+
+    out_bytes.append(val)
+
+    return bytes(out_bytes)
+
+def legacy_rle_bytes(image, bits):
+    val = 1 if image.getdata()[0] else 0
+    run = 0
+    out_bytes = []
+    if bits == 4:
+        run_max = 0x0f
+        val_mask = 0xf0
+    else:
+        run_max = 0x7f
+        val_mask = 0xfe
+
+    for pixel_raw in list(image.getdata())[1:]:
+        pixel = 1 if pixel_raw else 0
+        if pixel == val:
+            if run == run_max:
+                run = 0
+                out_bytes.append(val_mask + val)
+            else:
+                run += 1
+        else:
+            out_bytes.append((run << (8-bits)) + val)
+            run = 0
+            val = pixel
+    out_bytes.append((run << (8-bits)) + val)
+
+    return bytes(out_bytes)
+
+def sample_frames():
+    frames = []
+    # Blank and full frames exercise the maximum-length run splitting.
+    frames.append(Image.new('1', (128, 128), 0))
+    frames.append(Image.new('1', (128, 128), 1))
+    # Line art, roughly what most animations look like.
+    for i in range(8):
+        img = Image.new('1', (128, 128), 0)
+        draw = ImageDraw.Draw(img)
+        draw.ellipse((8 * i, 8 * i, 127 - 4 * i, 127 - 2 * i), outline=1, width=3)
+        draw.rectangle((0, 100, 127, 127), fill=1)
+        frames.append(img)
+    # Dithered noise is the worst case for RLE.
+    frames.append(Image.effect_noise((128, 128), 64).convert('1'))
+    # Widths that aren't a multiple of 8 exercise the row padding.
+    frames.append(Image.effect_noise((37, 21), 64).convert('1'))
+    return frames
+
+def main():
+    # The legacy loops use Image.getdata(), which newer Pillow releases deprecate.
+    warnings.simplefilter("ignore", DeprecationWarning)
+
+    frames = sample_frames()
+
+    for frame in frames:
+        pixels = encoding.unpack_pixels(frame)
+        assert encoding.uncompressed_bytes(pixels) == legacy_uncompressed_bytes(frame)
+        assert encoding.rle_bytes(pixels, 7) == legacy_rle_bytes(frame, 7)
+        assert encoding.rle_bytes(pixels, 4) == legacy_rle_bytes(frame, 4)
+    print(f"Outputs identical for {len(frames)} sample frames.")
+
+    def run_legacy():
+        for frame in frames:
+            legacy_uncompressed_bytes(frame)
+            legacy_rle_bytes(frame, 7)
+
+    def run_numpy():
+        for frame in frames:
+            pixels = encoding.unpack_pixels(frame)
+            encoding.uncompressed_bytes(pixels)
+            encoding.rle_bytes(pixels, 7)
+
+    count = 20
+    legacy_time = timeit.timeit(run_legacy, number=count) / (count * len(frames))
+    numpy_time = timeit.timeit(run_numpy, number=count) / (count * len(frames))
+
+    print(f"legacy loops: {legacy_time * 1e3:8.3f} ms/frame")
+    print(f"numpy:        {numpy_time * 1e3:8.3f} ms/frame")
+    print(f"speedup:      {legacy_time / numpy_time:8.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import pathlib
+import tempfile
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from PIL import Image, ImageDraw
+from rich.progress import Progress
+
+from gqc import anim
+from gqc.datamodel import encode_frames, encode_extended_formats, collapse_held_frames
+
+# Benchmark of converting a GIF with holds and uneven frame delays with
+#  source_timing, its held frames collapsed, against converting it at a fixed
+#  frame rate: time to convert and the number of stored frames and bytes, both
+#  through ffmpeg and in-process. The round trip itself is checked by
+#  tests/test_timing.py. Needs ffmpeg on the PATH. Run with:
+#  python benchmarks/frame_timing.py
+
+def sample_gif_frames() -> list[tuple[Image.Image, int]]:
+    # (frame, delay in ms) pairs. Holds are stored as runs of frames that
+    #  differ only in shades that all quantize to the same black and white
+    #  frame, so the GIF writer can't merge them itself.
+    frames = []
+    holds = [1, 1, 4, 1, 12, 2, 1, 30, 1]
+    delays = [40, 100, 40, 70, 100, 20, 250, 100, 40]
+    for index, (hold, delay) in enumerate(zip(holds, delays)):
+        for shade in range(hold):
+            img = Image.new('L', (128, 128), shade % 32)
+            draw = ImageDraw.Draw(img)
+            draw.ellipse((4 * index, 6 * index, 127 - 3 * index, 127 - 5 * index), outline=255 - shade % 32, width=4)
+            draw.rectangle((0, 110 - 8 * index, 20 + 10 * index, 127), fill=224)
+            frames.append((img, delay))
+    return frames
+
+def convert(gif_path : pathlib.Path, output_dir : pathlib.Path, source_timing : bool, in_process : bool, frame_rate : int = 25):
+    start = time.perf_counter()
+    with Progress(disable=True) as progress:
+        images = anim.make_animation(progress, gif_path, output_dir, frame_rate=frame_rate, write_frames=False, write_gif=False, source_timing=source_timing, in_process=in_process)
+        frames = encode_frames(images)
+    if source_timing:
+        frames = collapse_held_frames(frames, anim.frame_durations(output_dir))
+    encode_extended_formats(frames)
+    return time.perf_counter() - start, frames
+
+def main():
+    source = sample_gif_frames()
+
+    print(f"{'':24} {'frames':>7} {'bytes':>7} {'time':>9}")
+    print(f"{'source frames':24} {len(source):7}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = pathlib.Path(tmp_dir)
+        gif_path = tmp_dir / 'timing.gif'
+        source[0][0].save(gif_path, save_all=True, append_images=[img for img, _ in source[1:]], duration=[delay for _, delay in source], loop=0)
+
+        for in_process in (False, True):
+            for source_timing in (False, True):
+                name = f"{'source timing' if source_timing else 'fixed 25 fps'}, {'in-process' if in_process else 'ffmpeg'}"
+                elapsed, frames = convert(gif_path, tmp_dir / name, source_timing, in_process)
+                print(f"{name:24} {len(frames):7} {sum(len(frame.bytes) for frame in frames):7} {elapsed * 1e3:7.1f}ms")
+
+if __name__ == '__main__':
+    main()
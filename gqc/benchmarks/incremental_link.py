@@ -0,0 +1,171 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import pathlib
+import tempfile
+import subprocess
+import contextlib
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+# Benchmark of relinking a large game after a one-event change: how long
+#  linking takes (placing the symbols and writing the map, then generating
+#  and writing the image) against parsing, and how many 4 KB sectors of the
+#  image change (what gqc patch would write), for a cold build, a rebuild
+#  with no changes, and rebuilds after changing one event, both without
+#  changing its size and by adding a command to it. Builds use the stable
+#  layout, as `gqc compile --stable-layout` would. Each game is built in its
+#  own process, as the compiler's state is global. Needs ffmpeg on the PATH
+#  for the animations. Run with:
+#  python benchmarks/incremental_link.py [stage count]
+#
+# This is why there's no link database to relink from: the whole link is a
+#  small fraction of a build, even warm, and with a stable layout only the
+#  sectors around the change differ.
+
+SKEL = pathlib.Path(__file__).parent.parent / 'examples' / 'skel'
+
+GAME_TEMPLATE = '''
+game {{
+    id = 0;
+    title := "Large";
+    author := "duplico";
+    starting_stage = stage0;
+}}
+
+persistent {{
+    int high_score = 0;
+}}
+
+volatile {{
+    int score = 0;
+    int lives = 3;
+}}
+
+animations {{
+    hearts <- "heart_anim.gif";
+    pop <- "bwcircles.gif" {{
+        frame_rate = 10;
+    }}
+    dance <- "dance.gif" {{ frame_rate = 5; dithering := "bayer"; }}
+    pbj <- "pbj.gif" {{ dithering := "floyd_steinberg"; }}
+    printer <- "printer.jpg" {{ dithering := "floyd_steinberg"; }}
+}}
+
+lightcues {{
+    flash <- "flash.gqcue";
+}}
+
+{stages}
+'''
+
+STAGE_TEMPLATE = '''
+stage stage{index} {{
+    bganim hearts;
+    event enter {{
+        score = score + {index};
+        if (score > high_score) {{
+            high_score = score;
+        }}
+        timer 100;
+    }}
+    event timer {{
+        gostage stage{next};
+    }}
+    event input(A) {{
+        score = score + 1;
+        play bganim pop;
+        cue flash;
+        if (lives > 0) {{
+            lives = lives - 1;
+        }} else {{
+            gostage stage0;
+        }}
+    }}
+    event input(B) {{
+        play bganim {anim};{extra}
+    }}
+}}
+'''
+
+def game_source(stage_count : int, edit : str = None) -> str:
+    # edit changes the input(B) event of the middle stage: 'same-size' plays
+    #  a different animation, 'grow' adds a command.
+    stages = []
+    for index in range(stage_count):
+        anim = 'dance' if index % 2 else 'pbj'
+        extra = ''
+        if index == stage_count // 2 and edit == 'same-size':
+            anim = 'printer'
+        elif index == stage_count // 2 and edit == 'grow':
+            extra = ' cue flash;'
+        stages.append(STAGE_TEMPLATE.format(index=index, next=(index + 1) % stage_count, anim=anim, extra=extra))
+    return GAME_TEMPLATE.format(stages=''.join(stages))
+
+def link(game_path : pathlib.Path, out_dir : pathlib.Path) -> dict:
+    # Builds the game into out_dir the way gqc compile --stable-layout does,
+    #  timing the link separately from parsing.
+    from gqc import parser, linker
+    from gqc.gqc import read_stable_layout, write_layout
+    from gqc.patch import make_patch, read_patch, sector_count
+    from gqc.datamodel import Game
+
+    Game.game_name = game_path.stem
+    out_dir.mkdir(parents=True, exist_ok=True)
+    linker.create_reserved_variables()
+    start = time.perf_counter()
+    with open(game_path, 'r') as f:
+        parsed = parser.parse(f)
+    linker.load_assets()
+    parse_time = time.perf_counter() - start
+
+    layout_path = out_dir / 'layout.json'
+    image_path = out_dir / f'{Game.game_name}.gqgame'
+    previous_image = image_path.read_bytes() if image_path.exists() else b''
+
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        start = time.perf_counter()
+        with open(out_dir / 'map.txt', 'w') as map_file, open(out_dir / 'cmds.gqasm', 'w') as cmd_asm_file:
+            symbol_table = linker.create_symbol_table(table_dest=map_file, cmd_dest=cmd_asm_file, stable_sections=read_stable_layout(layout_path))
+        symbols_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        output_code = linker.generate_code(parsed, symbol_table)
+        with open(image_path, 'wb') as out_file:
+            out_file.write(output_code)
+        emit_time = time.perf_counter() - start
+    write_layout(layout_path, True)
+
+    changed = read_patch(make_patch(previous_image, output_code))[0].sector_count
+    return dict(parse=parse_time, symbols=symbols_time, emit=emit_time, changed=changed, sectors=sector_count(len(output_code)))
+
+def build(workspace : pathlib.Path, out_dir : pathlib.Path, source : str) -> dict:
+    game_path = workspace / 'games' / 'large.gq'
+    game_path.write_text(source)
+    result = subprocess.run([sys.executable, __file__, '--link', str(game_path.relative_to(workspace)), str(out_dir)], cwd=workspace, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise AssertionError(f"Build failed:\n{result.stdout}\n{result.stderr}")
+    return json.loads(result.stdout.splitlines()[-1])
+
+def main():
+    stage_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        workspace = pathlib.Path(tmp_dir) / 'skel'
+        shutil.copytree(SKEL, workspace)
+        warm_dir = workspace / 'build' / 'warm'
+
+        print(f"{stage_count} stages")
+        print(f"{'build':20} {'parse':>8} {'symbols':>8} {'emit':>8} {'link':>8} {'sectors changed':>16}")
+        builds = [('cold', None), ('no change', None), ('same-size edit', 'same-size'), ('grow edit', 'grow')]
+        for name, edit in builds:
+            result = build(workspace, warm_dir, game_source(stage_count, edit))
+            print(f"{name:20} {result['parse']:7.2f}s {result['symbols']:7.3f}s {result['emit']:7.3f}s {result['symbols'] + result['emit']:7.3f}s {result['changed']:>7} of {result['sectors']:<5}")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 3 and sys.argv[1] == '--link':
+        print(json.dumps(link(pathlib.Path(sys.argv[2]), pathlib.Path(sys.argv[3]))))
+    else:
+        main()
@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+import random
+import pathlib
+import tempfile
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from gqc import structs
+from gqc.symbols import SymbolIndex
+
+# Benchmark of resolving addresses to symbols with the symbol index, against
+#  scanning the linker's symbol table, on synthetic symbol tables of
+#  increasing size up to a nearly full 16 MB cart: time to build, save and
+#  load the index, and per lookup. Every lookup is checked against the scan.
+#  Run with: python benchmarks/symbol_lookup.py
+
+class Blob:
+    # Stands in for a linked symbol: just an address and a size.
+    def __init__(self, addr : int, size : int):
+        self.addr = addr
+        self.length = size
+
+    def size(self):
+        return self.length
+
+    def __repr__(self) -> str:
+        return f"Blob({self.addr:#010x})"
+
+def synthetic_symbol_table(symbol_count : int) -> dict:
+    # Frame data, then event code, then the persistent variables, in the
+    #  proportions of a large game.
+    addr = structs.gq_ptr_apply_ns(structs.GQ_PTR_NS_CART, 0x000000)
+    symbol_table = dict()
+    for section, share, size in (('.framedata', 0.2, 1024), ('.event', 0.7, 40), ('.var', 0.1, 4)):
+        table = dict()
+        for _ in range(int(symbol_count * share)):
+            table[addr] = Blob(addr, size)
+            addr += size
+        symbol_table[section] = table
+    return symbol_table
+
+def scan(symbol_table : dict, addr : int):
+    for table in symbol_table.values():
+        for symbol_addr, symbol in table.items():
+            if symbol_addr <= addr < symbol_addr + symbol.size():
+                return symbol
+    return None
+
+def main():
+    random.seed(0)
+    print(f"{'symbols':>8} {'build':>8} {'save':>8} {'load':>8} {'indexed':>10} {'scan':>10}")
+    for symbol_count in (10_000, 100_000, 400_000):
+        symbol_table = synthetic_symbol_table(symbol_count)
+        cart_end = max(addr + symbol.size() for table in symbol_table.values() for addr, symbol in table.items())
+        addrs = [random.randrange(structs.gq_ptr_apply_ns(structs.GQ_PTR_NS_CART, 0), cart_end) for _ in range(10_000)]
+
+        start = time.perf_counter()
+        index = SymbolIndex.from_symbol_table(symbol_table)
+        build_time = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = pathlib.Path(tmp_dir) / 'symbols.gqsym'
+            start = time.perf_counter()
+            index.write(path)
+            save_time = time.perf_counter() - start
+            start = time.perf_counter()
+            index = SymbolIndex.read(path)
+            load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        found = [index.at(addr) for addr in addrs]
+        indexed_time = (time.perf_counter() - start) / len(addrs)
+
+        # Scanning is slow enough that a few lookups will do.
+        start = time.perf_counter()
+        scanned = [scan(symbol_table, addr) for addr in addrs[:20]]
+        scan_time = (time.perf_counter() - start) / 20
+
+        for symbol, blob in zip(found, scanned):
+            assert (symbol.addr, symbol.size, symbol.name) == (blob.addr, blob.size(), repr(blob))
+        print(f"{symbol_count:8} {build_time * 1e3:6.0f}ms {save_time * 1e3:6.0f}ms {load_time * 1e3:6.0f}ms {indexed_time * 1e6:8.2f}us {scan_time * 1e6:8.0f}us")
+
+if __name__ == '__main__':
+    main()
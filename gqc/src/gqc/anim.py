@@ -1,14 +1,55 @@
+import math
+import zlib
 import ffmpeg
+import itertools
 import pathlib
+from fractions import Fraction
+from typing import Iterator
 
-from PIL import Image
-from PIL.Image import Dither
+import numpy as np
+from PIL import Image, ImageSequence
+from PIL.Image import Dither, Resampling
 
-from rich.progress import Progress
+from concurrent.futures import ThreadPoolExecutor, Future
 
-def make_animation_from_video(progress: Progress, anim_src_path : pathlib.Path, output_dir : pathlib.Path, dithering : str = 'none', frame_rate : int = 25, height : int = 128, width : int = 128):
-    # Load the source file
-    in_file = ffmpeg.input(anim_src_path)
+from rich.progress import Progress, TextColumn, BarColumn, TaskProgressColumn, TimeElapsedColumn
+
+from . import dither
+
+TICKS_PER_SECOND = 100
+MAX_FRAME_TICKS = 0xFFFF # Per-frame durations are stored as uint16_t ticks
+FRAME_TIMING_FILE = 'timing.framecrc'
+
+STILL_IMAGE_SUFFIXES = ['.bmp', '.png', '.jpg', '.jpeg']
+# Animated formats that Pillow can decode in-process, without ffmpeg, when
+#  asked to (see make_animation)
+IMAGE_SEQUENCE_SUFFIXES = ['.gif', '.png', '.apng']
+
+# Dithering algorithms that Pillow implements, which still images use unless
+#  converted in-process
+PIL_DITHERS = {
+    'none': Dither.NONE,
+    'floyd_steinberg': Dither.FLOYDSTEINBERG,
+}
+
+# Frames converted in-process are dithered this many at a time, which is much
+#  faster for error diffusion than one at a time; see dither.error_diffusion.
+DITHER_BATCH_SIZE = 16
+
+# As ffmpeg's GIF demuxer does, frames with no delay are shown for 100 ms.
+GIF_MIN_DELAY_MS = 10
+GIF_DEFAULT_DELAY_MS = 100
+
+def make_animation_from_video(progress: Progress, anim_src_path : pathlib.Path, output_dir : pathlib.Path, dithering : str = 'none', frame_rate : int = 25, height : int = 128, width : int = 128, write_frames : bool = True, write_gif : bool = True, source_timing : bool = False, start : int = None, end : int = None, max_frames : int = None) -> Iterator[Image.Image]:
+    # Load the source file. start and end (in ticks) are applied as input
+    #  options, so ffmpeg seeks straight to start and stops reading at end
+    #  rather than decoding the whole source.
+    input_kwargs = dict()
+    if start:
+        input_kwargs['ss'] = start / TICKS_PER_SECOND
+    if end is not None:
+        input_kwargs['to'] = end / TICKS_PER_SECOND
+    in_file = ffmpeg.input(anim_src_path, **input_kwargs)
 
     # Scale the video to make its height or width the specified size
     # TODO: Decide if we want to scale the video to the specified size or crop it
@@ -20,45 +61,238 @@ def make_animation_from_video(progress: Progress, anim_src_path : pathlib.Path,
     palette = ffmpeg.filter([black, white], 'hstack', 2)
     # Apply dithering
     dithered = ffmpeg.filter([cropped, palette], 'paletteuse', new='false', dither=dithering)
-    # Apply the desired framerate
-    out = dithered.filter('fps', frame_rate)
+    # Apply the desired framerate, unless we're keeping the source's own frame
+    #  timing, in which case every source frame is passed through as-is and its
+    #  timestamps are recorded alongside; see frame_durations().
+    output_kwargs = dict()
+    if source_timing:
+        out = dithered
+        output_kwargs['fps_mode'] = 'passthrough'
+    else:
+        out = dithered.filter('fps', frame_rate)
+    # ffmpeg stops decoding once every output has max_frames frames.
+    if max_frames is not None:
+        output_kwargs['frames:v'] = max_frames
 
-    # Write the output - summary gif and frame files
-    out_files = [
-        (output_dir / 'anim.gif', progress.add_task(f" [dim]-> gif summary", total=1, start=False)),
-        (output_dir / 'frame%04d.bmp', progress.add_task(f" [dim]-> bmp frames", total=1, start=False))
-    ]
+    # The source is decoded and dithered exactly once. The frames always come
+    #  back over stdout as raw 8-bit gray (0 or 255 per pixel); the summary gif
+    #  and bmp frame files are extra branches of the same graph, only if asked.
+    out_files = ['pipe:']
+    if write_gif:
+        out_files.append(output_dir / 'anim.gif')
+    if write_frames:
+        out_files.append(output_dir / 'frame%04d.bmp')
+    if source_timing:
+        out_files.append(output_dir / FRAME_TIMING_FILE)
 
-    for out_file, task in out_files:
+    branches = out.split()
+    outputs = []
+    for index, out_file in enumerate(out_files):
+        if out_file == 'pipe:':
+            outputs.append(branches[index].output(out_file, format='rawvideo', pix_fmt='gray', **output_kwargs))
+        elif out_file.name == FRAME_TIMING_FILE:
+            outputs.append(branches[index].output(str(out_file), format='framecrc', **output_kwargs))
+        else:
+            outputs.append(branches[index].output(str(out_file), **output_kwargs))
+
+    task = progress.add_task(f" [dim]{anim_src_path.name} -> ffmpeg", total=None)
+
+    # Keep ffmpeg's stderr to errors only, so it can't fill its pipe while we're
+    #  still reading frames from stdout.
+    process = ffmpeg.merge_outputs(*outputs).global_args('-loglevel', 'error').run_async(overwrite_output=True, pipe_stdout=True, pipe_stderr=True)
+
+    frame_size = width * height
+    frame_count = 0
+    try:
+        while True:
+            frame_bytes = process.stdout.read(frame_size)
+            if len(frame_bytes) < frame_size:
+                break
+            yield Image.frombytes('L', (width, height), frame_bytes).convert('1', dither=Dither.NONE)
+            frame_count += 1
+            progress.update(task, advance=1)
+    except GeneratorExit:
+        # Don't leave ffmpeg running if our consumer gave up early.
+        process.kill()
+        process.wait()
+        raise
+
+    stderr = process.stderr.read()
+    if process.wait() != 0 or frame_bytes:
+        raise ValueError(f"ffmpeg error; Raw output of ffmpeg follows: \n\n{stderr.decode()}")
+    progress.update(task, completed=frame_count, total=frame_count)
+
+def make_animation_from_image_sequence(progress: Progress, anim_src_path : pathlib.Path, output_dir : pathlib.Path, dithering : str = 'none', frame_rate : int = 25, height : int = 128, width : int = 128, write_frames : bool = True, write_gif : bool = True, source_timing : bool = False, start : int = None, end : int = None, max_frames : int = None) -> Iterator[Image.Image]:
+    # The same conversion as make_animation_from_video, for animated GIFs and
+    #  PNGs, done in-process: each frame is decoded and scaled by Pillow,
+    #  dithered in memory (in small batches) and yielded straight to the
+    #  encoder. Frames are resampled to frame_rate as ffmpeg's fps filter does
+    #  (see scaled_source_frames); with source_timing, every frame is yielded
+    #  once and its timing recorded in the same form as ffmpeg's, so that
+    #  frame_durations() reads either. start, end and max_frames trim the
+    #  animation as they do for ffmpeg; decoding stops as soon as they're met.
+    if dithering not in dither.DITHERS:
+        raise ValueError(f"Dithering algorithm {dithering} is not supported")
+    task = progress.add_task(f" [dim]{anim_src_path.name} -> frames", total=None)
+
+    try:
+        in_img = Image.open(anim_src_path)
+    except OSError as e:
+        raise ValueError(f"Error reading image; {e}")
+
+    timing = [] # (start, duration, checksum), in ms, for source_timing
+    summary = [] # (frame, duration in ms), for the summary gif
+    frame_count = 0
+    with in_img:
+        source_frames = scaled_source_frames(
+            in_img, width, height, frame_rate, source_timing,
+            start=(start or 0) * 1000 // TICKS_PER_SECOND,
+            end=end * 1000 // TICKS_PER_SECOND if end is not None else None,
+            max_frames=max_frames
+        )
         try:
-            progress.start_task(task)
-            out.output(str(out_file)).run(overwrite_output=True, quiet=True)
-            progress.update(task, completed=1, total=1)
-        except ffmpeg._run.Error as e:
-            raise ValueError(f"ffmpeg error; Raw output of ffmpeg follows: \n\n{e.stderr.decode()}")
-        progress.update(task, advance=1)
+            while batch := list(itertools.islice(source_frames, DITHER_BATCH_SIZE)):
+                pixels = dither.dither(np.stack([scaled for scaled, _, _, _ in batch]), dithering)
+                for frame_pixels, (_, start, delay, repeats) in zip(pixels, batch):
+                    frame = Image.fromarray(frame_pixels.astype(bool))
+                    if source_timing:
+                        timing.append((start, delay, zlib.adler32(frame.tobytes())))
+                    for _ in range(repeats):
+                        frame_count += 1
+                        if write_frames:
+                            frame.save(output_dir / f'frame{frame_count:04d}.bmp')
+                        yield frame
+                        progress.update(task, advance=1)
+                    if write_gif:
+                        summary.append((frame, delay if source_timing else repeats * 1000 // frame_rate))
+        except OSError as e:
+            raise ValueError(f"Error reading image; {e}")
+
+    if source_timing:
+        with open(output_dir / FRAME_TIMING_FILE, 'w') as timing_file:
+            timing_file.write('#tb 0: 1/1000\n')
+            for frame_start, delay, checksum in timing:
+                timing_file.write(f'0, {frame_start:10}, {frame_start:10}, {delay:8}, {width * height:8}, 0x{checksum:08x}\n')
+    if summary:
+        summary[0][0].save(output_dir / 'anim.gif', save_all=True, append_images=[frame for frame, _ in summary[1:]], duration=[duration for _, duration in summary], loop=0)
+    progress.update(task, completed=frame_count, total=frame_count)
+
+def shown_source_frames(in_img : Image.Image, start : int = 0, end : int = None) -> Iterator[tuple[Image.Image, int, int]]:
+    # Yields (frame, start, end) for each source frame that's shown between
+    #  start and end, with times in ms from start.
+    frame_start = -start
+    stop = end - start if end is not None else None
+    for source_frame in ImageSequence.Iterator(in_img):
+        if stop is not None and frame_start >= stop:
+            break
+        delay = round(source_frame.info.get('duration', 0))
+        if in_img.format == 'GIF' and delay < GIF_MIN_DELAY_MS:
+            delay = GIF_DEFAULT_DELAY_MS
+        frame_end = frame_start + delay
+        if frame_end > 0 or (frame_start == 0 and not delay):
+            yield source_frame, max(frame_start, 0), frame_end if stop is None else min(frame_end, stop)
+        frame_start = frame_end
+
+def scaled_source_frames(in_img : Image.Image, width : int, height : int, frame_rate : int, source_timing : bool, start : int = 0, end : int = None, max_frames : int = None) -> Iterator[tuple[np.ndarray, int, int, int]]:
+    # Yields (scaled RGB pixels, start, delay, repeats) for each source frame
+    #  that's shown at least once between start and end, with times in ms
+    #  from start, until max_frames output frames have been yielded. Like
+    #  ffmpeg's fps filter, each output frame shows the last source frame to
+    #  start at or before it (rounding halves up), up to where the last source
+    #  frame starts, so the last frame's own delay is never shown.
+    frames = shown_source_frames(in_img, start, end)
+    frame_count = 0
+    if source_timing:
+        for source_frame, shown_start, shown_end in frames:
+            if max_frames is not None and frame_count >= max_frames:
+                break
+            yield scale_frame(source_frame, width, height), shown_start, shown_end - shown_start, 1
+            frame_count += 1
+        return
+
+    # Frames are only shown once the next one's start is known. Pillow reuses
+    #  the frame image as it seeks, so the one held back is a copy.
+    previous = None
+    for source_frame, shown_start, _ in frames:
+        if previous:
+            previous_frame, previous_start = previous
+            repeats = output_frame_index(shown_start, frame_rate) - output_frame_index(previous_start, frame_rate)
+            if max_frames is not None:
+                repeats = min(repeats, max_frames - frame_count)
+            if repeats:
+                yield scale_frame(previous_frame, width, height), previous_start, shown_start - previous_start, repeats
+                frame_count += repeats
+            if max_frames is not None and frame_count >= max_frames:
+                break
+        previous = (source_frame.copy(), shown_start)
+
+def output_frame_index(time_ms : int, frame_rate : int) -> int:
+    # The output frame a source frame boundary falls on, rounding halves up as
+    #  ffmpeg's fps filter does.
+    return math.floor(time_ms * frame_rate / 1000 + 0.5)
+
+def scale_frame(source_frame : Image.Image, width : int, height : int) -> np.ndarray:
+    # Transparent areas are the background, which is black.
+    if source_frame.mode in ('RGBA', 'LA', 'PA') or 'transparency' in source_frame.info:
+        rgba = source_frame.convert('RGBA')
+        source_frame = Image.new('RGBA', rgba.size, (0, 0, 0, 255))
+        source_frame.alpha_composite(rgba)
+    return np.asarray(source_frame.convert('RGB').resize((width, height), Resampling.BICUBIC))
+
+def frame_durations(output_dir : pathlib.Path) -> list[int]:
+    # Reads the frame timestamps recorded by a source_timing conversion and
+    #  returns each frame's duration in ticks. Frame boundaries are rounded to
+    #  the nearest tick, rather than each duration, so rounding never
+    #  accumulates into drift; a frame may round to 0 ticks if it's shorter
+    #  than one.
+    time_base = None
+    timestamps = []
+    with open(output_dir / FRAME_TIMING_FILE, 'r') as timing_file:
+        for line in timing_file:
+            if line.startswith('#tb 0:'):
+                time_base = Fraction(line.split(':')[1].strip())
+            elif line and not line.startswith('#'):
+                # stream, dts, pts, duration, size, checksum
+                fields = [field.strip() for field in line.split(',')]
+                timestamps.append((int(fields[2]), int(fields[3])))
+
+    if time_base is None:
+        raise ValueError("ffmpeg didn't record frame timing")
+
+    boundaries = [round(pts * time_base * TICKS_PER_SECOND) for pts, _ in timestamps]
+    if timestamps:
+        pts, duration = timestamps[-1]
+        # A last frame without a duration still gets shown for one tick.
+        boundaries.append(max(round((pts + duration) * time_base * TICKS_PER_SECOND), boundaries[-1] + 1))
+    return [min(end - start, MAX_FRAME_TICKS) for start, end in zip(boundaries, boundaries[1:])]
 
-def make_animation_from_image(progress: Progress, anim_src_path : pathlib.Path, output_dir : pathlib.Path, dithering : str = 'none', height : int = 128, width : int = 128):
+def make_animation_from_image(progress: Progress, anim_src_path : pathlib.Path, output_dir : pathlib.Path, dithering : str = 'none', height : int = 128, width : int = 128, write_frames : bool = True, write_gif : bool = True, in_process : bool = False) -> Iterator[Image.Image]:
     # Load the source file
-    in_img = Image.open(anim_src_path)
+    try:
+        in_img = Image.open(anim_src_path)
+    except OSError as e:
+        raise ValueError(f"Error reading image; {e}")
 
-    if dithering == 'none':
-        dither_method = Dither.NONE
-    elif dithering == 'floyd_steinberg':
-        dither_method = Dither.FLOYDSTEINBERG
-    else:
-        raise ValueError(f"Dithering algorithm {dithering} is not supported for single images.")
+    if dithering not in dither.DITHERS:
+        raise ValueError(f"Dithering algorithm {dithering} is not supported")
 
-    # Scale the image to make its height or width the specified size
-    scaled = in_img.resize((width, height))
-    # Quantize the image to black and white, using the specified dithering algorithm
-    quantized = scaled.convert('1', dither=dither_method)
+    # Scale the image to make its height or width the specified size, then
+    #  quantize it to black and white, using the specified dithering algorithm:
+    #  Pillow's, if it has it, or else (or if converting in-process) the same
+    #  as an animation frame converted in-process.
+    with in_img:
+        if dithering in PIL_DITHERS and not in_process:
+            quantized = in_img.resize((width, height)).convert('1', dither=PIL_DITHERS[dithering])
+        else:
+            scaled = scale_frame(in_img, width, height)
+            quantized = Image.fromarray(dither.dither(scaled[np.newaxis], dithering)[0].astype(bool))
 
-    # Write the output - summary gif and frame files
-    out_files = [
-        (output_dir / 'anim.gif', progress.add_task(f" [dim]-> gif summary", total=1, start=False)),
-        (output_dir / 'frame0000.bmp', progress.add_task(f" [dim]-> bmp frames", total=1, start=False))
-    ]
+    # Write the output - summary gif and frame files, if asked for
+    out_files = []
+    if write_gif:
+        out_files.append((output_dir / 'anim.gif', progress.add_task(f" [dim]{anim_src_path.name} -> gif summary", total=1, start=False)))
+    if write_frames:
+        out_files.append((output_dir / 'frame0001.bmp', progress.add_task(f" [dim]{anim_src_path.name} -> bmp frames", total=1, start=False)))
 
     for out_file, task in out_files:
         try:
@@ -68,7 +302,21 @@ def make_animation_from_image(progress: Progress, anim_src_path : pathlib.Path,
         except OSError as e:
             raise ValueError(f"Error writing image; {e}")
 
-def make_animation(progress: Progress, anim_src_path : pathlib.Path, output_dir : pathlib.Path, dithering : str = 'none', frame_rate : int = 25, duration : int = 100, height : int = 128, width : int = 128):
+    return [quantized]
+
+def make_animation(progress: Progress, anim_src_path : pathlib.Path, output_dir : pathlib.Path, dithering : str = 'none', frame_rate : int = 25, duration : int = 100, height : int = 128, width : int = 128, write_frames : bool = True, write_gif : bool = True, source_timing : bool = False, start : int = None, end : int = None, max_frames : int = None, in_process : bool = False) -> Iterator[Image.Image]:
+    # Returns the animation's frames as 1-bit images. For videos this is a
+    #  generator that yields each frame as ffmpeg produces it. With
+    #  source_timing, video frames aren't resampled to frame_rate; once
+    #  they've all been read, frame_durations(output_dir) gives their timing.
+    #  Animations can be trimmed to the part of the source between start and
+    #  end (in ticks) and to at most max_frames frames; still images ignore
+    #  these. With in_process, animated GIFs and PNGs are decoded by Pillow
+    #  rather than ffmpeg, and dithered as ffmpeg would (see dither.py), as are
+    #  still images; that avoids starting ffmpeg, but is slower for all but the
+    #  smallest sources, and error diffusion of scaled frames only roughly
+    #  matches ffmpeg's.
+
     # Set up the output directory
     output_dir.mkdir(parents=True, exist_ok=True)
     # Delete the old output files: anim.gif and frame*.bmp
@@ -76,18 +324,60 @@ def make_animation(progress: Progress, anim_src_path : pathlib.Path, output_dir
         file.unlink()
     for file in output_dir.glob('frame*.bmp'):
         file.unlink()
+    for file in output_dir.glob(FRAME_TIMING_FILE):
+        file.unlink()
 
     # Check whether the source file exists and raise a value error if it doesn't
     if not anim_src_path.exists():
         raise ValueError(f"Animation source file {anim_src_path} does not exist")
     
     # Check whether the source file is a video or an image
-    if anim_src_path.suffix in ['.bmp', '.png', '.jpg', '.jpeg']:
-        make_animation_from_image(progress, anim_src_path, output_dir, dithering, height, width)
+    if is_still_image(anim_src_path):
+        return make_animation_from_image(progress, anim_src_path, output_dir, dithering, height, width, write_frames, write_gif, in_process)
+    elif in_process and anim_src_path.suffix in IMAGE_SEQUENCE_SUFFIXES:
+        return make_animation_from_image_sequence(progress, anim_src_path, output_dir, dithering, frame_rate, height, width, write_frames, write_gif, source_timing, start, end, max_frames)
     else:
-        make_animation_from_video(progress, anim_src_path, output_dir, dithering, frame_rate, height, width)
+        return make_animation_from_video(progress, anim_src_path, output_dir, dithering, frame_rate, height, width, write_frames, write_gif, source_timing, start, end, max_frames)
 
-    
+def is_still_image(anim_src_path : pathlib.Path) -> bool:
+    if anim_src_path.suffix not in STILL_IMAGE_SUFFIXES:
+        return False
+    # A PNG may be an animated PNG.
+    try:
+        with Image.open(anim_src_path) as img:
+            return not getattr(img, 'is_animated', False)
+    except OSError:
+        # Let the conversion report it.
+        return True
 
-def convert_animations(assets_dir : pathlib.Path, build_dir : pathlib.Path):
-    pass
+def decodes_in_process(anim_src_path : pathlib.Path, in_process : bool) -> bool:
+    # Whether make_animation converts a source in-process when asked to.
+    return in_process and anim_src_path.suffix in STILL_IMAGE_SUFFIXES + IMAGE_SEQUENCE_SUFFIXES
+
+class ConversionScheduler:
+    # Runs animation conversions in the background. Work is submitted as each
+    #  animation is declared, so the ffmpeg runs for all of a game's animations
+    #  overlap with each other and with the rest of the parse. ffmpeg does its
+    #  work in a subprocess, so a bounded thread pool is enough to keep up to
+    #  `jobs` conversions going at once.
+    def __init__(self, jobs : int = 1):
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        self.progress = Progress(TextColumn("[progress.description]{task.description}"), BarColumn(), TaskProgressColumn(), TimeElapsedColumn())
+        self.futures = []
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        # fn is called as fn(progress, *args, **kwargs) on a worker thread.
+        future = self.executor.submit(fn, self.progress, *args, **kwargs)
+        self.futures.append(future)
+        return future
+
+    def wait(self):
+        # The progress display only goes live here, so nothing is drawn over
+        #  parser output (or errors) while the game is still being parsed.
+        #  Failures are re-raised in submission order.
+        try:
+            with self.progress:
+                for future in self.futures:
+                    future.result()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
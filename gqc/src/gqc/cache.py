@@ -0,0 +1,224 @@
+import os
+import json
+import mmap
+import time
+import struct
+import hashlib
+import pathlib
+import tempfile
+import threading
+from collections import namedtuple
+
+# Packed per-animation frame cache. One file holds every encoded frame of an
+#  animation:
+#
+#   header   magic, format version, animation flags, digest of the inputs that
+#            produced it, frame count, crop offset
+#   index    one fixed-size entry per frame: encoding, width, height, offset,
+#            length, duration
+#   payloads the encoded frame bytes, back to back
+#
+# The file is read through mmap, so loading a cached animation only touches
+#  the header and index; each frame's payload is a zero-copy slice that isn't
+#  read from disk until the linker actually emits it.
+
+FRAME_CACHE_MAGIC = b'GQFC'
+FRAME_CACHE_VERSION = 3
+
+FrameCacheHeader = namedtuple('FrameCacheHeader', 'magic version flags digest frame_count crop_x crop_y')
+FRAME_CACHE_HEADER_FORMAT = '<4sHH32sIBBxx'
+FRAME_CACHE_HEADER_SIZE = struct.calcsize(FRAME_CACHE_HEADER_FORMAT)
+
+FrameCacheEntry = namedtuple('FrameCacheEntry', 'encoding width height offset length duration')
+FRAME_CACHE_ENTRY_FORMAT = '<BxHHIIH'
+FRAME_CACHE_ENTRY_SIZE = struct.calcsize(FRAME_CACHE_ENTRY_FORMAT)
+
+def write_frame_cache(path : pathlib.Path, frames : list[tuple[int, int, int, bytes, int]], digest : str = None, flags : int = 0, crop : tuple[int, int] = (0, 0)):
+    # frames is a list of (encoding, width, height, payload, duration); flags
+    #  and crop are the animation's gq_anim.flags and crop offset. The file is
+    #  written next to its final location and moved into place, so a reader
+    #  never sees a partial cache.
+    offset = FRAME_CACHE_HEADER_SIZE + len(frames) * FRAME_CACHE_ENTRY_SIZE
+
+    header = FrameCacheHeader(
+        magic=FRAME_CACHE_MAGIC,
+        version=FRAME_CACHE_VERSION,
+        flags=flags,
+        digest=bytes.fromhex(digest) if digest else bytes(32),
+        frame_count=len(frames),
+        crop_x=crop[0],
+        crop_y=crop[1]
+    )
+    chunks = [struct.pack(FRAME_CACHE_HEADER_FORMAT, *header)]
+
+    for encoding, width, height, payload, duration in frames:
+        chunks.append(struct.pack(FRAME_CACHE_ENTRY_FORMAT, encoding, width, height, offset, len(payload), duration))
+        offset += len(payload)
+    for _, _, _, payload, _ in frames:
+        chunks.append(payload)
+
+    write_atomically(path, chunks)
+
+def write_atomically(path : pathlib.Path, chunks : list[bytes]):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.writelines(chunks)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+class FrameCache:
+    def __init__(self, path : pathlib.Path):
+        with open(path, 'rb') as file:
+            try:
+                self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError(f"Frame cache {path} is empty")
+        self.view = memoryview(self.mmap)
+
+        if len(self.view) < FRAME_CACHE_HEADER_SIZE:
+            raise ValueError(f"Frame cache {path} is truncated")
+        header = FrameCacheHeader(*struct.unpack_from(FRAME_CACHE_HEADER_FORMAT, self.view))
+        if header.magic != FRAME_CACHE_MAGIC or header.version != FRAME_CACHE_VERSION:
+            raise ValueError(f"Frame cache {path} has an unknown format")
+        self.digest = header.digest.hex()
+        self.flags = header.flags
+        self.crop = (header.crop_x, header.crop_y)
+
+        index_end = FRAME_CACHE_HEADER_SIZE + header.frame_count * FRAME_CACHE_ENTRY_SIZE
+        if len(self.view) < index_end:
+            raise ValueError(f"Frame cache {path} is truncated")
+        self.entries = [FrameCacheEntry(*entry) for entry in struct.iter_unpack(FRAME_CACHE_ENTRY_FORMAT, self.view[FRAME_CACHE_HEADER_SIZE:index_end])]
+
+        if self.entries and self.entries[-1].offset + self.entries[-1].length > len(self.view):
+            raise ValueError(f"Frame cache {path} is truncated")
+
+    def __len__(self):
+        return len(self.entries)
+
+    def payload(self, index : int) -> memoryview:
+        entry = self.entries[index]
+        return self.view[entry.offset:entry.offset + entry.length]
+
+# Workspace-wide content-addressed store of frame caches. An entry is named by
+#  Animation.digest(), which covers everything that affects the encoded frames
+#  (source contents, timing, dithering, size and compiler version) but not the
+#  game or animation name, so every animation with the same inputs, in any
+#  game, shares one entry. Entries' modification times record when they were
+#  last used, for LRU pruning.
+
+ASSET_CACHE_DIR = pathlib.Path() / 'build' / 'assets' / 'cache'
+
+AssetCacheEntry = namedtuple('AssetCacheEntry', 'path size last_used')
+
+def asset_cache_path(digest : str, cache_dir : pathlib.Path = ASSET_CACHE_DIR) -> pathlib.Path:
+    return cache_dir / digest[:2] / f'{digest}.gqcache'
+
+def mark_used(path : pathlib.Path):
+    try:
+        os.utime(path)
+    except OSError:
+        # Only used for pruning order; never worth failing a build over.
+        pass
+
+def asset_cache_entries(cache_dir : pathlib.Path = ASSET_CACHE_DIR) -> list[AssetCacheEntry]:
+    # Returns every entry in the store, least recently used first.
+    entries = []
+    for path in cache_dir.glob('*/*.gqcache'):
+        stat = path.stat()
+        entries.append(AssetCacheEntry(path, stat.st_size, stat.st_mtime))
+    return sorted(entries, key=lambda entry: entry.last_used)
+
+def prune_asset_cache(max_size : int, cache_dir : pathlib.Path = ASSET_CACHE_DIR) -> list[AssetCacheEntry]:
+    # Removes least recently used entries until the store is no larger than
+    #  max_size bytes, and returns the removed entries.
+    entries = asset_cache_entries(cache_dir)
+    total_size = sum(entry.size for entry in entries)
+
+    removed = []
+    for entry in entries:
+        if total_size <= max_size:
+            break
+        entry.path.unlink(missing_ok=True)
+        total_size -= entry.size
+        removed.append(entry)
+
+        # Tidy up the fan-out directory if this was its last entry.
+        try:
+            entry.path.parent.rmdir()
+        except OSError:
+            pass
+
+    return removed
+
+# Manifest of source file hashes. Hashing a multi-hundred-MB video on every
+#  build is slow, so the SHA-256 of each animation source is recorded along
+#  with the file's size, mtime and inode, and reused for as long as those
+#  still match.
+
+SOURCE_MANIFEST_PATH = ASSET_CACHE_DIR / 'sources.json'
+SOURCE_MANIFEST_VERSION = 1
+SOURCE_HASH_CHUNK_SIZE = 1 << 20
+
+# A file modified within this long before it was hashed could be modified
+#  again without its mtime changing, so its recorded hash isn't trusted.
+SOURCE_MTIME_GRANULARITY_NS = 1_000_000_000
+
+class SourceManifest:
+    def __init__(self, path : pathlib.Path = SOURCE_MANIFEST_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.sources = None
+
+    def load(self):
+        self.sources = dict()
+        try:
+            with open(self.path, 'r') as file:
+                manifest = json.load(file)
+            if manifest.get('version') == SOURCE_MANIFEST_VERSION:
+                self.sources = manifest['sources']
+        except (OSError, ValueError, KeyError):
+            # A missing or unreadable manifest just means everything gets rehashed.
+            pass
+
+    def save(self):
+        manifest = dict(version=SOURCE_MANIFEST_VERSION, sources=self.sources)
+        write_atomically(self.path, [json.dumps(manifest, indent=1).encode('utf-8')])
+
+    def sha256(self, src_path : pathlib.Path) -> str:
+        # Returns the hex SHA-256 of src_path's contents, from the manifest if
+        #  the file is unchanged since it was last hashed.
+        key = str(src_path.resolve())
+        stat = src_path.stat()
+
+        with self.lock:
+            if self.sources is None:
+                self.load()
+            entry = self.sources.get(key)
+
+        if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns and entry['inode'] == stat.st_ino \
+                and entry['hashed_ns'] - stat.st_mtime_ns > SOURCE_MTIME_GRANULARITY_NS:
+            return entry['sha256']
+
+        hashed_ns = time.time_ns()
+        sha256_hash = hashlib.sha256()
+        with open(src_path, 'rb') as file:
+            while chunk := file.read(SOURCE_HASH_CHUNK_SIZE):
+                sha256_hash.update(chunk)
+
+        with self.lock:
+            self.sources[key] = dict(
+                size=stat.st_size,
+                mtime_ns=stat.st_mtime_ns,
+                inode=stat.st_ino,
+                hashed_ns=hashed_ns,
+                sha256=sha256_hash.hexdigest()
+            )
+            self.save()
+
+        return sha256_hash.hexdigest()
+
+source_manifest = SourceManifest()
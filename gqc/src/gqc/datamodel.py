@@ -5,19 +5,36 @@ from typing import Iterable
 import pathlib
 from collections import namedtuple
 import pickle
+import functools
+import collections
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 import webcolors
+import numpy as np
 from PIL import Image
 from rich import print
-from rich.progress import Progress, TextColumn, BarColumn, TaskProgressColumn, TimeElapsedColumn
+from rich.progress import Progress
 
 from . import structs
+from . import encoding
 from .structs import EventType
-from .anim import make_animation
+from .anim import make_animation, frame_durations, is_still_image, decodes_in_process, ConversionScheduler, MAX_FRAME_TICKS
+from .cache import FrameCache, write_frame_cache, asset_cache_path, mark_used, source_manifest
 
 import hashlib
 
+encoder_pool : ProcessPoolExecutor = None
+encoder_pool_lock = threading.Lock()
+# Frames handed to the encoder pool ahead of the one being waited on, per worker.
+ENCODER_FRAMES_IN_FLIGHT = 4
+
+# An encoded frame, as handed back by the encoder workers or read from the
+#  frame cache (in which case `bytes` is a zero-copy view into the cache file).
 FrameOnDisk = namedtuple('FrameOnDisk', ['compression_type_name', 'width', 'height', 'bytes'])
+# A candidate frame encoding; see Frame.codecs.
+FrameCodec = namedtuple('FrameCodec', ['name', 'extended_format', 'measure', 'encode'])
 CueColor = namedtuple('CueColor', ['name', 'r', 'g', 'b'])
 GqcIntOperand = namedtuple('GqcIntOperand', 'is_literal value')
 
@@ -38,6 +55,8 @@ class Game:
 
         self.persistent_crc16_ptr = None
 
+        self.sections = dict() # Start and size of each section on the cart; see linker.create_symbol_table
+
         if Game.game is not None:
             raise ValueError("Game already defined")
         Game.game = self
@@ -382,13 +401,26 @@ class FrameEncoding(IntEnum):
     UNCOMPRESSED = 0x01
     RLE4 = 0x41
     RLE7 = 0x71
+    # Not yet supported by the badge firmware:
+    DELTA_RLE7 = 0xD1
+    TILE8 = 0xB1
+    RLE7_COLUMNS = 0xC1
+    PACKBITS = 0x91
+    FILL_0 = 0xE1
+    FILL_1 = 0xF1
+    RLE7_ROWS = 0xA1
 
 class Animation:
     anim_table = {}
     link_table = dict() # OrderedDict not needed to remember order since Python 3.7
     next_id : str = 0
+    jobs : int = 1 # Number of concurrent conversions, and of processes used to encode frames
+    scheduler : ConversionScheduler = None
+    gif_summary : bool = False # Whether to also write anim.gif when converting
+    in_process : bool = False # Whether to convert GIFs and PNGs without ffmpeg; see make_animation
+    keyframe_interval : int = 8 # Every nth frame is stored whole when delta frames are enabled
     
-    def __init__(self, name : str, source : str, dithering : str = 'none', frame_rate : int = 5, duration: int = 100, w : int = 128, h : int = 128):
+    def __init__(self, name : str, source : str, dithering : str = 'none', frame_rate : int = 5, duration: int = 100, w : int = 128, h : int = 128, crop : bool = False, source_timing : bool = False, pingpong : bool = False, row_seekable : bool = False, start : int = None, end : int = None, max_frames : int = None):
         self.frame_pointer = 0x00000000
         self.addr = 0x00000000
         self.name = name
@@ -397,6 +429,21 @@ class Animation:
         self.ticks_per_frame = 100 // frame_rate
         self.width = w
         self.height = h
+        self.crop = crop
+        self.source_timing = source_timing
+        self.pingpong = pingpong
+        # Whether every frame must be stored in a format the renderer can
+        #  start at any row (see Frame.row_seekable_formats), e.g. for a
+        #  foreground animation that's often clipped at the top of the screen.
+        self.row_seekable = row_seekable
+        # The part of the source to convert: from start to end, in ticks, and
+        #  at most max_frames frames of it. None means no limit.
+        self.start = start
+        self.end = end
+        self.max_frames = max_frames
+        self.flags = structs.AnimFlags.NONE # Set once the frames are loaded
+        self.durations_record = None # Set once the frames are loaded, if they have their own durations
+        self.crop_record = AnimCrop(self) if crop else None
 
         # Animation widths and heights must fit in a uint8_t
         if self.width > 128:
@@ -404,6 +451,13 @@ class Animation:
         if self.height > 128:
             raise ValueError(f"Animation {name} height {self.height} exceeds maximum of 128")
 
+        if start is not None and start < 0:
+            raise ValueError(f"Animation {name} start {start} is negative")
+        if end is not None and end <= (start or 0):
+            raise ValueError(f"Animation {name} end {end} is not after its start")
+        if max_frames is not None and max_frames < 1:
+            raise ValueError(f"Animation {name} max_frames {max_frames} must be at least 1")
+
         self.id = Animation.next_id
         Animation.next_id += 1
 
@@ -413,85 +467,152 @@ class Animation:
 
         self.frames = []
 
-        with Progress(TextColumn("[progress.description]{task.description}"), BarColumn(), TaskProgressColumn(), TimeElapsedColumn()) as animation_progress:
-            anim_task = animation_progress.add_task(f"[blue]Animation [italic]{name}[/italic]", total=None)
-            hash_task = animation_progress.add_task(f" [dim]-- digest", total=1, start=False)
-            
-            if 100 % frame_rate != 0:
-                print(f"[red][bold]WARNING[/bold][/red]: [blue][italic]{self.name}[/italic][/blue] frame rate {frame_rate} not a factor of 100; setting to {100 / self.tiks_per_frame}")
-                frame_rate = 100 / self.ticks_per_frame
-
-            if frame_rate > 5:
-                print(f"[red][bold]WARNING[/bold][/red]: [blue][italic]{self.name}[/italic][/blue] frame rate {frame_rate} exceeds 5 FPS; badge performance may suffer.")
-
-            make_animation_kwargs = dict()
-            if dithering:
-                make_animation_kwargs['dithering'] = dithering
-            if frame_rate:
-                make_animation_kwargs['frame_rate'] = frame_rate
-            if self.width:
-                make_animation_kwargs['width'] = self.width
-            if self.height:
-                make_animation_kwargs['height'] = self.height
-
-            self.src_path = pathlib.Path() / 'assets' / 'animations' / source
-            self.dst_path = pathlib.Path() / 'build' / 'assets' / 'animations' / Game.game_name / name
-            digest_path = self.dst_path / '.digest'
-            
-            # Check if the dst_path has a file in it called .digest and compare it to self.digest()
-            # If they match, skip the ffmpeg conversion step
-            ffmpeged = False
-            if digest_path.exists():
-                animation_progress.update(hash_task, total=1)
-                animation_progress.start_task(hash_task)
-                with open(digest_path, 'r') as digest_file:
-                    if digest_file.read() == self.digest():
-                        animation_progress.update(hash_task, completed=1, total=1)
-                        animation_progress.update(anim_task, completed=1, total=1)
-                        ffmpeged = True
-                        animation_progress.update(hash_task, advance=1)
-
-            # Reformat the animation source file into the build directory.
-            if not ffmpeged:
-                make_animation(
+        if 100 % frame_rate != 0:
+            print(f"[red][bold]WARNING[/bold][/red]: [blue][italic]{self.name}[/italic][/blue] frame rate {frame_rate} not a factor of 100; setting to {100 / self.ticks_per_frame}")
+            frame_rate = 100 / self.ticks_per_frame
+
+        if frame_rate > 5:
+            print(f"[red][bold]WARNING[/bold][/red]: [blue][italic]{self.name}[/italic][/blue] frame rate {frame_rate} exceeds 5 FPS; badge performance may suffer.")
+
+        if crop:
+            print(f"[red][bold]WARNING[/bold][/red]: [blue][italic]{self.name}[/italic][/blue] is cropped; the badge firmware doesn't apply crop offsets yet.")
+
+        if source_timing:
+            print(f"[red][bold]WARNING[/bold][/red]: [blue][italic]{self.name}[/italic][/blue] uses its source's frame timing; the badge firmware doesn't apply per-frame durations yet.")
+
+        if pingpong:
+            print(f"[red][bold]WARNING[/bold][/red]: [blue][italic]{self.name}[/italic][/blue] is ping-pong; the badge firmware doesn't play animations backward yet.")
+
+        make_animation_kwargs = dict()
+        if dithering:
+            make_animation_kwargs['dithering'] = dithering
+        if frame_rate:
+            make_animation_kwargs['frame_rate'] = frame_rate
+        if source_timing:
+            make_animation_kwargs['source_timing'] = True
+        if self.width:
+            make_animation_kwargs['width'] = self.width
+        if self.height:
+            make_animation_kwargs['height'] = self.height
+        if start is not None:
+            make_animation_kwargs['start'] = start
+        if end is not None:
+            make_animation_kwargs['end'] = end
+        if max_frames is not None:
+            make_animation_kwargs['max_frames'] = max_frames
+
+        self.src_path = pathlib.Path() / 'assets' / 'animations' / source
+        self.dst_path = pathlib.Path() / 'build' / 'assets' / 'animations' / Game.game_name / name
+
+        # Check this here, rather than during conversion, so it's reported as a parse error.
+        if not self.src_path.exists():
+            raise ValueError(f"Animation source file {self.src_path} does not exist")
+
+        # Conversion and encoding run in the background while the rest of the game
+        #  is parsed; the linker waits for them in load_assets().
+        if Animation.scheduler is None:
+            Animation.scheduler = ConversionScheduler(Animation.jobs)
+        Animation.scheduler.submit(self.load, duration, make_animation_kwargs)
+
+    @classmethod
+    def wait_for_loads(cls):
+        if cls.scheduler is not None:
+            cls.scheduler.wait()
+            cls.scheduler = None
+
+    def load(self, animation_progress : Progress, duration : int, make_animation_kwargs : dict):
+        # Runs on one of the scheduler's threads. Everything here touches only
+        #  this animation (and the shared encoder pool), never the link tables.
+        name = self.name
+
+        anim_task = animation_progress.add_task(f"[blue]Animation [italic]{name}[/italic]", total=None)
+        hash_task = animation_progress.add_task(f" [dim]{name} -- digest", total=1, start=False)
+
+        digest = self.digest()
+        cache_path = asset_cache_path(digest)
+        
+        # If any game in the workspace has already converted an animation with the
+        #  same inputs, load the frames from the asset cache and skip the ffmpeg
+        #  conversion step.
+        animation_progress.start_task(hash_task)
+        cache = None
+        if cache_path.exists():
+            try:
+                cache = FrameCache(cache_path)
+            except ValueError:
+                cache = None
+            if cache and cache.digest != digest:
+                cache = None
+            if cache:
+                mark_used(cache_path)
+        animation_progress.update(hash_task, completed=1, total=1)
+
+        binary_task = animation_progress.add_task(f" [dim]{name} -> gqimage", total=None)
+
+        if cache:
+            # Only the cache's index is read here; each frame's bytes are a view
+            #  into the mapped file.
+            animation_progress.update(binary_task, total=len(cache))
+            self.flags = cache.flags
+            if self.crop_record:
+                self.crop_record.x, self.crop_record.y = cache.crop
+            for index, entry in enumerate(cache.entries):
+                frame = Frame(encoded=FrameOnDisk(
+                    compression_type_name=Frame.image_format_names[entry.encoding],
+                    width=entry.width,
+                    height=entry.height,
+                    bytes=cache.payload(index)
+                ))
+                frame.duration = entry.duration
+                self.frames.append(frame)
+                animation_progress.update(binary_task, advance=1)
+        else:
+            # Reformat the animation source file, streaming its frames straight
+            #  into the encoder (in parallel if allowed), then write the cache.
+            try:
+                frame_images = make_animation(
                     animation_progress,
                     self.src_path,
                     self.dst_path,
+                    write_frames=False,
+                    write_gif=Animation.gif_summary,
+                    in_process=Animation.in_process,
                     **make_animation_kwargs
                 )
-            binary_task = animation_progress.add_task(f" [dim]-> gqimage", total=1, start=False)
-            
-            # Load each frame into a Frame object
-            frame_paths = sorted(self.dst_path.glob('frame*.bmp'))
-            animation_progress.update(binary_task, total=len(frame_paths))
-            animation_progress.start_task(binary_task)
-
-            if len(frame_paths) == 1:
-                self.ticks_per_frame = duration
-            
-            # Animation durations must fit in a uint16_t
-            if self.ticks_per_frame > 0xffff:
-                raise ValueError(f"Animation {name} duration {self.ticks_per_frame} exceeds maximum of 65535")
-
-            for frame_path in frame_paths:
-                serialized_path = frame_path.with_suffix('.gqframe')
-                if ffmpeged and serialized_path.exists():
-                    self.frames.append(Frame(path=serialized_path))
-                else:
-                    self.frames.append(Frame(path=frame_path))
-                    self.frames[-1].serialize(serialized_path)
-                animation_progress.update(binary_task, advance=1)
-            animation_progress.start_task(anim_task)
-            animation_progress.update(anim_task, completed=1, total=1)
-
-            # Write the digest of the source file to the .digest file
-            if not ffmpeged:
-                animation_progress.update(hash_task, total=1)
-                animation_progress.start_task(hash_task)
-                with open(self.dst_path / '.digest', 'w') as digest_file:
-                    digest_file.write(self.digest())
-                animation_progress.update(hash_task, advance=1)
+                if self.crop:
+                    frame_images = self.crop_frames(list(frame_images))
+                self.frames = encode_frames(frame_images, Animation.jobs, animation_progress, binary_task, row_seekable=self.row_seekable)
+                if self.source_timing and not is_still_image(self.src_path):
+                    self.frames = collapse_held_frames(self.frames, frame_durations(self.dst_path))
+                    self.flags |= structs.AnimFlags.FRAME_DURATIONS
+                if self.pingpong:
+                    self.flags |= structs.AnimFlags.PINGPONG
+                elif 'pingpong' in Frame.extended_formats and (forward_frames := fold_pingpong(self.frames)):
+                    self.frames = forward_frames
+                    self.flags |= structs.AnimFlags.PINGPONG
+                encode_extended_formats(self.frames, reversible=bool(self.flags & structs.AnimFlags.PINGPONG), row_seekable=self.row_seekable)
+            except ValueError as ve:
+                raise ValueError(f"Animation {name} could not be converted: {ve}")
+            write_frame_cache(
+                cache_path,
+                [frame.cache_entry() for frame in self.frames],
+                digest,
+                flags=self.flags,
+                crop=(self.crop_record.x, self.crop_record.y) if self.crop_record else (0, 0)
+            )
+        if self.flags & structs.AnimFlags.FRAME_DURATIONS:
+            self.durations_record = AnimDurations(self)
+        animation_progress.update(binary_task, total=len(self.frames))
+        animation_progress.start_task(anim_task)
+        animation_progress.update(anim_task, completed=1, total=1)
+
+        if len(self.frames) == 1:
+            self.ticks_per_frame = duration
         
+        # Animation durations must fit in a uint16_t
+        if self.ticks_per_frame > 0xffff:
+            raise ValueError(f"Animation {name} duration {self.ticks_per_frame} exceeds maximum of 65535")
+
         # Frame counts must fit in a uint16_t
         if len(self.frames) > 0xffff:
             raise ValueError(f"Animation {name} has too many frames ({len(self.frames)}); maximum is 65535")
@@ -499,22 +620,62 @@ class Animation:
         if len(self.frames) == 0:
             raise ValueError(f"Animation {name} has no frames - possible image content or compiler error")
             
+    def crop_frames(self, frame_images : list[Image.Image]) -> list[Image.Image]:
+        # Crop every frame to the union of their content (nonzero pixels),
+        #  recording where that region sits in the full canvas. Nothing outside
+        #  it is ever drawn through a mask, so for masks and masked animations
+        #  this is lossless; an unmasked animation loses the zero pixels it
+        #  would have drawn around its content.
+        box = encoding.bounding_box([encoding.unpack_pixels(image) for image in frame_images])
+        if box is None:
+            # Entirely blank; keep a single pixel.
+            box = (0, 0, 1, 1)
+        x, y, width, height = box
+        self.crop_record.x = x
+        self.crop_record.y = y
+        self.flags |= structs.AnimFlags.CROPPED
+        return [image.crop((x, y, x + width, y + height)) for image in frame_images]
+
     def digest(self) -> int:
         # An Animation object is uniquely identified by a hash of the source file,
-        #  its frame rate, size, and its dithering configuration.
+        #  its frame rate, size, trimming, and its dithering configuration.
 
-        # Get a SHA-256 hash of self.source's contents
-        with open(self.src_path, 'rb') as file:
-            contents = file.read()
-            sha256_hash = hashlib.sha256(contents)
+        # Start from a SHA-256 hash of self.source's contents (which is only
+        #  recomputed if the file has changed since it was last hashed)
+        sha256_hash = hashlib.sha256(source_manifest.sha256(self.src_path).encode('ascii'))
         sha256_hash.update(str(self.ticks_per_frame).encode('ascii'))
         sha256_hash.update(self.dithering.encode('ascii'))
+        if decodes_in_process(self.src_path, Animation.in_process):
+            sha256_hash.update(b'pillow')
         sha256_hash.update(str(self.width).encode('ascii'))
         sha256_hash.update(str(self.height).encode('ascii'))
+        if self.crop:
+            sha256_hash.update(b'crop')
+        if self.source_timing:
+            sha256_hash.update(b'source_timing')
+        if self.pingpong:
+            sha256_hash.update(b'pingpong')
+        if self.row_seekable:
+            sha256_hash.update(b'row_seekable')
+        if (self.start, self.end, self.max_frames) != (None, None, None):
+            sha256_hash.update(f'trim:{self.start},{self.end},{self.max_frames}'.encode('ascii'))
+        sha256_hash.update(','.join(codec.name for codec in Frame.codecs).encode('ascii'))
+        sha256_hash.update(','.join(sorted(Frame.extended_formats)).encode('ascii'))
+        if 'delta' in Frame.extended_formats:
+            sha256_hash.update(str(Animation.keyframe_interval).encode('ascii'))
+        if Frame.encoding_policy != 'size':
+            sha256_hash.update(Frame.encoding_policy.encode('ascii'))
+        if Frame.encoding_policy == 'balanced':
+            sha256_hash.update(str(Frame.speed_weight).encode('ascii'))
         from . import __version__
         sha256_hash.update(__version__.encode('ascii'))
         return sha256_hash.hexdigest()
     
+    def frame_table_records(self) -> list:
+        # The records placed in the frame table after this animation's frames,
+        #  in order, as indicated by its flags.
+        return [record for record in (self.durations_record, self.crop_record) if record]
+
     def set_frame_pointer(self, frame_pointer : int, namespace : int = structs.GQ_PTR_NS_CART):
         self.frame_pointer = structs.gq_ptr_apply_ns(namespace, frame_pointer)
     
@@ -533,54 +694,172 @@ class Animation:
             id=self.id,
             frame_count=len(self.frames),
             ticks_per_frame=self.ticks_per_frame,
-            flags=0,
+            flags=self.flags,
             width=self.frames[0].width,
             height=self.frames[0].height,
             frame_pointer=self.frame_pointer
         )
         return struct.pack(structs.GQ_ANIM_FORMAT, *anim_struct)
 
+class AnimDurations:
+    # How long each of an animation's frames is shown, in ticks. Placed
+    #  directly after the animation's frames, in the frame table.
+    def __init__(self, anim : Animation):
+        self.anim = anim
+        self.addr = 0x00000000 # Set at link time
+
+    def set_addr(self, addr : int, namespace : int = structs.GQ_PTR_NS_CART):
+        self.addr = structs.gq_ptr_apply_ns(namespace, addr)
+        Frame.link_table[self.addr] = self
+
+    def size(self):
+        return len(self.anim.frames) * structs.GQ_ANIM_DURATION_SIZE
+
+    def to_bytes(self):
+        return b''.join(struct.pack(structs.GQ_ANIM_DURATION_FORMAT, frame.duration) for frame in self.anim.frames)
+
+    def __repr__(self) -> str:
+        return f"AnimDurations('{self.anim.name}', {sum(frame.duration for frame in self.anim.frames)} ticks)"
+
+class AnimCrop:
+    # Where a cropped animation's frames sit within its full canvas. Placed
+    #  directly after the animation's frames, in the frame table.
+    def __init__(self, anim : Animation):
+        self.anim = anim
+        self.addr = 0x00000000 # Set at link time
+        self.x = 0
+        self.y = 0
+
+    def set_addr(self, addr : int, namespace : int = structs.GQ_PTR_NS_CART):
+        self.addr = structs.gq_ptr_apply_ns(namespace, addr)
+        Frame.link_table[self.addr] = self
+
+    def size(self):
+        return structs.GQ_ANIM_CROP_SIZE
+
+    def to_bytes(self):
+        return struct.pack(structs.GQ_ANIM_CROP_FORMAT, *structs.GqAnimCrop(x=self.x, y=self.y))
+
+    def __repr__(self) -> str:
+        return f"AnimCrop('{self.anim.name}', {self.x}, {self.y})"
+
 class Frame:
     link_table = dict() # OrderedDict not needed to remember order since Python 3.7
 
     image_formats = dict(
         IMAGE_FMT_1BPP_COMP_RLE7=0x71,
-        # IMAGE_FMT_1BPP_COMP_RLE4=0x41,
-        IMAGE_FMT_1BPP_UNCOMP=0x01
+        IMAGE_FMT_1BPP_COMP_RLE4=0x41,
+        IMAGE_FMT_1BPP_UNCOMP=0x01,
+        IMAGE_FMT_1BPP_DELTA_RLE7=0xD1,
+        IMAGE_FMT_1BPP_TILE8=0xB1,
+        IMAGE_FMT_1BPP_COMP_RLE7_COLUMNS=0xC1,
+        IMAGE_FMT_1BPP_PACKBITS=0x91,
+        IMAGE_FMT_1BPP_FILL_0=0xE1,
+        IMAGE_FMT_1BPP_FILL_1=0xF1,
+        IMAGE_FMT_1BPP_COMP_RLE7_ROWS=0xA1
+    )
+    image_format_names = {number: name for name, number in image_formats.items()}
+
+    # Frame formats the badge firmware can't display yet are only used when
+    #  enabled by name (gqc compile -x). So is folding ping-pong animations
+    #  ('pingpong'), which the firmware can't play yet either.
+    extended_formats : frozenset = frozenset()
+
+    # The encodings each frame is considered for on its own, in order of
+    #  preference when they tie. measure(pixels, runs) works out the payload
+    #  length and the number of runs the badge would decode, from the frame's
+    #  pixels and its row-major runs (shared by all the codecs), without
+    #  encoding anything; it returns None if the codec can't represent the
+    #  frame. Only the candidate chosen by encoding_policy is encoded.
+    codecs = (
+        FrameCodec('IMAGE_FMT_1BPP_COMP_RLE7', None,
+                   lambda pixels, runs: (encoding.rle_size(runs[1], 7),) * 2,
+                   lambda pixels, runs: encoding.rle_bytes(pixels, 7, runs)),
+        FrameCodec('IMAGE_FMT_1BPP_UNCOMP', None,
+                   lambda pixels, runs: (encoding.uncompressed_size(pixels), 0),
+                   lambda pixels, runs: encoding.uncompressed_bytes(pixels)),
+        FrameCodec('IMAGE_FMT_1BPP_COMP_RLE4', None,
+                   lambda pixels, runs: (encoding.rle_size(runs[1], 4),) * 2,
+                   lambda pixels, runs: encoding.rle_bytes(pixels, 4, runs)),
+        FrameCodec('IMAGE_FMT_1BPP_FILL_0', 'solid',
+                   lambda pixels, runs: (0, 0) if encoding.solid_value(runs) == 0 else None,
+                   lambda pixels, runs: bytes()),
+        FrameCodec('IMAGE_FMT_1BPP_FILL_1', 'solid',
+                   lambda pixels, runs: (0, 0) if encoding.solid_value(runs) == 1 else None,
+                   lambda pixels, runs: bytes()),
+        FrameCodec('IMAGE_FMT_1BPP_COMP_RLE7_COLUMNS', 'columns',
+                   lambda pixels, runs: (encoding.rle_size(encoding.rle_runs(pixels.T)[1], 7),) * 2,
+                   lambda pixels, runs: encoding.column_rle_bytes(pixels)),
+        FrameCodec('IMAGE_FMT_1BPP_PACKBITS', 'packbits',
+                   lambda pixels, runs: encoding.packbits_measure(pixels),
+                   lambda pixels, runs: encoding.packbits_bytes(pixels)),
+        FrameCodec('IMAGE_FMT_1BPP_COMP_RLE7_ROWS', 'rows',
+                   lambda pixels, runs: row_indexed_measure(pixels),
+                   lambda pixels, runs: encoding.row_indexed_bytes(pixels)),
     )
 
-    def __init__(self, img : Image = None, path : pathlib.Path = None):
+    # Formats in which a renderer can start at any row without decoding the
+    #  ones above it. Every frame of a row_seekable animation is stored in one
+    #  of these, so if it's clipped at the top of the screen its hidden rows
+    #  can be skipped. Row-indexed RLE is among them only when 'rows' is
+    #  enabled.
+    row_seekable_formats = frozenset((
+        'IMAGE_FMT_1BPP_UNCOMP',
+        'IMAGE_FMT_1BPP_COMP_RLE7_ROWS',
+        'IMAGE_FMT_1BPP_FILL_0',
+        'IMAGE_FMT_1BPP_FILL_1',
+        'IMAGE_FMT_1BPP_TILE8'
+    ))
+
+    # How to trade payload size against render cost (see encoding.render_cost)
+    #  when choosing encodings: 'size', 'speed', or 'balanced', which weighs
+    #  each relative to the frame's uncompressed encoding by speed_weight.
+    encoding_policy : str = 'size'
+    speed_weight : float = 0.5
+
+    def __init__(self, img : Image = None, path : pathlib.Path = None, encoded : FrameOnDisk = None, row_seekable : bool = False):
         self.addr = 0x00000000
         self.frame_data = FrameData(self)
+        self.duration = 0 # In ticks; 0 if the frame is shown for the animation's ticks_per_frame
 
-        assert img or path
+        assert img or path or encoded
         
         reading_bytes = False
 
-        if img:
+        if encoded:
+            self.load_encoded(encoded)
+            return
+        elif img:
             self.image = img
         elif path:
-            if path.suffix == '.gqframe':
-                self.deserialize(path)
-                return
-            else:
-                self.image = Image.open(path)
+            self.image = Image.open(path)
         
         self.image = self.image.convert('1')
-
-        # Now, determine which of these image types is the smallest:
-        image_types = dict(
-            IMAGE_FMT_1BPP_COMP_RLE7=self.image_rle7_bytes(),
-            # IMAGE_FMT_1BPP_COMP_RLE4=self.image_rle4_bytes(),
-            IMAGE_FMT_1BPP_UNCOMP=self.uncompressed_bytes()
-        )
-
-        self.compression_type_name = sorted(list(image_types.keys()), key=lambda a: len(image_types[a]))[0]
-        self.compression_type_number = Frame.image_formats[self.compression_type_name]
-        self.bytes = image_types[self.compression_type_name]
+        self.pixels = encoding.unpack_pixels(self.image)
 
         self.width = self.image.width
         self.height = self.image.height
+
+        # Now, determine which of the available encodings is best under the
+        #  encoding policy:
+        runs = encoding.rle_runs(self.pixels)
+        best_codec = None
+        best_score = None
+        for codec in Frame.codecs:
+            if codec.extended_format and codec.extended_format not in Frame.extended_formats:
+                continue
+            if row_seekable and codec.name not in Frame.row_seekable_formats:
+                continue
+            measure = codec.measure(self.pixels, runs)
+            if measure is None:
+                continue
+            size, run_count = measure
+            score = self.score(size, encoding.render_cost(size, run_count, self.pixels.size))
+            if best_score is None or score < best_score:
+                best_codec = codec
+                best_score = score
+
+        self.use_encoding(best_codec.name, best_codec.encode(self.pixels, runs))
     
     def set_addr(self, addr : int, namespace : int = structs.GQ_PTR_NS_CART):
         self.addr = structs.gq_ptr_apply_ns(namespace, addr)
@@ -594,87 +873,89 @@ class Frame:
         )
         return struct.pack(structs.GQ_ANIM_FRAME_FORMAT, *frame_struct)
     
-    def serialize(self, out_path : pathlib.Path):
-        d = FrameOnDisk(
+    def encoded(self) -> FrameOnDisk:
+        return FrameOnDisk(
             compression_type_name=self.compression_type_name,
             width=self.width,
             height=self.height,
             bytes=self.bytes
         )
-        with open(out_path, 'wb') as file:
-            pickle.dump(d, file)
 
-    def deserialize(self, in_path : pathlib.Path):
-        with open(in_path, 'rb') as file:
-            d = pickle.load(file)
-            self.compression_type_name = d.compression_type_name
-            self.compression_type_number = Frame.image_formats[self.compression_type_name]
-            self.width = d.width
-            self.height = d.height
-            self.bytes = d.bytes
+    def load_encoded(self, d : FrameOnDisk):
+        self.compression_type_name = d.compression_type_name
+        self.compression_type_number = Frame.image_formats[self.compression_type_name]
+        self.width = d.width
+        self.height = d.height
+        self.bytes = d.bytes
+
+    def cache_entry(self) -> tuple[int, int, int, bytes, int]:
+        return (self.compression_type_number, self.width, self.height, self.bytes, self.duration)
+
+    def use_encoding(self, compression_type_name : str, payload : bytes):
+        self.compression_type_name = compression_type_name
+        self.compression_type_number = Frame.image_formats[compression_type_name]
+        self.bytes = payload
+
+    def use_encoding_if_better(self, compression_type_name : str, payload : bytes) -> bool:
+        cost = frame_render_cost(Frame.image_formats[compression_type_name], payload, self.width, self.height)
+        if self.score(len(payload), cost) >= self.score(len(self.bytes), self.render_cost()):
+            return False
+        self.use_encoding(compression_type_name, payload)
+        return True
+
+    def render_cost(self) -> int:
+        return frame_render_cost(self.compression_type_number, self.bytes, self.width, self.height)
+
+    def score(self, size : int, cost : int) -> float:
+        # Lower is better.
+        if Frame.encoding_policy == 'speed':
+            return cost
+        elif Frame.encoding_policy == 'balanced':
+            # Both measured relative to the uncompressed frame, which is always a candidate.
+            reference_size = self.height * -(-self.width // 8)
+            reference_cost = encoding.render_cost(reference_size, 0, self.width * self.height)
+            return (1 - Frame.speed_weight) * size / reference_size + Frame.speed_weight * cost / reference_cost
+        return size
+
+    def decode(self, previous : np.ndarray = None, dictionary : np.ndarray = None) -> np.ndarray:
+        # Reference decoder, returning the frame's pixels. Delta frames also need
+        #  the decoded pixels of the frame before them, and tile frames other than
+        #  the first need the tile dictionary stored in the first.
+        if self.compression_type_number == FrameEncoding.UNCOMPRESSED:
+            return encoding.decode_uncompressed(self.bytes, self.width, self.height)
+        elif self.compression_type_number == FrameEncoding.RLE4:
+            return encoding.decode_rle(self.bytes, 4, self.width, self.height)
+        elif self.compression_type_number == FrameEncoding.RLE7:
+            return encoding.decode_rle(self.bytes, 7, self.width, self.height)
+        elif self.compression_type_number == FrameEncoding.RLE7_COLUMNS:
+            return encoding.decode_column_rle(self.bytes, self.width, self.height)
+        elif self.compression_type_number == FrameEncoding.RLE7_ROWS:
+            return encoding.decode_row_indexed(self.bytes, self.width, self.height)
+        elif self.compression_type_number == FrameEncoding.PACKBITS:
+            return encoding.decode_packbits(self.bytes, self.width, self.height)
+        elif self.compression_type_number == FrameEncoding.FILL_0:
+            return encoding.decode_solid(0, self.width, self.height)
+        elif self.compression_type_number == FrameEncoding.FILL_1:
+            return encoding.decode_solid(1, self.width, self.height)
+        elif self.compression_type_number == FrameEncoding.DELTA_RLE7:
+            if previous is None:
+                raise ValueError(f"{self} is a delta frame with no frame before it")
+            return encoding.decode_xor_delta(self.bytes, previous)
+        elif self.compression_type_number == FrameEncoding.TILE8:
+            index_map = self.bytes
+            if dictionary is None:
+                dictionary, index_map = encoding.split_tile_dictionary(self.bytes)
+            return encoding.decode_tiles(index_map, dictionary, self.width, self.height)
+        raise ValueError(f"{self} has unknown encoding {self.compression_type_number:#04x}")
 
     def size(self):
         return structs.GQ_ANIM_FRAME_SIZE
 
     def uncompressed_bytes(self):
-        run = 0
-        val = 0
-        out_bytes = []
-        row_run = 0
-
-        for pixel_raw in self.image.getdata():
-            pixel = 1 if pixel_raw else 0
-
-            if run == 8 or row_run == self.image.width:
-                out_bytes.append(val)
-                run = 0
-                val = 0
-                if row_run == self.image.width:
-                    row_run = 0
-            
-            if pixel:
-                val |= (0b10000000 >> run)
-            
-            run += 1
-            row_run += 1
-
-        # We definitely didn't finish the above with a write-out, so do one:
-        out_bytes.append(val)
-        
-        return bytes(out_bytes)
+        return encoding.uncompressed_bytes(self.pixels)
 
     def rle_bytes(self, bits):
-        val = 1 if self.image.getdata()[0] else 0
-        run = 0
-        out_bytes = []
-        if bits == 4:
-            run_max = 0x0f
-            val_mask = 0xf0
-        elif bits == 7:
-            run_max = 0x7f # 127
-            val_mask = 0xfe
-        else:
-            assert False # ERROR.
-
-        for pixel_raw in list(self.image.getdata())[1:]:
-            pixel = 1 if pixel_raw else 0
-            if pixel == val:
-                # same as previous pixel value; add to the run value
-                if run == run_max:
-                    run = 0
-                    out_bytes.append(val_mask + val)
-                else:
-                    run += 1
-            else:
-                # different from previous pixel value; write out current run,
-                # and then change run and val.
-                out_bytes.append((run << (8-bits)) + val)
-                run = 0
-                val = pixel
-        # We always have at least one more value to write-out:
-        out_bytes.append((run << (8-bits)) + val)
-        
-        return bytes(out_bytes)
+        return encoding.rle_bytes(self.pixels, bits)
 
     def image_rle4_bytes(self):
         return self.rle_bytes(4)
@@ -685,6 +966,194 @@ class Frame:
     def __repr__(self) -> str:
         return f"Frame({self.width}x{self.height}:{self.compression_type_name})"
 
+def encode_frame(source : Image.Image | pathlib.Path, row_seekable : bool = False) -> FrameOnDisk:
+    # Encode a single frame, given as an image or the path to one. This runs in
+    #  the encoder pool's worker processes, so only the small encoded tuple is
+    #  sent back.
+    if isinstance(source, Image.Image):
+        frame = Frame(img=source, row_seekable=row_seekable)
+    else:
+        frame = Frame(path=source, row_seekable=row_seekable)
+    return frame.encoded()
+
+def init_encoder_worker(extended_formats : frozenset, encoding_policy : str, speed_weight : float):
+    # Encoder workers are spawned fresh, so settings made by the command line
+    #  have to be handed over.
+    Frame.extended_formats = extended_formats
+    Frame.encoding_policy = encoding_policy
+    Frame.speed_weight = speed_weight
+
+def encode_in_pool(pool : ProcessPoolExecutor, encode, sources : Iterable, window : int):
+    # Like pool.map(encode, sources), but only reads a source once fewer than
+    #  `window` frames are waiting to be encoded, rather than submitting them
+    #  all up front, so frames streaming out of ffmpeg aren't all buffered.
+    pending = collections.deque()
+    for source in sources:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(pool.submit(encode, source))
+    while pending:
+        yield pending.popleft().result()
+
+def encode_frames(sources : Iterable, jobs : int = 1, progress : Progress = None, task = None, row_seekable : bool = False) -> list[Frame]:
+    # Encode frames in order, spreading the work across up to `jobs` processes.
+    #  sources may be a generator (e.g. frames streaming out of ffmpeg); it's
+    #  read only as fast as the workers keep up, with a few frames per worker
+    #  in flight. The pool is created on first use and shared by every
+    #  animation in the compile (including ones loading concurrently on the
+    #  conversion scheduler's threads); see shutdown_encoder_pool().
+    global encoder_pool
+
+    encode = functools.partial(encode_frame, row_seekable=row_seekable)
+    if jobs > 1 and not (isinstance(sources, list) and len(sources) < 2):
+        with encoder_pool_lock:
+            if encoder_pool is None:
+                encoder_pool = ProcessPoolExecutor(
+                    max_workers=jobs,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=init_encoder_worker,
+                    initargs=(Frame.extended_formats, Frame.encoding_policy, Frame.speed_weight)
+                )
+        encoded_frames = encode_in_pool(encoder_pool, encode, sources, jobs * ENCODER_FRAMES_IN_FLIGHT)
+    else:
+        encoded_frames = map(encode, sources)
+
+    frames = []
+    for encoded in encoded_frames:
+        frames.append(Frame(encoded=encoded))
+        if progress:
+            progress.update(task, advance=1)
+    return frames
+
+def row_indexed_measure(pixels : np.ndarray) -> tuple[int, int] | None:
+    # Size (including the row offset table) and run count of a row-indexed
+    #  RLE7 frame, or None if it's too big for the offset table.
+    size = encoding.row_indexed_size(pixels)
+    runs_size = size - pixels.shape[0] * encoding.ROW_OFFSET_SIZE
+    if runs_size > 0xFFFF:
+        return None
+    return size, runs_size
+
+def frame_render_cost(compression_type_number : int, payload : bytes, width : int, height : int) -> int:
+    # Estimated cost for the badge to render a frame; see encoding.render_cost.
+    pixel_count = width * height
+    if compression_type_number in (FrameEncoding.RLE4, FrameEncoding.RLE7, FrameEncoding.RLE7_COLUMNS):
+        return encoding.render_cost(len(payload), len(payload), pixel_count)
+    elif compression_type_number == FrameEncoding.DELTA_RLE7:
+        return encoding.render_cost(len(payload), len(payload), pixel_count, passes=2)
+    elif compression_type_number == FrameEncoding.RLE7_ROWS:
+        # The row offset table is only read when clipping.
+        runs_size = len(payload) - height * encoding.ROW_OFFSET_SIZE
+        return encoding.render_cost(runs_size, runs_size, pixel_count)
+    elif compression_type_number == FrameEncoding.PACKBITS:
+        return encoding.render_cost(len(payload), encoding.packbits_packet_count(payload), pixel_count)
+    elif compression_type_number == FrameEncoding.TILE8:
+        # Each tile costs a lookup and a read of its 8 bytes (taking the index
+        #  as one byte; the first frame's dictionary is only read through them).
+        tiles = -(-width // encoding.TILE_SIZE) * -(-height // encoding.TILE_SIZE)
+        return encoding.render_cost(tiles * (encoding.TILE_SIZE + 1), tiles, pixel_count)
+    return encoding.render_cost(len(payload), 0, pixel_count)
+
+def collapse_held_frames(frames : list[Frame], durations : list[int]) -> list[Frame]:
+    # Gives each frame its duration in ticks, then merges each run of
+    #  identical consecutive frames into its first frame, shown for the run's
+    #  total duration. Frames too short to ever be shown are dropped.
+    if len(frames) != len(durations):
+        raise ValueError(f"got {len(frames)} frames but timing for {len(durations)}")
+
+    collapsed = []
+    for frame, duration in zip(frames, durations):
+        if not duration:
+            continue
+        held = collapsed[-1] if collapsed else None
+        if held and held.compression_type_number == frame.compression_type_number and held.bytes == frame.bytes \
+                and held.duration + duration <= MAX_FRAME_TICKS:
+            held.duration += duration
+        else:
+            frame.duration = duration
+            collapsed.append(frame)
+
+    if not collapsed and frames:
+        # Every frame was shorter than a tick; show the first for one.
+        frames[0].duration = 1
+        collapsed.append(frames[0])
+    return collapsed
+
+def fold_pingpong(frames : list[Frame]) -> list[Frame] | None:
+    # If frames loop as a ping-pong, i.e. f0 f1 ... fk ... f1 (then back to
+    #  f0), returns just the forward half f0 ... fk, which plays the same loop
+    #  forward and then backward without repeating either end. Frames are
+    #  compared by their encoding, duration and a hash of their payload.
+    if len(frames) < 4 or len(frames) % 2:
+        return None
+    keys = [(frame.compression_type_number, frame.duration, hashlib.sha256(frame.bytes).digest()) for frame in frames]
+    turn = len(frames) // 2
+    if any(keys[turn - offset] != keys[turn + offset] for offset in range(1, turn)):
+        return None
+    return frames[:turn + 1]
+
+def encode_deltas(frames : list[Frame], keyframe_interval : int):
+    # Store each frame as the XOR against the frame before it wherever that's
+    #  better under the encoding policy. Every keyframe_interval-th frame
+    #  (including the first, which playback loops back to) is always stored
+    #  whole, so nothing has to look back further than the last keyframe to
+    #  reconstruct a frame.
+    previous = None
+    for index, frame in enumerate(frames):
+        pixels = frame.decode(previous)
+        if index % keyframe_interval:
+            frame.use_encoding_if_better('IMAGE_FMT_1BPP_DELTA_RLE7', encoding.xor_delta_bytes(pixels, previous))
+        previous = pixels
+
+def encode_tiles(frames : list[Frame]) -> bool:
+    # Switch the whole animation to the tile dictionary format if that's better
+    #  in total, under the encoding policy, than the frames' current encodings.
+    #  It's all or nothing, since every tile frame depends on the dictionary
+    #  stored in the first.
+    payloads = encoding.tile_bytes(decode_frames(frames))
+    if payloads is None:
+        return False
+    tile_score = 0
+    current_score = 0
+    for frame, payload in zip(frames, payloads):
+        tile_score += frame.score(len(payload), frame_render_cost(FrameEncoding.TILE8, payload, frame.width, frame.height))
+        current_score += frame.score(len(frame.bytes), frame.render_cost())
+    if tile_score >= current_score:
+        return False
+    for frame, payload in zip(frames, payloads):
+        frame.use_encoding('IMAGE_FMT_1BPP_TILE8', payload)
+    return True
+
+def encode_extended_formats(frames : list[Frame], reversible : bool = False, row_seekable : bool = False):
+    # Per-animation encoding passes for the enabled extended formats, run once
+    #  all of an animation's frames have been encoded individually. reversible
+    #  animations (ping-pong) are also played backward; row_seekable ones may
+    #  be started at any row.
+    if 'delta' in Frame.extended_formats and not reversible and not row_seekable:
+        # Delta frames can't be decoded from an arbitrary row, or from the
+        #  frame after them.
+        encode_deltas(frames, Animation.keyframe_interval)
+    if 'tiles' in Frame.extended_formats:
+        encode_tiles(frames)
+
+def decode_frames(frames : list[Frame]) -> list[np.ndarray]:
+    # Reference decoder for a whole animation, in playback order.
+    decoded = []
+    previous = None
+    dictionary = None
+    for frame in frames:
+        previous = frame.decode(previous, dictionary)
+        if dictionary is None and frame.compression_type_number == FrameEncoding.TILE8:
+            dictionary, _ = encoding.split_tile_dictionary(frame.bytes)
+        decoded.append(previous)
+    return decoded
+
+def shutdown_encoder_pool():
+    global encoder_pool
+    if encoder_pool is not None:
+        encoder_pool.shutdown()
+        encoder_pool = None
+
 class FrameData:
     link_table = dict() # OrderedDict not needed to remember order since Python 3.7
 
@@ -702,7 +1171,26 @@ class FrameData:
         return len(self.frame.bytes)
     
     def __repr__(self) -> str:
-        return f"FrameData({self.frame.width}x{self.frame.height}:{self.frame.compression_type_name})"
+        return f"FrameData({self.frame.width}x{self.frame.height}:{self.frame.compression_type_name}, cost {self.frame.render_cost()})"
+
+class FrameDataPadding:
+    # Erased bytes left between frame payloads to align the next one; see
+    #  layout.py.
+    def __init__(self, size : int):
+        self.padding = size
+
+    def set_addr(self, addr : int, namespace : int = structs.GQ_PTR_NS_CART):
+        self.addr = structs.gq_ptr_apply_ns(namespace, addr)
+        FrameData.link_table[self.addr] = self
+
+    def to_bytes(self):
+        return b'\xff' * self.padding
+
+    def size(self):
+        return self.padding
+
+    def __repr__(self) -> str:
+        return f"FrameDataPadding({self.padding})"
 
 class Menu:
     menu_table = dict()
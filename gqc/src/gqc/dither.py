@@ -0,0 +1,136 @@
+import numpy as np
+
+# Quantization of RGB frames to black and white, as ffmpeg's paletteuse filter
+#  does it with the black and white palette used by make_animation_from_video,
+#  for frames that are converted in-process:
+#
+#   none             each pixel becomes the nearer of black and white
+#   bayer            an 8x8 ordered dither (paletteuse's bayer_scale=2) is
+#                    added to each channel first
+#   heckbert,        the difference between each pixel and its color is
+#   floyd_steinberg, diffused into its unprocessed neighbors, in integer RGB
+#   sierra2,         with the same weights, truncation and clipping as
+#   sierra2_4a       paletteuse
+#
+# paletteuse compares colors in OkLab, where black and white differ only in
+#  lightness (L = 0 and L = 1), so the nearer of the two is white exactly when
+#  a color's L is over 0.5.
+#
+# paletteuse works out L in fixed point, though, and here it's done in floats,
+#  so the two disagree on a couple of hundred colors (of the 16.7M) whose L is
+#  within about 0.00003 of 0.5. Without error diffusion, only pixels of those
+#  exact colors come out differently. With it, a pixel that's come out
+#  differently diffuses a different error, and so can change the pixels after
+#  it too: on the gradients in tests/test_anim.py, floyd_steinberg and
+#  heckbert never reach one of those colors and match paletteuse exactly,
+#  while sierra2 and sierra2_4a do, and match only about 94% and 96% of pixels.
+#
+# All of the functions here work on a stack of frames at once: an (N, H, W, 3)
+#  array of uint8 RGB, giving an (N, H, W) array of uint8 0/1 pixels.
+
+DITHERS = ('none', 'bayer', 'heckbert', 'floyd_steinberg', 'sierra2', 'sierra2_4a')
+
+# Linear sRGB to LMS, and LMS (cube-rooted) to OkLab L
+OKLAB_LMS = np.array([
+    [0.4122214708, 0.5363325363, 0.0514459929],
+    [0.2119034982, 0.6806995451, 0.1073969566],
+    [0.0883024619, 0.2817188376, 0.6299787005],
+], dtype=np.float32)
+OKLAB_L = np.array([0.2104542553, 0.7936177850, -0.0040720468], dtype=np.float32)
+
+SRGB_TO_LINEAR = np.array([
+    value / 12.92 if value <= 0.04045 else ((value + 0.055) / 1.055) ** 2.4
+    for value in np.arange(256) / 255
+], dtype=np.float32)
+
+def oklab_lightness(rgb : np.ndarray) -> np.ndarray:
+    # OkLab L of each uint8 RGB color along the last axis.
+    lms = np.cbrt(SRGB_TO_LINEAR[rgb] @ OKLAB_LMS.T)
+    return lms @ OKLAB_L
+
+def nearest(rgb : np.ndarray) -> np.ndarray:
+    # 1 where white is the nearer color, 0 where black is.
+    return (oklab_lightness(rgb) > 0.5).astype(np.uint8)
+
+def bayer_matrix() -> np.ndarray:
+    # paletteuse's 8x8 ordered dither values, indexed by [y & 7, x & 7]: the
+    #  Bayer matrix, scaled down by bayer_scale=2 and centered on 0.
+    bayer_scale = 2
+    index = np.arange(64)
+    mixed = index ^ (index >> 3)
+    bayer = (index & 4) >> 2 | (mixed & 4) >> 1 | (index & 2) << 1 | (mixed & 2) << 2 | (index & 1) << 4 | (mixed & 1) << 5
+    return ((bayer >> bayer_scale) - (1 << (5 - bayer_scale))).reshape(8, 8)
+
+def ordered_dither(frames : np.ndarray) -> np.ndarray:
+    _, height, width, _ = frames.shape
+    offsets = np.tile(bayer_matrix(), ((height + 7) // 8, (width + 7) // 8))[:height, :width]
+    return nearest(np.clip(frames + offsets[np.newaxis, :, :, np.newaxis], 0, 255).astype(np.uint8))
+
+# Error diffusion kernels: (dy, dx, weight) for each neighbor the error is
+#  diffused to, and the shift the weighted error is divided by.
+DIFFUSION_KERNELS = dict(
+    heckbert=(((1, 0, 3), (1, 1, 2), (0, 1, 3)), 3),
+    floyd_steinberg=(((1, -1, 3), (1, 0, 5), (1, 1, 1), (0, 1, 7)), 4),
+    sierra2=(((1, -2, 1), (1, -1, 2), (1, 0, 3), (1, 1, 2), (1, 2, 1), (0, 1, 4), (0, 2, 3)), 4),
+    sierra2_4a=(((1, -1, 1), (1, 0, 1), (0, 1, 2)), 2),
+)
+
+def wavefronts(height : int, width : int, skew : int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Orders the frame's pixels by wavefront, the pixels where x + skew * y is
+    #  the same. Returns their ys and xs in that order, and the index where
+    #  each wavefront starts (and where the last ends).
+    ys, xs = np.mgrid[0:height, 0:width]
+    steps = (xs + skew * ys).ravel()
+    order = np.argsort(steps, kind='stable')
+    bounds = np.concatenate(([0], np.flatnonzero(np.diff(steps[order])) + 1, [steps.size]))
+    return ys.ravel()[order], xs.ravel()[order], bounds
+
+def error_diffusion(frames : np.ndarray, method : str) -> np.ndarray:
+    # paletteuse handles pixels one at a time in raster order. A pixel's value
+    #  when it's reached is its own plus each error diffused to it, in the
+    #  order they were added, clipped to 0-255 after every addition. Here each
+    #  wavefront is handled at once instead: with a skew of twice the kernel's
+    #  reach plus one, every pixel's errors come from earlier wavefronts, those
+    #  from the row above all arrive before those from its own row, and no two
+    #  errors from one wavefront land on the same pixel, so the result is
+    #  exactly the same.
+    count, height, width, _ = frames.shape
+    kernel, shift = DIFFUSION_KERNELS[method]
+    reach = max(abs(dx) for _, dx, _ in kernel)
+    weights = np.array([weight for _, _, weight in kernel], dtype=np.int32)[:, np.newaxis, np.newaxis]
+
+    # One row per pixel, of every frame's channels. Errors diffused past the
+    #  edges land in a margin that's never read.
+    stride = width + 2 * reach
+    pixels = np.zeros((height + 1, stride, count, 3), dtype=np.int32)
+    pixels[:height, reach:reach + width] = frames.transpose(1, 2, 0, 3)
+    pixels = pixels.reshape(-1, count * 3)
+    out = np.zeros((height * width, count), dtype=np.uint8)
+
+    ys, xs, bounds = wavefronts(height, width, 2 * reach + 1)
+    outputs = ys * width + xs
+    sources = ys * stride + xs + reach
+    targets = sources + np.array([dy * stride + dx for dy, dx, _ in kernel])[:, np.newaxis]
+
+    for start, end in zip(bounds, bounds[1:]):
+        colors = pixels[sources[start:end]]
+        white = nearest(colors.reshape(-1, count, 3).astype(np.uint8))
+        out[outputs[start:end]] = white
+        error = colors - 255 * np.repeat(white, 3, axis=1)
+
+        # Divide the weighted errors, truncating toward zero as C does.
+        weighted = error * weights
+        diffused = (weighted + ((weighted >> 31) & ((1 << shift) - 1))) >> shift
+        wave_targets = targets[:, start:end].ravel()
+        pixels[wave_targets] = np.minimum(np.maximum(pixels[wave_targets] + diffused.reshape(-1, count * 3), 0), 255)
+
+    return out.reshape(height, width, count).transpose(2, 0, 1)
+
+def dither(frames : np.ndarray, method : str = 'none') -> np.ndarray:
+    if method == 'none':
+        return nearest(frames)
+    elif method == 'bayer':
+        return ordered_dither(frames)
+    elif method in DIFFUSION_KERNELS:
+        return error_diffusion(frames, method)
+    raise ValueError(f"Dithering algorithm {method} is not supported")
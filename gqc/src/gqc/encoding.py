@@ -0,0 +1,313 @@
+import numpy as np
+from PIL import Image
+
+# Frame encoders. Every encoder operates on a 2D (height x width) uint8 array
+#  of 0/1 pixel values, which is produced exactly once per frame by
+#  unpack_pixels(), so no encoder has to go back to the PIL image.
+
+def unpack_pixels(image : Image.Image) -> np.ndarray:
+    # Mode '1' images come out of numpy as bool arrays; use 0/1 bytes instead.
+    return np.asarray(image.convert('1'), dtype=np.uint8)
+
+# Each encoding also has a *_size() function that works out the length of the
+#  encoded payload without building it, so that candidate encodings can be
+#  compared cheaply and only the winner is actually produced.
+
+# Render cost model, in rough units of the work to push one pixel to the
+#  display. The badge streams a frame's payload from flash through a buffer
+#  of IMAGE_BUFFER_SIZE bytes (see oled.c), so every payload byte costs a
+#  flash read and every refill of the buffer a flash transaction, and every
+#  run (or PackBits packet, or tile) costs a decode step on top of the
+#  per-pixel work.
+
+IMAGE_BUFFER_SIZE = 1024
+COST_PER_PIXEL = 1
+COST_PER_BYTE = 4
+COST_PER_BUFFER_LOAD = 64
+COST_PER_RUN = 6
+
+def render_cost(bytes_read : int, runs : int, pixel_count : int, passes : int = 1) -> int:
+    # passes is the number of times each pixel is touched: 2 for formats that
+    #  combine with the previous frame.
+    buffer_loads = -(-bytes_read // IMAGE_BUFFER_SIZE)
+    return passes * pixel_count * COST_PER_PIXEL + bytes_read * COST_PER_BYTE + buffer_loads * COST_PER_BUFFER_LOAD + runs * COST_PER_RUN
+
+def bounding_box(frames_pixels : list[np.ndarray]) -> tuple[int, int, int, int] | None:
+    # The smallest (x, y, width, height) containing every nonzero pixel of
+    #  every frame, or None if all of them are blank.
+    content = np.logical_or.reduce(np.stack(frames_pixels), axis=0)
+    rows = np.flatnonzero(content.any(axis=1))
+    columns = np.flatnonzero(content.any(axis=0))
+    if rows.size == 0:
+        return None
+    return int(columns[0]), int(rows[0]), int(columns[-1] - columns[0] + 1), int(rows[-1] - rows[0] + 1)
+
+def uncompressed_bytes(pixels : np.ndarray) -> bytes:
+    # One bit per pixel, MSB first, with every row padded out to a whole byte.
+    return np.packbits(pixels, axis=1).tobytes()
+
+def uncompressed_size(pixels : np.ndarray) -> int:
+    height, width = pixels.shape
+    return height * -(-width // 8)
+
+def runs(flat : np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Split a 1D array into runs of identical values, returning the value and
+    #  the length of each run.
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    lengths = np.diff(np.append(starts, flat.size))
+    return flat[starts].astype(np.int64), lengths
+
+def rle_runs(pixels : np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Runs of the row-major pixel stream.
+    return runs(pixels.ravel())
+
+def rle_size(lengths : np.ndarray, bits : int) -> int:
+    chunk = 1 << bits
+    return int(((lengths + chunk - 1) // chunk).sum())
+
+def rle_bytes(pixels : np.ndarray, bits : int, pixel_runs : tuple[np.ndarray, np.ndarray] = None) -> bytes:
+    # Each output byte holds (run length - 1) in its top `bits` bits and the
+    #  pixel value in its bottom bit. Runs longer than the largest encodable
+    #  length are split into maximum-length chunks followed by the remainder.
+    #  pixel_runs may be passed in if rle_runs(pixels) has already been computed.
+    if bits not in (4, 7):
+        raise ValueError(f"Unsupported RLE width {bits}")
+    shift = 8 - bits
+    chunk = 1 << bits
+
+    values, lengths = pixel_runs if pixel_runs is not None else rle_runs(pixels)
+    byte_counts = (lengths + chunk - 1) // chunk
+
+    out = np.repeat(((chunk - 1) << shift) | values, byte_counts)
+    last = np.cumsum(byte_counts) - 1
+    out[last] = ((lengths - chunk * (byte_counts - 1) - 1) << shift) | values
+
+    return out.astype(np.uint8).tobytes()
+
+# Row-indexed RLE7. Runs are split at the end of every row, and a table of
+#  each row's byte offset into the runs (uint16_t, little-endian) is appended
+#  after them, so a renderer clipping off the top of the frame can start
+#  decoding at its first visible row instead of the start of the payload.
+
+ROW_OFFSET_FORMAT = '<u2'
+ROW_OFFSET_SIZE = 2
+
+def row_runs(pixels : np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Like rle_runs(), but with a run boundary at the start of every row.
+    height, width = pixels.shape
+    flat = pixels.ravel()
+    boundaries = flat[1:] != flat[:-1]
+    boundaries[width - 1::width] = True
+    starts = np.concatenate(([0], np.flatnonzero(boundaries) + 1))
+    lengths = np.diff(np.append(starts, flat.size))
+    return flat[starts].astype(np.int64), lengths
+
+def row_indexed_size(pixels : np.ndarray, pixel_runs : tuple[np.ndarray, np.ndarray] = None) -> int:
+    _, lengths = pixel_runs if pixel_runs is not None else row_runs(pixels)
+    return rle_size(lengths, 7) + pixels.shape[0] * ROW_OFFSET_SIZE
+
+def row_indexed_bytes(pixels : np.ndarray) -> bytes | None:
+    # Returns None if the runs are too long for the offset table to address.
+    height, width = pixels.shape
+    values, lengths = row_runs(pixels)
+    runs_bytes = rle_bytes(pixels, 7, (values, lengths))
+    if len(runs_bytes) > 0xFFFF:
+        return None
+
+    # Runs never cross rows, so each row's first byte follows the bytes of
+    #  all the runs in the rows before it.
+    byte_counts = (lengths + 127) // 128
+    run_rows = (np.cumsum(lengths) - lengths) // width
+    row_bytes = np.bincount(run_rows, weights=byte_counts, minlength=height).astype(np.int64)
+    offsets = np.concatenate(([0], np.cumsum(row_bytes)[:-1]))
+
+    return runs_bytes + offsets.astype(ROW_OFFSET_FORMAT).tobytes()
+
+def column_rle_bytes(pixels : np.ndarray) -> bytes:
+    # RLE7 of the pixels in column-major order, which suits images made of
+    #  vertical features (bars, columns of text) better than scanning rows.
+    return rle_bytes(pixels.T, 7)
+
+# PackBits-style codec over the uncompressed bytes. A header byte h < 128 is
+#  followed by h + 1 literal bytes; h > 128 is followed by one byte to be
+#  repeated 257 - h times. Only runs of 3 or more identical bytes are worth a
+#  repeat packet; shorter ones are merged into the surrounding literals.
+
+PACKBITS_MAX_PACKET = 128
+PACKBITS_MIN_REPEAT = 3
+
+def packbits_runs(pixels : np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    values, lengths = runs(np.packbits(pixels, axis=1).ravel())
+    return values, lengths, lengths >= PACKBITS_MIN_REPEAT
+
+def packbits_measure(pixels : np.ndarray) -> tuple[int, int]:
+    # Returns the payload size and the number of packets.
+    _, lengths, repeat = packbits_runs(pixels)
+    repeat_packets = ((lengths[repeat] + PACKBITS_MAX_PACKET - 1) // PACKBITS_MAX_PACKET).sum()
+
+    # Consecutive literal runs form one literal stretch; each repeat run
+    #  starts a new one.
+    stretch = np.cumsum(repeat)[~repeat]
+    literals = np.bincount(stretch, weights=lengths[~repeat]).astype(np.int64)
+    literals = literals[literals > 0]
+    literal_packets = ((literals + PACKBITS_MAX_PACKET - 1) // PACKBITS_MAX_PACKET).sum()
+
+    return int(2 * repeat_packets + literals.sum() + literal_packets), int(repeat_packets + literal_packets)
+
+def packbits_size(pixels : np.ndarray) -> int:
+    return packbits_measure(pixels)[0]
+
+def packbits_packet_count(payload : bytes) -> int:
+    count = 0
+    index = 0
+    while index < len(payload):
+        header = payload[index]
+        index += header + 2 if header < 128 else 2 if header > 128 else 1
+        count += 1
+    return count
+
+def packbits_bytes(pixels : np.ndarray) -> bytes:
+    values, lengths, repeat = packbits_runs(pixels)
+    out = bytearray()
+    literal = bytearray()
+
+    def flush_literal():
+        for start in range(0, len(literal), PACKBITS_MAX_PACKET):
+            packet = literal[start:start + PACKBITS_MAX_PACKET]
+            out.append(len(packet) - 1)
+            out.extend(packet)
+        literal.clear()
+
+    for value, length, is_repeat in zip(values.tolist(), lengths.tolist(), repeat.tolist()):
+        if not is_repeat:
+            literal.extend(bytes([value]) * length)
+            continue
+        flush_literal()
+        while length:
+            # A 1-byte remainder comes out as header 0, a 1-byte literal, which
+            #  is the same size.
+            count = min(length, PACKBITS_MAX_PACKET)
+            out.extend(((257 - count) & 0xFF, value))
+            length -= count
+    flush_literal()
+
+    return bytes(out)
+
+def solid_value(pixel_runs : tuple[np.ndarray, np.ndarray]) -> int | None:
+    # The pixel value of a frame that's entirely one colour, else None. Such
+    #  frames need no payload at all.
+    values, _ = pixel_runs
+    return int(values[0]) if values.size == 1 else None
+
+def xor_delta_bytes(pixels : np.ndarray, previous : np.ndarray) -> bytes:
+    # Pixels that changed since the previous frame, as RLE7. Mostly-static
+    #  frames XOR down to long runs of zeros.
+    return rle_bytes(pixels ^ previous, 7)
+
+# Reference decoders. These mirror what the badge does with each format, so
+#  encodings can be round-tripped without hardware; they aren't used when
+#  building a cartridge.
+
+def decode_uncompressed(payload : bytes, width : int, height : int) -> np.ndarray:
+    rows = np.frombuffer(payload, dtype=np.uint8).reshape(height, -1)
+    return np.unpackbits(rows, axis=1)[:, :width]
+
+def decode_rle(payload : bytes, bits : int, width : int, height : int) -> np.ndarray:
+    shift = 8 - bits
+    data = np.frombuffer(payload, dtype=np.uint8)
+    flat = np.repeat(data & 0x01, (data >> shift).astype(np.int64) + 1)
+    if flat.size != width * height:
+        raise ValueError(f"RLE{bits} payload decodes to {flat.size} pixels; expected {width * height}")
+    return flat.reshape(height, width)
+
+def decode_row_indexed(payload : bytes, width : int, height : int, y_start : int = 0, y_end : int = None) -> np.ndarray:
+    # Decodes rows y_start up to (not including) y_end, using the offset table
+    #  to skip straight to the first of them, the way a clipped blit would.
+    if y_end is None:
+        y_end = height
+    table_start = len(payload) - height * ROW_OFFSET_SIZE
+    offsets = np.frombuffer(payload[table_start:], dtype=ROW_OFFSET_FORMAT).astype(np.int64)
+    runs_end = int(offsets[y_end]) if y_end < height else table_start
+    return decode_rle(payload[int(offsets[y_start]):runs_end], 7, width, y_end - y_start)
+
+def decode_column_rle(payload : bytes, width : int, height : int) -> np.ndarray:
+    return decode_rle(payload, 7, height, width).T
+
+def decode_packbits(payload : bytes, width : int, height : int) -> np.ndarray:
+    data = bytes(payload)
+    out = bytearray()
+    index = 0
+    while index < len(data):
+        header = data[index]
+        if header < 128:
+            out.extend(data[index + 1:index + header + 2])
+            index += header + 2
+        elif header > 128:
+            out.extend(data[index + 1:index + 2] * (257 - header))
+            index += 2
+        else:
+            index += 1
+    return decode_uncompressed(bytes(out), width, height)
+
+def decode_solid(value : int, width : int, height : int) -> np.ndarray:
+    return np.full((height, width), value, dtype=np.uint8)
+
+def decode_xor_delta(payload : bytes, previous : np.ndarray) -> np.ndarray:
+    height, width = previous.shape
+    return decode_rle(payload, 7, width, height) ^ previous
+
+# Tile dictionary encoding. Frames are cut into 8x8 tiles (zero-padded out to
+#  a multiple of 8 pixels in each direction), each tile being 8 bytes, one per
+#  row, MSB first. The distinct tiles of every frame in an animation form one
+#  shared dictionary, and each frame is stored as a row-major map of indices
+#  into it: one byte per tile for dictionaries of up to 256 tiles, otherwise
+#  two (little-endian). The dictionary itself is stored at the start of the
+#  animation's first frame, preceded by its tile count as a uint16_t.
+
+TILE_SIZE = 8
+TILE_DICTIONARY_MAX = 0xFFFF
+
+def frame_tiles(pixels : np.ndarray) -> np.ndarray:
+    # Returns the frame's tiles, row-major, as a (tile count x 8) array of bytes.
+    height, width = pixels.shape
+    tiles_y = -(-height // TILE_SIZE)
+    tiles_x = -(-width // TILE_SIZE)
+    padded = np.zeros((tiles_y * TILE_SIZE, tiles_x * TILE_SIZE), dtype=np.uint8)
+    padded[:height, :width] = pixels
+    rows = np.packbits(padded, axis=1)
+    return rows.reshape(tiles_y, TILE_SIZE, tiles_x).transpose(0, 2, 1).reshape(-1, TILE_SIZE)
+
+def tile_bytes(frames_pixels : list[np.ndarray]) -> list[bytes] | None:
+    # Encodes a whole animation, returning one payload per frame, or None if
+    #  its frames have too many distinct tiles for the format.
+    tiles = np.stack([frame_tiles(pixels) for pixels in frames_pixels])
+    frame_count, tiles_per_frame, _ = tiles.shape
+
+    # Viewing each tile's 8 bytes as one uint64 lets np.unique deduplicate them.
+    dictionary, indices = np.unique(tiles.reshape(-1, TILE_SIZE).view(np.uint64), return_inverse=True)
+    if dictionary.size > TILE_DICTIONARY_MAX:
+        return None
+    index_type = np.uint8 if dictionary.size <= 0x100 else np.dtype('<u2')
+    indices = indices.reshape(frame_count, tiles_per_frame).astype(index_type)
+
+    payloads = [index_map.tobytes() for index_map in indices]
+    header = np.array([dictionary.size], dtype='<u2').tobytes()
+    payloads[0] = header + dictionary.tobytes() + payloads[0]
+    return payloads
+
+def split_tile_dictionary(payload : bytes) -> tuple[np.ndarray, bytes]:
+    # Separates the first frame's payload into the dictionary and its index map.
+    tile_count = int(np.frombuffer(payload, dtype='<u2', count=1)[0])
+    dictionary_end = 2 + tile_count * TILE_SIZE
+    dictionary = np.frombuffer(payload[2:dictionary_end], dtype=np.uint8).reshape(tile_count, TILE_SIZE)
+    return dictionary, payload[dictionary_end:]
+
+def decode_tiles(index_map : bytes, dictionary : np.ndarray, width : int, height : int) -> np.ndarray:
+    tiles_y = -(-height // TILE_SIZE)
+    tiles_x = -(-width // TILE_SIZE)
+    index_type = np.uint8 if len(dictionary) <= 0x100 else np.dtype('<u2')
+    indices = np.frombuffer(index_map, dtype=index_type)
+    if indices.size != tiles_x * tiles_y:
+        raise ValueError(f"Tile map has {indices.size} tiles; expected {tiles_x * tiles_y}")
+    rows = dictionary[indices].reshape(tiles_y, tiles_x, TILE_SIZE).transpose(0, 2, 1).reshape(tiles_y * TILE_SIZE, tiles_x)
+    return np.unpackbits(rows, axis=1)[:height, :width]
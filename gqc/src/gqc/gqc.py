@@ -1,18 +1,62 @@
 import os
 import sys
+import json
 import pathlib
+import datetime
 from collections import namedtuple
 
 import click
+from tabulate import tabulate
 from rich.progress import Progress
 
 from . import parser
 from . import anim, cues
 from . import makefile_src
 from . import linker
-from .datamodel import Game
+from . import structs
+from .datamodel import Game, Animation, Frame, encode_frames, encode_extended_formats, collapse_held_frames, fold_pingpong, shutdown_encoder_pool
+from .symbols import SymbolIndex, parse_address
+from .patch import make_patch, read_patch, apply_patch, sector_count
+from .cache import write_frame_cache, asset_cache_entries, prune_asset_cache, ASSET_CACHE_DIR
 
 DITHER_CHOICES = ('none', 'bayer', 'heckbert', 'floyd_steinberg', 'sierra2', 'sierra2_4a')
+# Frame formats (and ping-pong folding) that the badge firmware can't display
+#  yet; see Frame.extended_formats.
+EXTENDED_FORMAT_CHOICES = ('delta', 'tiles', 'columns', 'packbits', 'solid', 'rows', 'pingpong')
+ENCODING_POLICY_CHOICES = ('size', 'speed', 'balanced')
+# Frame data layout rules; see layout.py.
+LAYOUT_CHOICES = ('page', 'sector', 'stage')
+# Version of layout.json, which records where each build placed each section;
+#  see linker.create_symbol_table.
+LAYOUT_FILE_VERSION = 2
+
+def configure_encoding(extended_formats : tuple[str], keyframe_interval : int, encoding_policy : str, speed_weight : float):
+    Frame.extended_formats = frozenset(extended_formats)
+    Frame.encoding_policy = encoding_policy
+    Frame.speed_weight = speed_weight
+    Animation.keyframe_interval = keyframe_interval
+    if extended_formats:
+        print(f"WARNING: Extended frame formats enabled ({', '.join(sorted(Frame.extended_formats))}); the badge firmware can't display them yet.", file=sys.stderr)
+
+def read_stable_layout(layout_path : pathlib.Path) -> dict[str, tuple[int, int]]:
+    # Where the last build placed each section (start and size), from its
+    #  layout.json, for a build with a stable layout to keep them there. Only a
+    #  build with a stable layout left its sections room to grow; after any
+    #  other, everything is laid out afresh.
+    if not layout_path.exists():
+        return dict()
+    with open(layout_path, 'r') as layout_file:
+        last_layout = json.load(layout_file)
+    if last_layout.get('version') != LAYOUT_FILE_VERSION:
+        print(f"WARNING: Ignoring {layout_path}, which is version {last_layout.get('version')} rather than {LAYOUT_FILE_VERSION}; the layout starts afresh.", file=sys.stderr)
+        return dict()
+    if not last_layout['stable_layout']:
+        return dict()
+    return {section: tuple(extent) for section, extent in last_layout['sections'].items()}
+
+def write_layout(layout_path : pathlib.Path, stable_layout : bool):
+    with open(layout_path, 'w') as layout_file:
+        json.dump(dict(version=LAYOUT_FILE_VERSION, stable_layout=stable_layout, sections=Game.game.sections), layout_file, indent=1)
 
 @click.group()
 def gqc_cli():
@@ -23,9 +67,36 @@ def gqc_cli():
 @click.option('--src-path', '-i', type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True, path_type=pathlib.Path), required=True)
 @click.option('--dither', '-d', type=click.Choice(DITHER_CHOICES), default=DITHER_CHOICES[0])
 @click.option('--frame-rate', '-f', type=int, default=24)
-def mkanim(out_path : pathlib.Path, src_path : pathlib.Path, dither : str, frame_rate : int):
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=os.cpu_count())
+@click.option('--gif-summary/--no-gif-summary', default=True)
+@click.option('--in-process', is_flag=True)
+@click.option('--extended-format', '-x', 'extended_formats', type=click.Choice(EXTENDED_FORMAT_CHOICES), multiple=True)
+@click.option('--keyframe-interval', type=click.IntRange(min=1), default=Animation.keyframe_interval)
+@click.option('--encoding-policy', '-e', type=click.Choice(ENCODING_POLICY_CHOICES), default=Frame.encoding_policy)
+@click.option('--speed-weight', type=click.FloatRange(0, 1), default=Frame.speed_weight)
+@click.option('--source-timing', is_flag=True)
+@click.option('--row-seekable', is_flag=True)
+@click.option('--start', type=click.IntRange(min=0), default=None)
+@click.option('--end', type=click.IntRange(min=1), default=None)
+@click.option('--max-frames', type=click.IntRange(min=1), default=None)
+def mkanim(out_path : pathlib.Path, src_path : pathlib.Path, dither : str, frame_rate : int, jobs : int, gif_summary : bool, in_process : bool, extended_formats : tuple[str], keyframe_interval : int, encoding_policy : str, speed_weight : float, source_timing : bool, row_seekable : bool, start : int, end : int, max_frames : int):
+    configure_encoding(extended_formats, keyframe_interval, encoding_policy, speed_weight)
     with Progress() as progress:
-        anim.make_animation(progress, src_path, out_path, dither, frame_rate)
+        frames = anim.make_animation(progress, src_path, out_path, dither, frame_rate, write_gif=gif_summary, source_timing=source_timing, start=start, end=end, max_frames=max_frames, in_process=in_process)
+
+        # Encode the frames too, leaving a frame cache next to the bitmaps.
+        encode_task = progress.add_task(" [dim]-> gqimage", total=None)
+        encoded_frames = encode_frames(frames, jobs, progress, encode_task, row_seekable=row_seekable)
+        flags = structs.AnimFlags.NONE
+        if source_timing and not anim.is_still_image(src_path):
+            encoded_frames = collapse_held_frames(encoded_frames, anim.frame_durations(out_path))
+            flags |= structs.AnimFlags.FRAME_DURATIONS
+        if 'pingpong' in Frame.extended_formats and (forward_frames := fold_pingpong(encoded_frames)):
+            encoded_frames = forward_frames
+            flags |= structs.AnimFlags.PINGPONG
+        encode_extended_formats(encoded_frames, reversible=bool(flags & structs.AnimFlags.PINGPONG), row_seekable=row_seekable)
+        write_frame_cache(out_path / 'frames.gqcache', [frame.cache_entry() for frame in encoded_frames], flags=flags)
+    shutdown_encoder_pool()
 
 @gqc_cli.command()
 @click.option('--out-path', '-o', type=click.Path(file_okay=False, dir_okay=True, writable=True, path_type=pathlib.Path), required=True)
@@ -37,9 +108,22 @@ def mkcue(out_path : pathlib.Path, src_path : pathlib.Path):
 @gqc_cli.command()
 @click.option('--no-mem-map', '-n', is_flag=True)
 @click.option('--out-dir', '-o', type=click.Path(file_okay=False, dir_okay=True, writable=True, path_type=pathlib.Path), default=None)
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=os.cpu_count())
+@click.option('--gif-summary', is_flag=True)
+@click.option('--in-process', is_flag=True)
+@click.option('--extended-format', '-x', 'extended_formats', type=click.Choice(EXTENDED_FORMAT_CHOICES), multiple=True)
+@click.option('--keyframe-interval', type=click.IntRange(min=1), default=Animation.keyframe_interval)
+@click.option('--encoding-policy', '-e', type=click.Choice(ENCODING_POLICY_CHOICES), default=Frame.encoding_policy)
+@click.option('--speed-weight', type=click.FloatRange(0, 1), default=Frame.speed_weight)
+@click.option('--layout', '-l', 'layout_rules', type=click.Choice(LAYOUT_CHOICES), multiple=True)
+@click.option('--stable-layout', is_flag=True)
 @click.argument('input', type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True, path_type=pathlib.Path), required=True)
-def compile(input : pathlib.Path, no_mem_map : bool, out_dir : pathlib.Path):
+def compile(input : pathlib.Path, no_mem_map : bool, out_dir : pathlib.Path, jobs : int, gif_summary : bool, in_process : bool, extended_formats : tuple[str], keyframe_interval : int, encoding_policy : str, speed_weight : float, layout_rules : tuple[str], stable_layout : bool):
     Game.game_name = input.stem
+    Animation.jobs = jobs
+    Animation.gif_summary = gif_summary
+    Animation.in_process = in_process
+    configure_encoding(extended_formats, keyframe_interval, encoding_policy, speed_weight)
 
     # output_path is the directory where the output of the project will be placed
     if out_dir is None:
@@ -52,6 +136,8 @@ def compile(input : pathlib.Path, no_mem_map : bool, out_dir : pathlib.Path):
     #  │   ├── animations/
     #  │   └── lighting/
     #  ├── map.txt
+    #  ├── layout.json
+    #  ├── symbols.gqsym
     #  └── <game_name>.gqgame
 
     # Load all our builtin variables
@@ -61,6 +147,9 @@ def compile(input : pathlib.Path, no_mem_map : bool, out_dir : pathlib.Path):
     with open(input, 'r') as f:
         parsed = parser.parse(f)
 
+    # Wait for the animations declared in the game to finish converting
+    linker.load_assets()
+
     # Place symbols into the symbol table
     mem_map_path = out_dir / 'map.txt'
     cmd_asm_path = out_dir / 'cmds.gqasm'
@@ -68,14 +157,110 @@ def compile(input : pathlib.Path, no_mem_map : bool, out_dir : pathlib.Path):
         mem_map_path = os.devnull
         cmd_asm_path = os.devnull
 
+    # With --stable-layout, each section stays where it was in the last build
+    #  wherever it can, so a small change to the game makes a small patch (see gqc patch).
+    layout_path = out_dir / 'layout.json'
+    stable_sections = read_stable_layout(layout_path) if stable_layout else None
+
     with open(mem_map_path, 'w') as map_file, open(cmd_asm_path, 'w') as cmd_asm_file:
-        symbol_table = linker.create_symbol_table(table_dest=map_file, cmd_dest=cmd_asm_file)
+        symbol_table = linker.create_symbol_table(table_dest=map_file, cmd_dest=cmd_asm_file, layout_rules=tuple(dict.fromkeys(layout_rules)), stable_sections=stable_sections)
+
+    write_layout(layout_path, stable_layout)
+    SymbolIndex.from_symbol_table(symbol_table).write(out_dir / 'symbols.gqsym')
 
     # Code generation
     output_code = linker.generate_code(parsed, symbol_table)
     with open(out_dir / f'{Game.game_name}.gqgame', 'wb') as out_file:
         out_file.write(output_code)
 
+def parse_size(size : str) -> int:
+    # Sizes may be given in bytes or with a K, M or G (binary) suffix.
+    units = dict(K=1 << 10, M=1 << 20, G=1 << 30)
+    size = size.strip().upper().removesuffix('B')
+    try:
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except ValueError:
+        raise click.BadParameter(f"Invalid size {size}")
+
+@gqc_cli.command()
+@click.option('--prune', '-p', type=str, default=None)
+def cache(prune : str):
+    # Run from the workspace root, like compile.
+    if prune is not None:
+        removed = prune_asset_cache(parse_size(prune))
+        click.echo(f"Pruned {len(removed)} entries ({sum(entry.size for entry in removed)} bytes).")
+
+    entries = asset_cache_entries()
+    click.echo(f"Asset cache: {ASSET_CACHE_DIR}")
+    click.echo(f"  {len(entries)} entries, {sum(entry.size for entry in entries)} bytes")
+    if entries:
+        click.echo(f"  least recently used: {datetime.datetime.fromtimestamp(entries[0].last_used):%Y-%m-%d %H:%M:%S}")
+        click.echo(f"  most recently used:  {datetime.datetime.fromtimestamp(entries[-1].last_used):%Y-%m-%d %H:%M:%S}")
+
+@gqc_cli.command()
+@click.argument('symbols', type=click.Path(exists=True, file_okay=True, dir_okay=True, readable=True, path_type=pathlib.Path))
+@click.argument('queries', nargs=-1)
+@click.option('--sections', '-s', 'show_sections', is_flag=True)
+def addr2sym(symbols : pathlib.Path, queries : tuple[str], show_sections : bool):
+    # SYMBOLS is a game's build directory or its symbols.gqsym. Each query is
+    #  an address, resolved to the symbol there, or a symbol name, resolved
+    #  to its address.
+    if symbols.is_dir():
+        symbols = symbols / 'symbols.gqsym'
+    try:
+        index = SymbolIndex.read(symbols)
+    except (OSError, ValueError) as e:
+        raise click.ClickException(str(e))
+
+    if show_sections:
+        click.echo(tabulate([(section.name, f"{section.start:#010x}", f"{section.end:#010x}", section.size, section.count) for section in index.sections], headers=['Section', 'Start', 'End', 'Size', 'Symbols'], disable_numparse=True))
+
+    for query in queries:
+        try:
+            addr = parse_address(query)
+        except ValueError:
+            matches = index.lookup(query)
+            if not matches:
+                click.echo(f"{query}: no such symbol")
+            for symbol in matches:
+                click.echo(f"{query}: {symbol.addr:#010x} {symbol.section} ({symbol.size} bytes)")
+            continue
+
+        symbol = index.at(addr)
+        if symbol is None:
+            section = index.section(addr)
+            click.echo(f"{addr:#010x}: no symbol" + (f", in the padding of {section.name}" if section else ''))
+        else:
+            click.echo(f"{addr:#010x}: {symbol.name}+{addr - symbol.addr:#x} {symbol.section} ({symbol.size} bytes at {symbol.addr:#010x})")
+
+@gqc_cli.command()
+@click.argument('old', type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True, path_type=pathlib.Path))
+@click.argument('new', type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True, path_type=pathlib.Path))
+@click.option('--out-path', '-o', type=click.Path(file_okay=True, dir_okay=False, writable=True, path_type=pathlib.Path), default=None)
+def patch(old : pathlib.Path, new : pathlib.Path, out_path : pathlib.Path):
+    # Writes the sectors that differ between two cart images; see patch.py.
+    if out_path is None:
+        out_path = new.with_suffix('.gqpatch')
+    new_image = new.read_bytes()
+    sector_patch = make_patch(old.read_bytes(), new_image)
+    out_path.write_bytes(sector_patch)
+    changed = read_patch(sector_patch)[0].sector_count
+    click.echo(f"{changed} of {sector_count(len(new_image))} sectors changed; {out_path} is {len(sector_patch)} bytes.")
+
+@gqc_cli.command()
+@click.argument('image', type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True, path_type=pathlib.Path))
+@click.argument('patch', type=click.Path(exists=True, file_okay=True, dir_okay=False, readable=True, path_type=pathlib.Path))
+@click.option('--out-path', '-o', type=click.Path(file_okay=True, dir_okay=False, writable=True, path_type=pathlib.Path), default=None)
+def apply(image : pathlib.Path, patch : pathlib.Path, out_path : pathlib.Path):
+    # Patches the image in place unless told otherwise.
+    try:
+        patched = apply_patch(image.read_bytes(), patch.read_bytes())
+    except ValueError as ve:
+        raise click.ClickException(str(ve))
+    (out_path or image).write_bytes(patched)
+
 @gqc_cli.command()
 @click.argument('base_dir', type=click.Path(file_okay=False, dir_okay=True, writable=True, path_type=pathlib.Path))
 @click.option('--force', '-f', is_flag=True)
@@ -0,0 +1,201 @@
+import hashlib
+from collections import namedtuple
+
+import numpy as np
+
+from .datamodel import Stage, Animation
+from .commands import CommandPlay, CommandIf, CommandLoop
+
+# Layout of the frame data section. Frame payloads are read straight out of
+#  the cart's NOR flash, which is read a 256-byte page at a time and erased a
+#  4 KB sector at a time. By default payloads are packed back to back in the
+#  order their animations are declared, which makes the smallest cart; but a
+#  payload that straddles a page boundary costs an extra page read every time
+#  it's drawn, and every animation shares sectors with its neighbors, so
+#  changing one means rewriting theirs too. Layout rules trade padding for
+#  fewer of each:
+#
+#   page    a payload that would touch more pages than its size needs starts
+#           on the next page instead (so the padding is always smaller than
+#           the payload)
+#   sector  each animation's payloads start on a new sector
+#   stage   animations are placed in the order the stages use them, so each
+#           stage's frame data is together
+#
+# Padding is left erased (0xFF). Payloads are deduplicated across the whole
+#  cart either way: frames whose encoded bytes are identical all point at the
+#  first copy placed.
+
+FLASH_PAGE_SIZE = 0x100
+FLASH_SECTOR_SIZE = 0x1000
+
+# order(animations) returns the animations in the order their payloads are
+#  placed. align(addr, size, first) returns where a payload of size bytes
+#  should start, at or after addr; first is whether it's the first payload
+#  placed for its animation.
+LayoutRule = namedtuple('LayoutRule', ['name', 'order', 'align'])
+
+# placements is a list of (addr, size, frame) in address order, where frame is
+#  the frame whose payload goes there, or None for padding. shared is a list of
+#  (frame, frame whose payload it shares).
+FrameDataLayout = namedtuple('FrameDataLayout', ['rules', 'placements', 'shared', 'end', 'padding', 'page_reads', 'extra_page_reads', 'sectors'])
+
+def pages_touched(addr : int, size : int) -> int:
+    if size == 0:
+        return 0
+    return (addr + size - 1) // FLASH_PAGE_SIZE - addr // FLASH_PAGE_SIZE + 1
+
+def sectors_touched(addr : int, size : int) -> range:
+    if size == 0:
+        return range(0)
+    return range(addr // FLASH_SECTOR_SIZE, (addr + size - 1) // FLASH_SECTOR_SIZE + 1)
+
+def align_up(addr : int, alignment : int) -> int:
+    return -(-addr // alignment) * alignment
+
+def page_align(addr : int, size : int, first : bool) -> int:
+    if pages_touched(addr, size) > -(-size // FLASH_PAGE_SIZE):
+        return align_up(addr, FLASH_PAGE_SIZE)
+    return addr
+
+def sector_align(addr : int, size : int, first : bool) -> int:
+    return align_up(addr, FLASH_SECTOR_SIZE) if first else addr
+
+def command_animations(commands : list) -> list[str]:
+    # Names of the animations played by commands, including those nested in
+    #  if and loop blocks, in order.
+    names = []
+    for cmd in commands:
+        if isinstance(cmd, CommandPlay):
+            names.append(cmd.anim_name)
+        elif isinstance(cmd, CommandIf):
+            names += command_animations(cmd.true_cmds)
+            names += command_animations(cmd.false_cmds or [])
+        elif isinstance(cmd, CommandLoop):
+            names += command_animations(cmd.commands)
+    return names
+
+def stage_order(animations : list[Animation]) -> list[Animation]:
+    # Animations in the order of the first stage that uses each of them (as
+    #  its background or through a play command); animations no stage uses
+    #  go last. Within a stage, and among the unused ones, declaration order
+    #  is kept.
+    first_use = dict()
+    for stage_index, stage in enumerate(Stage.stage_table.values()):
+        names = [stage.bganim_name] if stage.bganim_name else []
+        for event in stage.events.values():
+            names += command_animations(event.event_statements)
+        for name in names:
+            first_use.setdefault(name, stage_index)
+    return sorted(animations, key=lambda anim: first_use.get(anim.name, len(Stage.stage_table)))
+
+LAYOUT_RULES = dict(
+    page=LayoutRule('page', None, page_align),
+    sector=LayoutRule('sector', None, sector_align),
+    stage=LayoutRule('stage', stage_order, None),
+)
+
+def frame_digests(animations : list[Animation]) -> dict[int, bytes]:
+    # Content hashes of every frame's payload, by id(frame), for deduplication.
+    return {id(frame): hashlib.sha256(frame.bytes).digest() for anim in animations for frame in anim.frames}
+
+def plan_frame_data(start : int, rule_names : tuple[str] = (), digests : dict[int, bytes] = None, exclude : set[int] = frozenset()) -> FrameDataLayout:
+    # Works out where each frame payload goes, starting at start, without
+    #  placing anything, so that layouts can be compared. Payloads of the
+    #  frames in exclude (by id) are left out, to be placed somewhere else;
+    #  frames that share them still do, and aren't counted in the stats.
+    rules = [LAYOUT_RULES[name] for name in rule_names]
+    animations = list(Animation.anim_table.values())
+    if digests is None:
+        digests = frame_digests(animations)
+    for rule in rules:
+        if rule.order:
+            animations = rule.order(animations)
+
+    placements = []
+    shared = []
+    placed = dict() # digest -> (frame, addr)
+    addr = start
+    padding = 0
+    page_reads = 0
+    extra_page_reads = 0
+    sectors = 0
+
+    for anim in animations:
+        first = True
+        anim_sectors = set()
+        for frame in anim.frames:
+            size = len(frame.bytes)
+            digest = digests[id(frame)]
+            if digest in placed:
+                original, frame_addr = placed[digest]
+                shared.append((frame, original))
+            elif id(frame) in exclude:
+                placed[digest] = (frame, None)
+                frame_addr = None
+            else:
+                frame_addr = addr
+                for rule in rules:
+                    if rule.align:
+                        frame_addr = rule.align(frame_addr, size, first)
+                if frame_addr != addr:
+                    placements.append((addr, frame_addr - addr, None))
+                    padding += frame_addr - addr
+                placements.append((frame_addr, size, frame))
+                placed[digest] = (frame, frame_addr)
+                addr = frame_addr + size
+                first = False
+
+            if frame_addr is None:
+                continue
+            # Every frame is a read of its payload each time it's drawn.
+            page_reads += pages_touched(frame_addr, size)
+            extra_page_reads += pages_touched(frame_addr, size) - -(-size // FLASH_PAGE_SIZE)
+            anim_sectors.update(sectors_touched(frame_addr, size))
+        sectors += len(anim_sectors)
+
+    return FrameDataLayout(rule_names, placements, shared, addr, padding, page_reads, extra_page_reads, sectors)
+
+def compare_layouts(start : int, rule_names : tuple[str]) -> list[FrameDataLayout]:
+    # The packed layout, each rule on its own, and the chosen rules together,
+    #  for the linker's report. The chosen layout is always last.
+    digests = frame_digests(Animation.anim_table.values())
+    candidates = [()] + [(name,) for name in LAYOUT_RULES]
+    candidates = [candidate for candidate in candidates if candidate != tuple(rule_names)] + [tuple(rule_names)]
+    return [plan_frame_data(start, candidate, digests) for candidate in candidates]
+
+def fill_gap(sizes : list[int], overhang : int) -> list[int]:
+    # The persistent section has to start on a sector boundary, so everything
+    #  before it that runs past a boundary (the overhang) costs the rest of
+    #  that sector in padding. Moving items that add up to at least the
+    #  overhang past the persistent section closes that gap, leaving only
+    #  what they overshoot by. Returns the indices of the items whose sizes
+    #  add up to the smallest such total under a sector, or [] if there are
+    #  none; a subset sum over every total up to a sector, so it's cheap even
+    #  for thousands of items.
+    reachable = np.zeros(FLASH_SECTOR_SIZE, dtype=bool)
+    reachable[0] = True
+    reached_by = np.full(FLASH_SECTOR_SIZE, -1) # The item that first made each total reachable
+    for index, size in enumerate(sizes):
+        if size == 0 or size >= FLASH_SECTOR_SIZE:
+            continue
+        newly = np.zeros(FLASH_SECTOR_SIZE, dtype=bool)
+        newly[size:] = reachable[:-size] & ~reachable[size:]
+        reached_by[newly] = index
+        reachable |= newly
+        if reachable[overhang]:
+            break
+
+    totals = np.flatnonzero(reachable[overhang:])
+    if overhang == 0 or totals.size == 0:
+        return []
+
+    # Each total was first reached from one that was reachable before its
+    #  item, so walking back gives distinct items.
+    chosen = []
+    total = overhang + totals[0]
+    while total:
+        index = int(reached_by[total])
+        chosen.append(index)
+        total -= sizes[index]
+    return chosen[::-1]
@@ -1,13 +1,15 @@
 import sys
+from collections import Counter
 
 from tabulate import tabulate
 from rich.progress import Progress, TextColumn, BarColumn, TaskProgressColumn, TimeElapsedColumn
 
-from .datamodel import Game, Stage, Variable, Animation, Frame, FrameData, Event, Menu
-from .datamodel import LightCue, LightCueFrame
+from .datamodel import Game, Stage, Variable, Animation, Frame, FrameData, FrameDataPadding, Event, Menu
+from .datamodel import LightCue, LightCueFrame, shutdown_encoder_pool
 from .commands import Command, CommandDone
 
 from . import structs
+from . import layout
 
 def create_reserved_variables():
     # Create the reserved special-purpose variables for the game:
@@ -30,7 +32,18 @@ def create_reserved_variables():
     for reg_name in structs.GQ_REGISTERS_STR:
         var = Variable('str', reg_name, '', 'volatile')
 
-def create_symbol_table(table_dest = sys.stdout, cmd_dest = sys.stdout):
+def load_assets():
+    # Animations are converted and encoded in the background from the moment
+    #  they're declared; everything has to be loaded before it can be placed.
+    try:
+        Animation.wait_for_loads()
+    except ValueError as ve:
+        print(f"FATAL: {ve}", file=sys.stderr)
+        exit(1)
+    finally:
+        shutdown_encoder_pool()
+
+def create_symbol_table(table_dest = sys.stdout, cmd_dest = sys.stdout, layout_rules : tuple[str] = (), stable_sections : dict[str, tuple[int, int]] = None):
     # Output order:
     # header (fixed size)
     # animations (fixed size by count)
@@ -43,78 +56,163 @@ def create_symbol_table(table_dest = sys.stdout, cmd_dest = sys.stdout):
     # events code (variable size)
 
     frame_count = sum([len(anim.frames) for anim in Animation.anim_table.values()])
+    frame_records_size = sum([record.size() for anim in Animation.anim_table.values() for record in anim.frame_table_records()])
 
     heap_ptr_start = 0
     heap_ptr_offset = 0
 
+    # With a stable layout (stable_sections, the last build's Game.sections), each section
+    #  stays where it was as long as it still fits in the space it had there, up to where the
+    #  next section started, so a small change to the game makes a small patch (see gqc patch).
+    #  Sections that have outgrown their space, and new ones, go after everything else instead,
+    #  each starting on a 4 KB boundary, leaving it the rest of its last sector to grow into.
+    section_starts = dict()
+    moved_sections = []
+    if stable_sections is not None:
+        pinned = sorted((start, size, section) for section, (start, size) in stable_sections.items())
+        spill_ptr = max([start + size for start, size, _ in pinned], default=structs.GQ_HEADER_SIZE)
+        spill_ptr += -spill_ptr % 0x1000
+        pinned_ends = [next_start for next_start, _, _ in pinned[1:]] + [spill_ptr]
+        pinned_space = {section: end - start for (start, _, section), end in zip(pinned, pinned_ends)}
+
+    def place_section(section : str, natural_start : int, size_at) -> int:
+        # size_at gives the size the section would be, starting at a given address.
+        nonlocal spill_ptr
+        start = natural_start
+        if stable_sections is not None:
+            if section in stable_sections and size_at(stable_sections[section][0]) <= pinned_space[section]:
+                start = stable_sections[section][0]
+            else:
+                start = spill_ptr
+                moved_sections.append(section)
+                spill_ptr += size_at(start)
+                spill_ptr += -spill_ptr % 0x1000
+        section_starts[section] = start
+        return start
+
+    anim_table_size = len(Animation.anim_table) * structs.GQ_ANIM_SIZE
+    stage_table_size = len(Stage.stage_table) * structs.GQ_STAGE_SIZE
+    frame_table_size = frame_count * structs.GQ_ANIM_FRAME_SIZE + frame_records_size
+
     cart_ptr_start = 0
     header_ptr_start = cart_ptr_start
-    anim_ptr_start = header_ptr_start + structs.GQ_HEADER_SIZE
-    stage_ptr_start = anim_ptr_start + len(Animation.anim_table) * structs.GQ_ANIM_SIZE
-    frames_ptr_start = stage_ptr_start + len(Stage.stage_table) * structs.GQ_STAGE_SIZE
-    frame_data_ptr_start = frames_ptr_start + frame_count * structs.GQ_ANIM_FRAME_SIZE
-
+    anim_ptr_start = place_section('.anim', header_ptr_start + structs.GQ_HEADER_SIZE, lambda start: anim_table_size)
+    stage_ptr_start = place_section('.stage', anim_ptr_start + anim_table_size, lambda start: stage_table_size)
+    frames_ptr_start = place_section('.frame', stage_ptr_start + stage_table_size, lambda start: frame_table_size)
+    frame_data_ptr_start = place_section('.framedata', frames_ptr_start + frame_table_size, lambda start: layout.plan_frame_data(start, layout_rules).end - start)
     # The starting locations of the variable tables need to be calculated based
     #  on the size of the frame data table, so we'll do that a little later.
 
     # Start with the game metadata header.
     Game.game.set_addr(header_ptr_start)
 
-    # Start with placing the frame data into the frame data table, their corresponding
-    #  frames into the frames table (setting the frame's data_pointer), and then the
-    #  animations into the animation table, setting their frame pointer.
+    # Start with placing the frame data into the frame data table, where the
+    #  layout rules put it, then their corresponding frames into the frames
+    #  table (which point to it), and then the animations into the animation
+    #  table, setting their frame pointer.
+
+    # Frame data is deduplicated across the whole cart: frames whose encoded bytes
+    #  are identical (blank frames, held frames, sprites shared between animations)
+    #  all point at a single copy. Every layout is worked out, to report what
+    #  the rules not used would cost; the chosen one is last.
+    layouts = layout.compare_layouts(frame_data_ptr_start, layout_rules)
+    frame_data_layout = layouts[-1]
+
+    # Allocation of volatile variables to the heap is required for event code
+    #  to resolve correctly, so do that now. We'll have another pass later to
+    #  generate their initialization code.
+    for var in list(Variable.storageclass_table['volatile'].values()):
+        # Heap memory allocation
+        var.set_addr(heap_ptr_start + heap_ptr_offset, namespace=structs.GQ_PTR_NS_HEAP)
+        heap_ptr_offset += var.size()
+
+    # Generate the volatile variables' initialization code, to be placed after the events.
+    init_cmds = [var.get_init_command() for var in list(Variable.storageclass_table['volatile'].values())]
+    # Terminate the init code with a DONE
+    init_cmds.append(CommandDone())
+
+    # Now, because of hardware limitations of the flash chips we're using, we can only erase 4 KB sectors at
+    #  a time, so the persistent variables have to start on a 4 KB boundary after the initialization code.
+    #  Rather than pad up to it, read-only items that don't have to be anywhere in particular (menus,
+    #  lighting cues' frames and, when they're packed, frame payloads) that add up to whatever runs past the
+    #  last boundary are moved past the persistent section instead; everything else closes up behind them.
+    events = [stage.events[event_type] for stage in Stage.stage_table.values() for event_type in structs.EventType if event_type in stage.events]
+    unpacked_code_end = frame_data_layout.end \
+        + len(LightCue.cue_table) * structs.GQ_LEDCUE_SIZE \
+        + sum(frame.size() for cue in LightCue.cue_table.values() for frame in cue.frames) \
+        + sum(menu.size() for menu in Menu.menu_table.values()) \
+        + sum(event.size() for event in events) \
+        + sum(cmd.size() for cmd in init_cmds)
+    relocatable = [('menu', menu, menu.size()) for menu in Menu.menu_table.values()]
+    relocatable += [('cue', cue, sum(frame.size() for frame in cue.frames)) for cue in LightCue.cue_table.values()]
+    if not layout_rules:
+        relocatable += [('frame', frame, size) for _, size, frame in frame_data_layout.placements if frame is not None]
+    # With a stable layout, nothing is moved: each section has the rest of its last sector to
+    #  grow into instead (see place_section).
+    relocated = []
+    if stable_sections is None:
+        relocated = [relocatable[index] for index in layout.fill_gap([size for _, _, size in relocatable], unpacked_code_end % 0x1000)]
+    relocated_objs = set(id(obj) for _, obj, _ in relocated)
+    if any(kind == 'frame' for kind, _, _ in relocated):
+        frame_data_layout = layout.plan_frame_data(frame_data_ptr_start, layout_rules, exclude=relocated_objs)
+
+    for addr, size, frame in frame_data_layout.placements:
+        if frame is None:
+            FrameDataPadding(size).set_addr(addr)
+        else:
+            frame.frame_data.set_addr(addr)
+    for frame, original in frame_data_layout.shared:
+        frame.frame_data = original.frame_data
+    frame_data_dupes = len(frame_data_layout.shared)
+    frame_data_saved = sum(len(frame.bytes) for frame, _ in frame_data_layout.shared)
+    frame_data_ptr_offset = frame_data_layout.end - frame_data_ptr_start
 
     anim_ptr_offset = 0
     frames_ptr_offset = 0
-    frame_data_ptr_offset = 0
     for anim in Animation.anim_table.values():
         for frame in anim.frames:
-            # Place the frame's data bytes into the frame_data table, set the enclosing frame's
-            #  reference to it, and increment the frame data offset.
-            frame.frame_data.set_addr(frame_data_ptr_start + frame_data_ptr_offset)
-            frame_data_ptr_offset += len(frame.bytes)
-
-            # Then place the frame itself into the frame table, updating the pointer offsets.
+            # Place the frame itself into the frame table, updating the pointer offsets.
             frame.set_addr(frames_ptr_start + frames_ptr_offset)
             frames_ptr_offset += structs.GQ_ANIM_FRAME_SIZE
-        
+
+        # Then any records its flags call for (frame durations, crop offset).
+        for record in anim.frame_table_records():
+            record.set_addr(frames_ptr_start + frames_ptr_offset)
+            frames_ptr_offset += record.size()
+
         # Point the animation to its first frame in the frame table
         anim.set_frame_pointer(structs.gq_ptr_get_addr(anim.frames[0].addr, expected_namespace=structs.GQ_PTR_NS_CART))
         # Place the animation into the animation table, updating the pointer offsets.
         anim.set_addr(anim_ptr_start + anim_ptr_offset)
         anim_ptr_offset += structs.GQ_ANIM_SIZE
-    
+
     # The lighting cues and their frames are placed next.
-    cues_ptr_start = frame_data_ptr_start + frame_data_ptr_offset
+    cues_ptr_start = place_section('.cues', frame_data_ptr_start + frame_data_ptr_offset, lambda start: len(LightCue.cue_table) * structs.GQ_LEDCUE_SIZE)
     cues_ptr_offset = 0
-    cuedata_ptr_start = cues_ptr_start + len(LightCue.cue_table) * structs.GQ_LEDCUE_SIZE
+    cuedata_ptr_start = place_section('.cuedata', cues_ptr_start + len(LightCue.cue_table) * structs.GQ_LEDCUE_SIZE, lambda start: sum(frame.size() for cue in LightCue.cue_table.values() if id(cue) not in relocated_objs for frame in cue.frames))
     cuedata_ptr_offset = 0
     for cue in LightCue.cue_table.values():
         cue.set_addr(cues_ptr_start + cues_ptr_offset)
         cues_ptr_offset += cue.size()
 
+        if id(cue) in relocated_objs:
+            continue
         for frame in cue.frames:
             frame.set_addr(cuedata_ptr_start + cuedata_ptr_offset)
             cuedata_ptr_offset += frame.size()
 
-    menus_ptr_start = cuedata_ptr_start + cuedata_ptr_offset
+    menus_ptr_start = place_section('.menu', cuedata_ptr_start + cuedata_ptr_offset, lambda start: sum(menu.size() for menu in Menu.menu_table.values() if id(menu) not in relocated_objs))
     menus_ptr_offset = 0
 
     for menu in Menu.menu_table.values():
+        if id(menu) in relocated_objs:
+            continue
         menu.set_addr(menus_ptr_start + menus_ptr_offset)
         menus_ptr_offset += menu.size()
 
-    # Allocation of volatile variables to the heap is required for event code
-    #  to resolve correctly, so do that now. We'll have another pass later to
-    #  generate their initialization code.
-    for var in list(Variable.storageclass_table['volatile'].values()):
-        # Heap memory allocation
-        var.set_addr(heap_ptr_start + heap_ptr_offset, namespace=structs.GQ_PTR_NS_HEAP)
-        heap_ptr_offset += var.size()
-
     # The event table's addresses are calculated as part of the placement of
     #  stages.
-    events_ptr_start = menus_ptr_start + menus_ptr_offset
+    events_ptr_start = place_section('.event', menus_ptr_start + menus_ptr_offset, lambda start: sum(event.size() for event in events))
     events_ptr_offset = 0
 
     # Stages require two passes: first to assign addresses to the stages themselves,
@@ -126,42 +224,28 @@ def create_symbol_table(table_dest = sys.stdout, cmd_dest = sys.stdout):
         stage_ptr_offset += structs.GQ_STAGE_SIZE
 
     # Second pass (events):
-    for stage in Stage.stage_table.values():
-        for event_type in structs.EventType:
-            if event_type in stage.events:
-                event = stage.events[event_type]
-                event.set_addr(events_ptr_start + events_ptr_offset, namespace=structs.GQ_PTR_NS_CART)
-                events_ptr_offset += event.size()
+    for event in events:
+        event.set_addr(events_ptr_start + events_ptr_offset, namespace=structs.GQ_PTR_NS_CART)
+        events_ptr_offset += event.size()
 
-    init_ptr_start = events_ptr_start + events_ptr_offset
+    init_ptr_start = place_section('.init', events_ptr_start + events_ptr_offset, lambda start: sum(cmd.size() for cmd in init_cmds))
     init_ptr_offset = 0
     init_table = dict()
     Game.game.startup_code_ptr = structs.gq_ptr_apply_ns(structs.GQ_PTR_NS_CART, init_ptr_start)
 
-    # Generate the volatile variables' initialization code.
-    for var in list(Variable.storageclass_table['volatile'].values()):
-        # Initialization code allocation.
-        init_cmd = var.get_init_command()
-        init_cmd.set_addr(init_ptr_start + init_ptr_offset)
+    # Initialization code allocation.
+    for init_cmd in init_cmds:
+        init_cmd.set_addr(init_ptr_start + init_ptr_offset, namespace=structs.GQ_PTR_NS_CART)
         init_table[init_cmd.addr] = init_cmd
         init_ptr_offset += init_cmd.size()
-    
-    # Terminate the init code with a DONE
-    done_cmd = CommandDone()
-    done_cmd.set_addr(init_ptr_start + init_ptr_offset, namespace=structs.GQ_PTR_NS_CART)
-    init_table[done_cmd.addr] = done_cmd
-    init_ptr_offset += done_cmd.size()
-
-    # Now, because of hardware limitations of the flash chips we're using, we can only erase 4 KB sectors at
-    #  a time. So we need to pad the initialization code with DONE commands until we reach a 4 KB boundary.
-
-    # The persistent variables should start at the next 4 KB boundary after the initialization code.
-    # this should be: init_ptr_start + init_ptr_offset + (0x1000 - (init_ptr_start + init_ptr_offset) % 0x1000)
 
     # Now that everything else has been addressed, we can calculate the starting
     #  locations of the variable tables.
-    # First, allocate memory on-cart for the persistent variables
-    vars_ptr_start = init_ptr_start + init_ptr_offset + (0x1000 - (init_ptr_start + init_ptr_offset) % 0x1000)
+    # First, allocate memory on-cart for the persistent variables, at the first 4 KB
+    #  boundary at or after the end of the initialization code.
+    code_end = init_ptr_start + init_ptr_offset
+    # (The persistent section is padded to a whole sector and followed by its cache, of the same size.)
+    vars_ptr_start = place_section('.var', code_end + -code_end % 0x1000, lambda start: 2 * 0x1000)
     vars_ptr_offset = 0
     Game.game.persistent_var_ptr = vars_ptr_start
     
@@ -201,6 +285,26 @@ def create_symbol_table(table_dest = sys.stdout, cmd_dest = sys.stdout):
         cache_var.set_addr(cache_ptr_start + cache_ptr_offset)
         cache_ptr_offset += var.size()
 
+    # The read-only items moved out of the way of the persistent section go
+    #  after it, in a section of their own.
+    relocated_ptr_start = place_section('.rodata', cache_ptr_start + cache_ptr_offset, lambda start: sum(size for _, _, size in relocated))
+    relocated_ptr_offset = 0
+    relocated_table = dict()
+    for kind, obj, size in relocated:
+        if kind == 'menu':
+            obj.set_addr(relocated_ptr_start + relocated_ptr_offset)
+            relocated_table[obj.addr] = Menu.link_table.pop(obj.addr)
+        elif kind == 'cue':
+            frame_ptr = relocated_ptr_start + relocated_ptr_offset
+            for frame in obj.frames:
+                frame.set_addr(frame_ptr)
+                relocated_table[frame.addr] = LightCueFrame.link_table.pop(frame.addr)
+                frame_ptr += frame.size()
+        elif kind == 'frame':
+            obj.frame_data.set_addr(relocated_ptr_start + relocated_ptr_offset)
+            relocated_table[obj.frame_data.addr] = FrameData.link_table.pop(obj.frame_data.addr)
+        relocated_ptr_offset += size
+
     # Now, do one more pass to try to resolve any unresolved symbols in commands.
     for cmd in Command.command_list:
         if not cmd.resolve():
@@ -225,9 +329,13 @@ def create_symbol_table(table_dest = sys.stdout, cmd_dest = sys.stdout):
         '.event' : Event.link_table,
         '.init' : init_table,
         '.var' : Variable.link_table,
+        '.rodata' : relocated_table,
         '.heap' : Variable.heap_table
     }
 
+    # Where each section ended up, for the next build with a stable layout.
+    Game.game.sections = {section: (start, sum(symbol.size() for symbol in symbol_table[section].values())) for section, start in section_starts.items()}
+
     # Emit a human readable summary of the symbol table.
 
     section_table = []
@@ -253,7 +361,58 @@ def create_symbol_table(table_dest = sys.stdout, cmd_dest = sys.stdout):
         for symbol in table.values():
             section_table.append(('', f"{symbol.addr:#0{PAD}x}", f"{symbol.size():#0{PAD}x}", repr(symbol)))
     
-    print(tabulate(section_table, headers=section_table_headers), file=table_dest)
+    print(tabulate(section_table, headers=section_table_headers, disable_numparse=True), file=table_dest)
+
+    # What it took to start the persistent section on a sector boundary, or,
+    #  with a stable layout, which sections had to move.
+    print(file=table_dest)
+    if stable_sections is not None:
+        print(f"Stable layout: {len(section_starts) - len(moved_sections)} of {len(section_starts)} sections kept their place; moved or new: {', '.join(moved_sections) or 'none'}.", file=table_dest)
+    else:
+        print(f"Persistent section at {vars_ptr_start:#0{PAD}x}: {vars_ptr_start - code_end} bytes of padding before it; {-unpacked_code_end % 0x1000} without moving any read-only items.", file=table_dest)
+    if relocated:
+        relocated_table_rows = [(kind, repr(obj.frame_data) if kind == 'frame' else obj.name, size) for kind, obj, size in relocated]
+        print(f"{len(relocated)} read-only items ({relocated_ptr_offset} bytes) moved past the persistent section, to {relocated_ptr_start:#0{PAD}x}:", file=table_dest)
+        print(tabulate(relocated_table_rows, headers=['Kind', 'Item', 'Size']), file=table_dest)
+
+    if frame_count:
+        print(file=table_dest)
+        print(f"Frame data: {frame_count - frame_data_dupes} unique payloads for {frame_count} frames; {frame_data_dupes} duplicates share storage, saving {frame_data_saved} bytes.", file=table_dest)
+
+        # What each layout of the frame data costs in padding, and saves in
+        #  page reads (one per page a frame's payload touches, each time it's
+        #  drawn) and in sectors (summed over animations, i.e. what it takes
+        #  to reflash each one).
+        layout_table = []
+        layout_table_headers = ['Layout', 'Padding', 'Size', 'Page reads', 'Extra page reads', 'Animation sectors']
+        for candidate in layouts:
+            layout_table.append((
+                ('+'.join(candidate.rules) or 'packed') + (' (used)' if candidate is frame_data_layout else ''),
+                candidate.padding,
+                candidate.end - frame_data_ptr_start,
+                candidate.page_reads,
+                candidate.extra_page_reads,
+                candidate.sectors
+            ))
+        print(file=table_dest)
+        print(tabulate(layout_table, headers=layout_table_headers), file=table_dest)
+
+        # Which encodings each animation's frames ended up using.
+        codec_table = []
+        codec_table_headers = ['Animation', 'Frames', 'Bytes', 'Mean cost', 'Max cost', 'Encodings']
+        for anim in Animation.anim_table.values():
+            codec_counts = Counter(frame.compression_type_name.removeprefix('IMAGE_FMT_1BPP_') for frame in anim.frames)
+            render_costs = [frame.render_cost() for frame in anim.frames]
+            codec_table.append((
+                anim.name,
+                len(anim.frames),
+                sum(len(frame.bytes) for frame in anim.frames),
+                sum(render_costs) // len(render_costs),
+                max(render_costs),
+                ', '.join(f"{name} x{count}" for name, count in codec_counts.most_common())
+            ))
+        print(file=table_dest)
+        print(tabulate(codec_table, headers=codec_table_headers), file=table_dest)
 
     # Check whether the heap size exceeds the maximum (512 bytes)
     if heap_ptr_offset > 0x200:
@@ -278,38 +437,55 @@ def create_symbol_table(table_dest = sys.stdout, cmd_dest = sys.stdout):
                 cmd_addr += structs.GQ_OP_SIZE
                 next_expected_addr += structs.GQ_OP_SIZE
 
-    print(tabulate(cmds_table, headers=cmds_table_headers), file=cmd_dest)
+    print(tabulate(cmds_table, headers=cmds_table_headers, disable_numparse=True), file=cmd_dest)
 
     # print(cmds_by_addr)
 
     # Return the machine-readable symbol table for use in final code generation.
     return symbol_table
 
-def generate_code(parsed, symbol_table : dict):
-    output = bytes()
+def generate_code(parsed, symbol_table : dict) -> bytearray:
+    # The cartridge image is assembled in a buffer allocated once at its final
+    #  size, which the symbol table already tells us. Every byte starts out as
+    #  0xFF, the erased state of the flash, so padding is just a matter of
+    #  leaving bytes alone, and each symbol is copied straight into its slot.
+
+    cart_base = structs.gq_ptr_apply_ns(structs.GQ_PTR_NS_CART, 0x000000)
+    cart_limit = structs.gq_ptr_apply_ns(structs.GQ_PTR_NS_CART, 0xFFFFFF)
 
-    # Emit each section in order to the output bytes.
+    # Count the total number of symbols to be processed, and find the end of the image.
+    symbol_count = 0
+    cart_end = cart_base
+    for table in symbol_table.values():
+        symbol_count += len(table)
+        for addr, symbol in table.items():
+            if structs.gq_ptr_get_ns(addr) == structs.GQ_PTR_NS_CART:
+                cart_end = max(cart_end, addr + symbol.size())
 
-    # Count the total number of symbols to be processed
-    symbol_count = sum([len(table) for table in symbol_table.values()])
+    if cart_end > cart_limit:
+        print(f"OVERSIZE GAME ERROR: Address space exhausted at {cart_end:#0{10}x}.", file=sys.stderr)
+        exit(1)
 
-    next_expected_addr = structs.gq_ptr_apply_ns(structs.GQ_PTR_NS_CART, 0x000000)
+    output = bytearray(b'\xff') * (cart_end - cart_base)
+    output_view = memoryview(output)
 
+    next_expected_addr = cart_base
+
+    # Emit each section in order to the output buffer.
     with Progress(TextColumn("[progress.description]{task.description}"), BarColumn(), TaskProgressColumn(), TimeElapsedColumn()) as progress:
         task = progress.add_task(f"Generating code", total=symbol_count)
-        for section_name, table in symbol_table.items():
-            if section_name == '.var':
-                # For the variable table only, we expect the next address to be at the next 4 KB boundary.
-                next_4kb_boundary = next_expected_addr + (0x1000 - next_expected_addr % 0x1000)
-                # Output padding FF bytes until we reach the 4 KB boundary.
-                while next_expected_addr < next_4kb_boundary:
-                    output += bytes([0xFF])
-                    next_expected_addr += 1
-            for addr, symbol in table.items():
-                if next_expected_addr >= structs.gq_ptr_apply_ns(structs.GQ_PTR_NS_CART, 0xFFFFFF):
-                    print(f"OVERSIZE GAME ERROR: Address space exhausted at {next_expected_addr:#0{10}x}.", file=sys.stderr)
+        # With a stable layout, the sections aren't necessarily in order on the cart.
+        for section_name, table in sorted(symbol_table.items(), key=lambda section: Game.game.sections.get(section[0], (0, 0))):
+            if section_name in Game.game.sections:
+                # Sections may start past the end of the one before (the persistent section on a 4 KB
+                #  boundary, and, with a stable layout, anything); the bytes skipped to get there are
+                #  left as 0xFF padding.
+                section_start = cart_base + Game.game.sections[section_name][0]
+                if section_start < next_expected_addr:
+                    print(f"COMPILER ERROR: Section {section_name} at {section_start:#0{10}x} overlaps the one before it, which ends at {next_expected_addr:#0{10}x}.", file=sys.stderr)
                     exit(1)
-
+                next_expected_addr = section_start
+            for addr, symbol in table.items():
                 if structs.gq_ptr_get_ns(addr) != structs.GQ_PTR_NS_CART:
                     # Only emit code for the cartridge.
                     continue
@@ -319,10 +495,18 @@ def generate_code(parsed, symbol_table : dict):
                 if addr != next_expected_addr:
                     print(f"COMPILER ERROR: While working on symbol {symbol}, expected address {next_expected_addr:#0{10}x} but got {addr:#0{10}x}.", file=sys.stderr)
                     exit(1)
-                next_expected_addr += symbol.size()
-                output += symbol.to_bytes()
+
+                symbol_bytes = symbol.to_bytes()
+                if len(symbol_bytes) != symbol.size():
+                    print(f"COMPILER ERROR: Symbol {symbol} at address {addr:#0{10}x} emitted {len(symbol_bytes)} bytes but has size {symbol.size()}.", file=sys.stderr)
+                    exit(1)
+
+                offset = addr - cart_base
+                output_view[offset:offset + len(symbol_bytes)] = symbol_bytes
+                next_expected_addr += len(symbol_bytes)
                 progress.update(task, advance=1)
 
         progress.update(task, completed=symbol_count)
-    
+
+    output_view.release()
     return output
@@ -137,7 +137,8 @@ def parse_animation_definition(instring, loc, toks):
         for opt in toks[2]:
             if opt[0] in kwargs:
                 raise GqcParseError(f"Duplicate option {opt[0]} for animation {name}", instring, loc)
-            kwargs[opt[0]] = opt[1]
+            # Options without a value (e.g. crop) are flags.
+            kwargs[opt[0]] = opt[1] if len(opt) > 1 else True
 
     try:
         return Animation(name, source, **kwargs)
@@ -0,0 +1,114 @@
+import zlib
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+# Sector patches between two cart images. The cart's flash is erased and
+#  rewritten a 4 KB sector at a time, so a patch lists only the sectors that
+#  differ, each with the CRC32 of what it should hold before and after, and
+#  the new contents of those sectors:
+#
+#   header   magic, format version, sector size, old and new image sizes and
+#            CRC32s, dirty sector count
+#   index    one entry per dirty sector: sector number, old CRC32, new CRC32
+#   sectors  the new contents of each dirty sector, back to back
+#
+# Images are compared as if padded with 0xFF (erased flash) to a whole number
+#  of sectors, so growing or shrinking a cart only touches the sectors at its
+#  end.
+
+PATCH_MAGIC = b'GQPT'
+PATCH_VERSION = 1
+SECTOR_SIZE = 0x1000
+
+PatchHeader = namedtuple('PatchHeader', 'magic version sector_size old_size new_size old_crc new_crc sector_count')
+PATCH_HEADER_FORMAT = '<4sHHIIIII'
+PATCH_HEADER_SIZE = struct.calcsize(PATCH_HEADER_FORMAT)
+
+PatchEntry = namedtuple('PatchEntry', 'sector old_crc new_crc')
+PATCH_ENTRY_FORMAT = '<III'
+PATCH_ENTRY_SIZE = struct.calcsize(PATCH_ENTRY_FORMAT)
+
+def sector_count(size : int) -> int:
+    return -(-size // SECTOR_SIZE)
+
+def sector(image : memoryview, index : int) -> bytes:
+    # One sector of the image, padded out with erased bytes past its end.
+    return bytes(image[index * SECTOR_SIZE:(index + 1) * SECTOR_SIZE]).ljust(SECTOR_SIZE, b'\xff')
+
+def dirty_sectors(old : memoryview, new : memoryview) -> list[int]:
+    # The sectors that differ between the two images. The sectors both images
+    #  fill completely are compared in place, 8 bytes at a time; only the few
+    #  at the end are copied to be padded.
+    whole = min(len(old), len(new)) // SECTOR_SIZE
+    old_words = np.frombuffer(old, dtype='<u8', count=whole * SECTOR_SIZE // 8).reshape(whole, SECTOR_SIZE // 8)
+    new_words = np.frombuffer(new, dtype='<u8', count=whole * SECTOR_SIZE // 8).reshape(whole, SECTOR_SIZE // 8)
+    dirty = np.flatnonzero((old_words != new_words).any(axis=1)).tolist()
+
+    for index in range(whole, max(sector_count(len(old)), sector_count(len(new)))):
+        if sector(old, index) != sector(new, index):
+            dirty.append(index)
+    return dirty
+
+def make_patch(old : bytes, new : bytes) -> bytes:
+    old = memoryview(old)
+    new = memoryview(new)
+    dirty = dirty_sectors(old, new)
+
+    header = PatchHeader(
+        magic=PATCH_MAGIC,
+        version=PATCH_VERSION,
+        sector_size=SECTOR_SIZE,
+        old_size=len(old),
+        new_size=len(new),
+        old_crc=zlib.crc32(old),
+        new_crc=zlib.crc32(new),
+        sector_count=len(dirty)
+    )
+    chunks = [struct.pack(PATCH_HEADER_FORMAT, *header)]
+    sectors = [sector(new, index) for index in dirty]
+    for index, new_sector in zip(dirty, sectors):
+        chunks.append(struct.pack(PATCH_ENTRY_FORMAT, index, zlib.crc32(sector(old, index)), zlib.crc32(new_sector)))
+    chunks += sectors
+    return b''.join(chunks)
+
+def read_patch(patch : bytes) -> tuple[PatchHeader, list[PatchEntry], memoryview]:
+    # Returns the patch's header, its index, and the new sector contents.
+    patch = memoryview(patch)
+    if len(patch) < PATCH_HEADER_SIZE:
+        raise ValueError("Patch is truncated")
+    header = PatchHeader(*struct.unpack_from(PATCH_HEADER_FORMAT, patch))
+    if header.magic != PATCH_MAGIC or header.version != PATCH_VERSION or header.sector_size != SECTOR_SIZE:
+        raise ValueError("Patch has an unknown format")
+
+    index_end = PATCH_HEADER_SIZE + header.sector_count * PATCH_ENTRY_SIZE
+    if len(patch) != index_end + header.sector_count * SECTOR_SIZE:
+        raise ValueError("Patch is truncated")
+    entries = [PatchEntry(*entry) for entry in struct.iter_unpack(PATCH_ENTRY_FORMAT, patch[PATCH_HEADER_SIZE:index_end])]
+    return header, entries, patch[index_end:]
+
+def apply_patch(image : bytes, patch : bytes) -> bytearray:
+    # Returns the patched image. Each sector is checked against its CRCs as
+    #  it's rewritten, the same checks a programmer writing the sectors to a
+    #  cart would make, and the whole image against the new image's CRC.
+    header, entries, sectors = read_patch(patch)
+    if len(image) != header.old_size or zlib.crc32(image) != header.old_crc:
+        raise ValueError("Image doesn't match the one the patch was made from")
+
+    patched = bytearray(b'\xff') * (sector_count(max(header.old_size, header.new_size)) * SECTOR_SIZE)
+    patched[:len(image)] = image
+    patched_view = memoryview(patched)
+    for position, entry in enumerate(entries):
+        if zlib.crc32(sector(patched_view, entry.sector)) != entry.old_crc:
+            raise ValueError(f"Sector {entry.sector} doesn't match the patch")
+        new_sector = sectors[position * SECTOR_SIZE:(position + 1) * SECTOR_SIZE]
+        if zlib.crc32(new_sector) != entry.new_crc:
+            raise ValueError(f"Sector {entry.sector} of the patch is corrupt")
+        patched_view[entry.sector * SECTOR_SIZE:(entry.sector + 1) * SECTOR_SIZE] = new_sector
+    patched_view.release()
+
+    del patched[header.new_size:]
+    if zlib.crc32(patched) != header.new_crc:
+        raise ValueError("Patched image doesn't match the new image")
+    return patched
@@ -106,6 +106,25 @@ GqAnim = namedtuple('GqAnim', 'id frame_count ticks_per_frame flags width height
 GQ_ANIM_FORMAT = f'<HHHHBB{T_GQ_POINTER_FORMAT}'
 GQ_ANIM_SIZE = struct.calcsize(GQ_ANIM_FORMAT)
 
+# Bits of gq_anim.flags. These aren't interpreted by the badge firmware yet.
+class AnimFlags(IntEnum):
+    NONE = 0x00
+    CROPPED = 0x01 # A gq_anim_crop follows the animation's last gq_anim_frame (and its durations)
+    FRAME_DURATIONS = 0x02 # A uint16_t duration in ticks per frame follows the animation's last gq_anim_frame
+    PINGPONG = 0x04 # Play the frames forward, then backward without repeating the last or first
+
+# typedef struct gq_anim_crop {
+#     uint8_t x; // Offset of the stored frames within the animation's full canvas
+#     uint8_t y;
+# } gq_anim_crop;
+GqAnimCrop = namedtuple('GqAnimCrop', 'x y')
+GQ_ANIM_CROP_FORMAT = '<BB'
+GQ_ANIM_CROP_SIZE = struct.calcsize(GQ_ANIM_CROP_FORMAT)
+
+# uint16_t frame durations, in ticks
+GQ_ANIM_DURATION_FORMAT = '<H'
+GQ_ANIM_DURATION_SIZE = struct.calcsize(GQ_ANIM_DURATION_FORMAT)
+
 # typedef struct gq_anim_frame {
 #     uint8_t bPP;               // Bits per pixel and compression flags
 #     t_gq_pointer data_pointer; // Pointer to the frame data
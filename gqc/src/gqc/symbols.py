@@ -0,0 +1,227 @@
+import sys
+import struct
+import bisect
+import pathlib
+from array import array
+from collections import namedtuple
+
+from .datamodel import Game, Stage, Variable, Animation, FrameDataPadding, Menu, LightCue
+from . import structs
+
+# Index of every symbol the linker placed, by name and by address, with a
+#  summary of each section, saved next to the cartridge image so addresses
+#  (say, from a crash on the badge) can be resolved without rebuilding the
+#  game:
+#
+#   header    magic, format version, section count, symbol count, size of
+#             the name table
+#   sections  one entry per section: name, start, end, size, symbol count
+#   columns   for every symbol, in address order: its address, its size,
+#             its section's index, and where its name starts in the name
+#             table (plus where the last name ends), each as an array of
+#             32-bit integers
+#   names     the symbols' names, back to back
+#
+# Addresses are full pointers, namespace included, so symbols from different
+#  namespaces (the cart, the heap, builtins) sort apart. Symbols in a
+#  namespace don't overlap, so the one at an address is the last one starting
+#  at or before it, found by bisecting the address column; nothing else is
+#  read to find it.
+#
+# Symbols are named after what they belong to: animations, stages, menus,
+#  cues and variables by their own names; their parts as <owner>.<part>
+#  (hearts.frame3, hearts.frame3.data, hearts.durations, start.bgdone,
+#  flash.frame0, init.2).
+
+SYMBOL_INDEX_MAGIC = b'GQSY'
+SYMBOL_INDEX_VERSION = 1
+
+SymbolIndexHeader = namedtuple('SymbolIndexHeader', 'magic version section_count symbol_count names_size')
+SYMBOL_INDEX_HEADER_FORMAT = '<4sHHII'
+SYMBOL_INDEX_HEADER_SIZE = struct.calcsize(SYMBOL_INDEX_HEADER_FORMAT)
+
+SectionSummary = namedtuple('SectionSummary', 'name start end size count')
+SECTION_SUMMARY_FORMAT = '<16sIIII'
+SECTION_SUMMARY_SIZE = struct.calcsize(SECTION_SUMMARY_FORMAT)
+
+Symbol = namedtuple('Symbol', 'name section addr size')
+
+def symbol_names() -> dict[int, str]:
+    # Names of the linked objects, by id().
+    names = dict()
+    names[id(Game.game)] = 'header'
+    for anim in Animation.anim_table.values():
+        names[id(anim)] = anim.name
+        for index, frame in enumerate(anim.frames):
+            names[id(frame)] = f'{anim.name}.frame{index}'
+            # Frames that share a payload name it after the first of them.
+            names.setdefault(id(frame.frame_data), f'{anim.name}.frame{index}.data')
+        if anim.durations_record:
+            names[id(anim.durations_record)] = f'{anim.name}.durations'
+        if anim.crop_record:
+            names[id(anim.crop_record)] = f'{anim.name}.crop'
+    for stage in Stage.stage_table.values():
+        names[id(stage)] = stage.name
+        for event in stage.events.values():
+            names[id(event)] = f'{stage.name}.{event.event_type.name.lower()}'
+    for cue in LightCue.cue_table.values():
+        names[id(cue)] = cue.name
+        for index, frame in enumerate(cue.frames):
+            names[id(frame)] = f'{cue.name}.frame{index}'
+    for menu in Menu.menu_table.values():
+        names[id(menu)] = menu.name
+    for var in Variable.var_table.values():
+        names[id(var)] = var.name
+    return names
+
+class SymbolIndex:
+    def __init__(self, sections : list[SectionSummary], addrs : array, sizes : array, section_indices : array, name_offsets : array, names : bytes):
+        self.sections = sections
+        self.addrs = addrs
+        self.sizes = sizes
+        self.section_indices = section_indices
+        self.name_offsets = name_offsets
+        self.names = names
+        self.symbols_by_name = None # Built on the first lookup by name
+
+    @classmethod
+    def from_symbol_table(cls, symbol_table : dict) -> 'SymbolIndex':
+        # Indexes the symbol table from linker.create_symbol_table, along with
+        #  the builtin variables, which the firmware places itself.
+        names = symbol_names()
+        tables = dict(symbol_table)
+        for storageclass in ('builtin_int', 'builtin_str'):
+            tables[f'.{storageclass}'] = {var.addr: var for var in Variable.storageclass_table[storageclass].values()}
+
+        sections = []
+        symbols = []
+        for section_name, table in tables.items():
+            if not table:
+                continue
+            section_symbols = []
+            for addr, symbol in table.items():
+                if id(symbol) in names:
+                    name = names[id(symbol)]
+                elif section_name == '.init':
+                    name = f'init.{len(section_symbols)}'
+                elif isinstance(symbol, FrameDataPadding):
+                    name = 'padding'
+                else:
+                    name = repr(symbol)
+                section_symbols.append((addr, symbol.size(), len(sections), name))
+            sections.append(SectionSummary(
+                section_name,
+                min(addr for addr, _, _, _ in section_symbols),
+                max(addr + size for addr, size, _, _ in section_symbols),
+                sum(size for _, size, _, _ in section_symbols),
+                len(section_symbols)
+            ))
+            symbols += section_symbols
+        symbols.sort()
+
+        encoded_names = [name.encode('utf-8') for _, _, _, name in symbols]
+        name_offsets = array('I', [0])
+        for name in encoded_names:
+            name_offsets.append(name_offsets[-1] + len(name))
+        return cls(
+            sections,
+            array('I', [addr for addr, _, _, _ in symbols]),
+            array('I', [size for _, size, _, _ in symbols]),
+            array('I', [section for _, _, section, _ in symbols]),
+            name_offsets,
+            b''.join(encoded_names)
+        )
+
+    @classmethod
+    def read(cls, path : pathlib.Path) -> 'SymbolIndex':
+        data = path.read_bytes()
+        if len(data) < SYMBOL_INDEX_HEADER_SIZE:
+            raise ValueError(f"{path} is truncated")
+        header = SymbolIndexHeader(*struct.unpack_from(SYMBOL_INDEX_HEADER_FORMAT, data))
+        if header.magic != SYMBOL_INDEX_MAGIC or header.version != SYMBOL_INDEX_VERSION:
+            raise ValueError(f"{path} isn't a symbol index this version of gqc can read")
+
+        offset = SYMBOL_INDEX_HEADER_SIZE
+        sections_end = offset + header.section_count * SECTION_SUMMARY_SIZE
+        columns_end = sections_end + (4 * header.symbol_count + 1) * 4
+        if len(data) != columns_end + header.names_size:
+            raise ValueError(f"{path} is truncated")
+
+        sections = []
+        for name, start, end, size, count in struct.iter_unpack(SECTION_SUMMARY_FORMAT, data[offset:sections_end]):
+            sections.append(SectionSummary(name.rstrip(b'\0').decode('ascii'), start, end, size, count))
+
+        columns = []
+        offset = sections_end
+        for length in (header.symbol_count,) * 3 + (header.symbol_count + 1,):
+            column = array('I')
+            column.frombytes(data[offset:offset + length * 4])
+            if sys.byteorder != 'little':
+                column.byteswap()
+            columns.append(column)
+            offset += length * 4
+        return cls(sections, *columns, data[columns_end:])
+
+    def write(self, path : pathlib.Path):
+        header = SymbolIndexHeader(
+            magic=SYMBOL_INDEX_MAGIC,
+            version=SYMBOL_INDEX_VERSION,
+            section_count=len(self.sections),
+            symbol_count=len(self.addrs),
+            names_size=len(self.names)
+        )
+        chunks = [struct.pack(SYMBOL_INDEX_HEADER_FORMAT, *header)]
+        for section in self.sections:
+            chunks.append(struct.pack(SECTION_SUMMARY_FORMAT, section.name.encode('ascii'), *section[1:]))
+        for column in (self.addrs, self.sizes, self.section_indices, self.name_offsets):
+            if sys.byteorder != 'little':
+                column = array('I', column)
+                column.byteswap()
+            chunks.append(column.tobytes())
+        chunks.append(self.names)
+        path.write_bytes(b''.join(chunks))
+
+    def __len__(self) -> int:
+        return len(self.addrs)
+
+    def symbol(self, index : int) -> Symbol:
+        return Symbol(
+            self.names[self.name_offsets[index]:self.name_offsets[index + 1]].decode('utf-8'),
+            self.sections[self.section_indices[index]].name,
+            self.addrs[index],
+            self.sizes[index]
+        )
+
+    def at(self, addr : int) -> Symbol:
+        # The symbol whose bytes include addr, or None.
+        index = bisect.bisect_right(self.addrs, addr) - 1
+        if index < 0 or addr >= self.addrs[index] + self.sizes[index]:
+            return None
+        return self.symbol(index)
+
+    def lookup(self, name : str) -> list[Symbol]:
+        # Every symbol with this name, in address order. Names are unique
+        #  within each kind of thing, but an animation and a stage, say, can
+        #  share one.
+        if self.symbols_by_name is None:
+            self.symbols_by_name = dict()
+            for index in range(len(self)):
+                self.symbols_by_name.setdefault(self.names[self.name_offsets[index]:self.name_offsets[index + 1]].decode('utf-8'), []).append(index)
+        return [self.symbol(index) for index in self.symbols_by_name.get(name, [])]
+
+    def section(self, addr : int) -> SectionSummary:
+        # The section spanning addr, or None.
+        for section in self.sections:
+            if section.start <= addr < section.end:
+                return section
+        return None
+
+def parse_address(text : str) -> int:
+    # Addresses may be given with or without their namespace; without one,
+    #  they're taken to be on the cart.
+    addr = int(text, 0)
+    if addr < 0 or addr > 0xFFFFFFFF:
+        raise ValueError(f"Invalid address {text}")
+    if not structs.gq_ptr_get_ns(addr):
+        addr = structs.gq_ptr_apply_ns(structs.GQ_PTR_NS_CART, addr)
+    return addr
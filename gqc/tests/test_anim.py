@@ -0,0 +1,224 @@
+import os
+import shutil
+import pathlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+from rich.progress import Progress
+
+from context import gqc
+from gqc import anim, structs
+
+# Conversions done in-process against the same conversions done by ffmpeg,
+#  then how cropped animations are cut down to their content.
+
+ANIMATIONS = pathlib.Path(__file__).parent.parent / 'examples' / 'skel' / 'assets' / 'animations'
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="ffmpeg isn't on the PATH")
+
+def sample_gif(path : pathlib.Path, delays : list[int]):
+    # A GIF with the given frame delays, in ms, whose frames all differ.
+    frames = []
+    for index in range(len(delays)):
+        img = Image.new('L', (16, 16), 37 * index % 256)
+        img.putpixel((index % 16, index // 16), 0 if 37 * index % 256 >= 128 else 255)
+        frames.append(img)
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=delays, loop=0)
+
+def gradient_gif(path : pathlib.Path):
+    # Gradients and flat colors, where the dithering patterns show the most,
+    #  already at the badge's size, so nothing is scaled.
+    frames = []
+    gradient = np.linspace(0, 255, 128, dtype=np.uint8)
+    for index in range(4):
+        pixels = np.zeros((128, 128, 3), dtype=np.uint8)
+        pixels[..., 0] = gradient[np.newaxis, :]
+        pixels[..., 1] = gradient[:, np.newaxis]
+        pixels[..., 2] = 64 * index
+        img = Image.fromarray(pixels)
+        draw = ImageDraw.Draw(img)
+        draw.ellipse((16 + 8 * index, 16, 112, 112 - 8 * index), fill=(128, 128, 128))
+        draw.rectangle((0, 96, 40, 127), fill=(200, 40, 40))
+        frames.append(img)
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=100, loop=0)
+
+def frame_count(convert, src_path : pathlib.Path, output_dir : pathlib.Path, frame_rate : int, size : int) -> int:
+    with Progress(disable=True) as progress:
+        return len(list(convert(progress, src_path, output_dir, frame_rate=frame_rate, width=size, height=size, write_frames=False, write_gif=False)))
+
+@needs_ffmpeg
+@pytest.mark.parametrize('delays,frame_rate', [
+    ([20] * 15, 5),
+    ([100] * 10, 5),
+    ([100] * 10, 10),
+    ([40] * 3, 25),
+    ([100, 100], 5),
+    ([30, 70, 110], 10),
+    ([150, 20, 70, 250, 200, 150, 70], 5),
+    ([50, 250, 40, 70, 40, 30], 10),
+    ([250, 40, 70, 30, 30], 25),
+    ([70, 20, 250, 20, 30, 150, 20, 200, 100], 2),
+    ([30, 250, 100, 250, 50, 250, 70, 200, 30, 150, 100, 50], 4),
+    ([30, 200, 50], 20),
+    ([10, 10, 100, 15], 10),
+    ([0, 0, 100, 0, 10], 10),
+])
+def test_frame_rate_matches_ffmpeg(tmp_path, delays, frame_rate):
+    src_path = tmp_path / 'sample.gif'
+    sample_gif(src_path, delays)
+    expected = frame_count(anim.make_animation_from_video, src_path, tmp_path, frame_rate, 16)
+    assert frame_count(anim.make_animation_from_image_sequence, src_path, tmp_path, frame_rate, 16) == expected
+
+@needs_ffmpeg
+@pytest.mark.parametrize('source,frame_rate', [('heart_anim.gif', 5), ('bwcircles.gif', 10), ('dance.gif', 5), ('pbj.gif', 25)])
+def test_example_frame_rate_matches_ffmpeg(tmp_path, source, frame_rate):
+    expected = frame_count(anim.make_animation_from_video, ANIMATIONS / source, tmp_path, frame_rate, 128)
+    assert frame_count(anim.make_animation_from_image_sequence, ANIMATIONS / source, tmp_path, frame_rate, 128) == expected
+
+@needs_ffmpeg
+@pytest.mark.parametrize('dithering,agreement', [
+    ('none', 1),
+    ('bayer', 1),
+    ('heckbert', 1),
+    ('floyd_steinberg', 1),
+    ('sierra2', 0.9),
+    ('sierra2_4a', 0.9),
+])
+def test_dithering_matches_ffmpeg(tmp_path, dithering, agreement):
+    # Unscaled, these come out as ffmpeg's paletteuse makes them: exactly, or,
+    #  where error diffusion reaches a color whose lightness is right on the
+    #  threshold, at least agreement of the pixels (see dither.py).
+    src_path = tmp_path / 'gradients.gif'
+    gradient_gif(src_path)
+    frames = []
+    for convert in (anim.make_animation_from_video, anim.make_animation_from_image_sequence):
+        with Progress(disable=True) as progress:
+            frames.append([np.asarray(frame) for frame in convert(progress, src_path, tmp_path, dithering, write_frames=False, write_gif=False, source_timing=True)])
+    ffmpeg_frames, in_process_frames = frames
+    assert len(in_process_frames) == len(ffmpeg_frames) == 4
+    assert np.mean(np.array(in_process_frames) == np.array(ffmpeg_frames)) >= agreement
+
+@pytest.mark.parametrize('dithering', ['none', 'floyd_steinberg'])
+def test_still_images_use_pillow_dithering(tmp_path, dithering):
+    # Unless converted in-process, stills are quantized by Pillow, as they
+    #  always have been.
+    src_path = ANIMATIONS / 'printer.jpg'
+    with Progress(disable=True) as progress:
+        frame, = anim.make_animation(progress, src_path, tmp_path, dithering, width=64, height=64, write_frames=False, write_gif=False)
+    with Image.open(src_path) as img:
+        expected = img.resize((64, 64)).convert('1', dither=anim.PIL_DITHERS[dithering])
+    assert frame.tobytes() == expected.tobytes()
+
+def load_cropped(workspace : pathlib.Path, sources : dict[str, list[list[tuple[int, int, int, int]]]], size : int) -> dict:
+    # Makes a cropped animation from each list of frames, where each frame is
+    #  a list of white rectangles on black, and returns its crop offset, flags
+    #  and decoded frames. Runs in a process of its own, as the compiler's
+    #  state is global; the asset cache is in workspace, so loading the same
+    #  sources again reads them back from the frame cache.
+    from gqc.datamodel import Game, Animation, decode_frames
+
+    os.chdir(workspace)
+    src_dir = pathlib.Path('assets') / 'animations'
+    src_dir.mkdir(parents=True, exist_ok=True)
+    Game.game_name = 'crop'
+    Animation.in_process = True
+    animations = []
+    for name, frames in sources.items():
+        images = []
+        for rectangles in frames:
+            img = Image.new('L', (size, size), 0)
+            draw = ImageDraw.Draw(img)
+            for rectangle in rectangles:
+                draw.rectangle(rectangle, fill=255)
+            images.append(img)
+        # Single frames as stills, as a one-frame GIF converts to no frames at
+        #  all; and every frame of the others kept, with the source's timing.
+        source = f'{name}.gif' if len(images) > 1 else f'{name}.png'
+        images[0].save(src_dir / source, save_all=True, append_images=images[1:], duration=200, loop=0)
+        animations.append(Animation(name, source, w=size, h=size, crop=True, source_timing=len(images) > 1))
+    Animation.wait_for_loads()
+    return {anim.name: dict(
+        offset=(anim.crop_record.x, anim.crop_record.y),
+        flags=anim.flags,
+        frames=decode_frames(anim.frames),
+    ) for anim in animations}
+
+CROP_SIZE = 32
+
+CROP_SOURCES = dict(
+    blank=[[]],
+    middle=[[(10, 12, 13, 14)], [(8, 16, 11, 20)]],
+    left=[[(0, 5, 3, 9)]],
+    top=[[(6, 0, 9, 2)]],
+    right=[[(28, 20, CROP_SIZE - 1, 22)]],
+    bottom=[[(17, 30, 19, CROP_SIZE - 1)]],
+    corners=[[(0, 0, 1, 1)], [(CROP_SIZE - 2, CROP_SIZE - 2, CROP_SIZE - 1, CROP_SIZE - 1)]],
+)
+
+def uncropped(result : dict) -> list[np.ndarray]:
+    # Puts each cropped frame back where it was in the full canvas.
+    x, y = result['offset']
+    canvases = []
+    for frame in result['frames']:
+        canvas = np.zeros((CROP_SIZE, CROP_SIZE), dtype=frame.dtype)
+        canvas[y:y + frame.shape[0], x:x + frame.shape[1]] = frame
+        canvases.append(canvas)
+    return canvases
+
+def drawn(frames : list[list[tuple[int, int, int, int]]]) -> list[np.ndarray]:
+    canvases = []
+    for rectangles in frames:
+        canvas = np.zeros((CROP_SIZE, CROP_SIZE), dtype=bool)
+        for x0, y0, x1, y1 in rectangles:
+            canvas[y0:y1 + 1, x0:x1 + 1] = True
+        canvases.append(canvas)
+    return canvases
+
+@pytest.fixture(scope='module')
+def cropped(tmp_path_factory):
+    # Each source loaded twice: converted, then read back from the cache.
+    workspace = tmp_path_factory.mktemp('crop')
+    results = []
+    for _ in range(2):
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            results.append(executor.submit(load_cropped, workspace, CROP_SOURCES, CROP_SIZE).result())
+        assert len(list((workspace / 'build' / 'assets' / 'cache').glob('*/*.gqcache'))) == len(CROP_SOURCES)
+    return results
+
+def test_blank_animation_keeps_one_pixel(cropped):
+    converted, _ = cropped
+    result = converted['blank']
+    assert result['offset'] == (0, 0)
+    assert result['flags'] & structs.AnimFlags.CROPPED
+    assert all(frame.shape == (1, 1) and not frame.any() for frame in result['frames'])
+
+@pytest.mark.parametrize('name,box', [
+    ('middle', (8, 12, 6, 9)),
+    ('left', (0, 5, 4, 5)),
+    ('top', (6, 0, 4, 3)),
+    ('right', (28, 20, 4, 3)),
+    ('bottom', (17, 30, 3, 2)),
+    ('corners', (0, 0, CROP_SIZE, CROP_SIZE)),
+])
+def test_crop_fits_content(cropped, name, box):
+    # The crop is the union of every frame's content, wherever it touches the
+    #  edges, and loses none of it.
+    converted, _ = cropped
+    result = converted[name]
+    x, y, width, height = box
+    assert result['offset'] == (x, y)
+    assert result['flags'] & structs.AnimFlags.CROPPED
+    assert all(frame.shape == (height, width) for frame in result['frames'])
+    for canvas, expected in zip(uncropped(result), drawn(CROP_SOURCES[name]), strict=True):
+        assert np.array_equal(canvas.astype(bool), expected)
+
+@pytest.mark.parametrize('name', CROP_SOURCES)
+def test_crop_survives_frame_cache(cropped, name):
+    converted, cached = cropped
+    assert cached[name]['offset'] == converted[name]['offset']
+    assert cached[name]['flags'] == converted[name]['flags']
+    for cached_frame, converted_frame in zip(cached[name]['frames'], converted[name]['frames'], strict=True):
+        assert np.array_equal(cached_frame, converted_frame)
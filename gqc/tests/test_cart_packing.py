@@ -0,0 +1,299 @@
+import io
+import os
+import re
+import json
+import shutil
+import pathlib
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+
+from context import gqc
+from gqc import structs
+from gqc.patch import make_patch, read_patch, apply_patch
+
+# How the linker gets the persistent section onto a 4 KB sector boundary, on
+#  tightly packed carts: games whose code ends exactly on a boundary (which
+#  used to cost a whole extra sector of padding), just past one, and across a
+#  sector with read-only items the linker can move past the persistent
+#  section to close the gap. Then how identical frame payloads are stored
+#  once, how, with a stable layout, sections stay where the last build put
+#  them, and how one build's image is patched into the next's.
+
+SKEL = pathlib.Path(__file__).parent.parent / 'examples' / 'skel'
+
+GAME_TEMPLATE = '''
+game {{
+    id = 0;
+    title := "Packing test";
+    author := "duplico";
+    starting_stage = start;
+}}
+
+persistent {{
+    int high_score = 0;
+}}
+
+volatile {{
+    int score = 0;
+}}
+
+{assets}
+
+stage start {{
+    {bganim}
+    event enter {{
+{filler}
+    }}
+}}
+
+{stages}
+'''
+
+ASSETS = '''
+animations {
+    hearts <- "heart_anim.gif";
+    pop <- "bwcircles.gif" {
+        frame_rate = 10;
+    }
+}
+
+lightcues {
+    flash <- "flash.gqcue";
+}
+
+menus {
+    restart {
+        1: "Yes";
+        0: "No";
+    }
+}
+'''
+
+def game_source(filler : int, extra_stages : int, assets : bool) -> str:
+    return GAME_TEMPLATE.format(
+        assets=ASSETS if assets else '',
+        bganim='bganim hearts; menu restart;' if assets else '',
+        filler='\n'.join(['        score = 1;'] * filler),
+        stages='\n'.join(f'stage extra{index} {{ event enter {{ score = 2; }} }}' for index in range(extra_stages)),
+    )
+
+def link(workspace : pathlib.Path, name : str, source : str, stable_sections : dict = None) -> dict:
+    # Builds the game in workspace and checks that every read-only item is
+    #  where whatever points to it says it is and that no two symbols on the
+    #  cart overlap. Runs in a process of its own, as the compiler's state is
+    #  global. Animations are converted in-process, so ffmpeg isn't needed.
+    from gqc import parser, linker
+    from gqc.datamodel import Game, Animation, Menu, LightCue
+
+    os.chdir(workspace)
+    game_path = pathlib.Path('games') / f'{name}.gq'
+    game_path.write_text(source)
+    Game.game_name = name
+    Animation.in_process = True
+    linker.create_reserved_variables()
+    with open(game_path, 'r') as f:
+        parsed = parser.parse(f)
+    linker.load_assets()
+    map_file = io.StringIO()
+    with contextlib.redirect_stdout(io.StringIO()):
+        symbol_table = linker.create_symbol_table(table_dest=map_file, cmd_dest=io.StringIO(), stable_sections=stable_sections)
+        output = linker.generate_code(parsed, symbol_table)
+
+    def cart_bytes(addr : int, size : int) -> bytes:
+        offset = structs.gq_ptr_get_addr(addr, expected_namespace=structs.GQ_PTR_NS_CART)
+        return bytes(output[offset:offset + size])
+
+    for anim in Animation.anim_table.values():
+        for frame in anim.frames:
+            assert cart_bytes(frame.frame_data.addr, len(frame.bytes)) == bytes(frame.bytes)
+    for menu in Menu.menu_table.values():
+        assert cart_bytes(menu.addr, menu.size()) == menu.to_bytes()
+    for cue in LightCue.cue_table.values():
+        for frame in cue.frames:
+            assert cart_bytes(frame.addr, frame.size()) == frame.to_bytes()
+
+    symbols = sorted(
+        (structs.gq_ptr_get_addr(addr), symbol.size())
+        for table in symbol_table.values()
+        for addr, symbol in table.items()
+        if structs.gq_ptr_get_ns(addr) == structs.GQ_PTR_NS_CART
+    )
+    for (addr, size), (next_addr, _) in zip(symbols, symbols[1:]):
+        assert addr + size <= next_addr
+
+    vars_ptr = structs.gq_ptr_get_addr(Game.game.persistent_var_ptr)
+    if stable_sections is not None:
+        return dict(vars_ptr=vars_ptr, sections=Game.game.sections, image=bytes(output))
+
+    padding, unpacked_padding = map(int, re.search(r'(\d+) bytes of padding before it; (\d+) without', map_file.getvalue()).groups())
+    return dict(
+        padding=padding,
+        unpacked_padding=unpacked_padding,
+        vars_ptr=vars_ptr,
+        code_end=vars_ptr - padding,
+        var_end=max(structs.gq_ptr_get_addr(addr) + var.size() for addr, var in symbol_table['.var'].items()),
+        relocated=sorted((structs.gq_ptr_get_addr(addr), symbol.size()) for addr, symbol in symbol_table['.rodata'].items()),
+        sections=Game.game.sections,
+        frame_data={anim.name: [frame.frame_data.addr for frame in anim.frames] for anim in Animation.anim_table.values()},
+        payload_size={anim.name: sum(len(frame.bytes) for frame in anim.frames) for anim in Animation.anim_table.values()},
+    )
+
+@pytest.fixture(scope='module')
+def build(tmp_path_factory):
+    workspace = tmp_path_factory.mktemp('packing') / 'skel'
+    shutil.copytree(SKEL, workspace)
+    def build(name : str, source : str, stable_sections : dict = None) -> dict:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            return executor.submit(link, workspace, name, source, stable_sections).result()
+    return build
+
+def check_alignment(result : dict):
+    assert result['vars_ptr'] % 0x1000 == 0
+    assert result['padding'] < 0x1000
+    assert result['padding'] <= result['unpacked_padding']
+
+def test_code_ending_on_a_sector_boundary(build):
+    # Without anything the linker can move, the padding is just up to the
+    #  next boundary; in particular none when the code already ends on one.
+    base = build('base', game_source(0, 0, False))
+    step = build('step', game_source(1, 0, False))['code_end'] - base['code_end']
+    stage_step = build('stage', game_source(0, 1, False))['code_end'] - base['code_end']
+    for extra_stages in range(step):
+        start = base['code_end'] + extra_stages * stage_step
+        if (0x1000 - start % 0x1000) % step == 0:
+            break
+    else:
+        pytest.fail("No game ends exactly on a sector boundary")
+    filler = (0x1000 - start % 0x1000) // step
+
+    aligned = build('aligned', game_source(filler, extra_stages, False))
+    check_alignment(aligned)
+    assert aligned['code_end'] % 0x1000 == 0
+    assert aligned['padding'] == 0
+
+    past = build('past', game_source(filler + 1, extra_stages, False))
+    check_alignment(past)
+    assert past['code_end'] % 0x1000 == step
+    assert past['padding'] == 0x1000 - step
+    assert not past['relocated']
+
+@pytest.mark.parametrize('filler', [0, 60, 120, 240, 360])
+def test_read_only_items_close_the_gap(build, filler):
+    # With animations, a lighting cue and a menu to move, across the sector:
+    #  whatever is moved is packed back to back straight after the persistent
+    #  section, and what's left before it needs less padding than before.
+    result = build(f'assets_{filler}', game_source(filler, 0, True))
+    check_alignment(result)
+    if result['relocated']:
+        addr = result['var_end']
+        for relocated_addr, size in result['relocated']:
+            assert relocated_addr == addr
+            addr += size
+        assert result['padding'] < result['unpacked_padding']
+
+def test_identical_frames_share_one_payload(build):
+    # Two animations made from the same source: the second one's frames all
+    #  point at the first one's payloads, so the frame data is no bigger than
+    #  with the first one alone, and only the tables describing them grow.
+    source = lambda animations: GAME_TEMPLATE.format(assets=f'animations {{ {animations} }}', bganim='bganim hearts;', filler='', stages='')
+    single = build('single', source('hearts <- "heart_anim.gif";'))
+    twin = build('twin', source('hearts <- "heart_anim.gif"; twin <- "heart_anim.gif";'))
+
+    assert twin['payload_size']['twin'] > 0
+    assert twin['frame_data']['twin'] == twin['frame_data']['hearts']
+    assert twin['sections']['.framedata'][1] == single['sections']['.framedata'][1]
+    assert twin['sections']['.anim'][1] == single['sections']['.anim'][1] + structs.GQ_ANIM_SIZE
+    assert twin['sections']['.frame'][1] == 2 * single['sections']['.frame'][1]
+
+def sectors_changed(old : bytes, new : bytes) -> set[int]:
+    return {offset // 0x1000 for offset in range(0, max(len(old), len(new)), 0x1000) if old[offset:offset + 0x1000] != new[offset:offset + 0x1000]}
+
+def test_stable_layout_keeps_sections_in_place(build):
+    # The first build with a stable layout starts each section on a sector
+    #  boundary; growing the events a little then leaves every section where
+    #  it was, and only the sectors holding the events (and the stage table,
+    #  which points to them) change.
+    first = build('stable', game_source(20, 2, True), dict())
+    assert all(start % 0x1000 == 0 for start, _ in first['sections'].values())
+    assert first['vars_ptr'] == first['sections']['.var'][0]
+
+    grown = build('stable', game_source(24, 2, True), first['sections'])
+    assert {section: start for section, (start, _) in grown['sections'].items()} == {section: start for section, (start, _) in first['sections'].items()}
+    assert grown['sections']['.event'][1] > first['sections']['.event'][1]
+    assert sectors_changed(first['image'], grown['image']) == {first['sections']['.stage'][0] // 0x1000, first['sections']['.event'][0] // 0x1000}
+
+def test_stable_layout_moves_only_what_outgrew_its_space(build):
+    # Events that no longer fit where they were go after everything else;
+    #  the sections after where they were stay put.
+    first = build('stable', game_source(20, 2, True), dict())
+    grown = build('stable', game_source(20 + 0x1000 // structs.GQ_OP_SIZE, 2, True), first['sections'])
+    cart_end = max(start + size for start, size in first['sections'].values())
+    for section, (start, _) in grown['sections'].items():
+        if section == '.event':
+            assert start >= cart_end and start % 0x1000 == 0
+        else:
+            assert start == first['sections'][section][0]
+
+def test_mismatched_layout_version_is_ignored(tmp_path, capsys):
+    from gqc.gqc import read_stable_layout, LAYOUT_FILE_VERSION
+    layout_path = tmp_path / 'layout.json'
+    layout_path.write_text(json.dumps(dict(version=1, relocation=[['menu', 'restart']])))
+    assert read_stable_layout(layout_path) == dict()
+    assert 'WARNING' in capsys.readouterr().err
+
+    layout_path.write_text(json.dumps(dict(version=LAYOUT_FILE_VERSION, stable_layout=True, sections={'.event': [0x2000, 16]})))
+    assert read_stable_layout(layout_path) == {'.event': (0x2000, 16)}
+    layout_path.write_text(json.dumps(dict(version=LAYOUT_FILE_VERSION, stable_layout=False, sections={'.event': [0x2000, 16]})))
+    assert read_stable_layout(layout_path) == dict()
+
+def check_patch(old : bytes, new : bytes):
+    # The patch holds exactly the sectors that differ, and turns old into new.
+    patch = make_patch(old, new)
+    header, entries, _ = read_patch(patch)
+    assert (header.old_size, header.new_size) == (len(old), len(new))
+    assert {entry.sector for entry in entries} == sectors_changed(old.ljust(len(new), b'\xff'), new.ljust(len(old), b'\xff'))
+    assert apply_patch(old, patch) == new
+    return patch
+
+def test_patch_between_builds(build):
+    # Between builds with a stable layout: the same game, events grown in
+    #  place, and events grown past their space (which makes the cart longer),
+    #  both ways.
+    first = build('stable', game_source(20, 2, True), dict())
+    again = build('stable', game_source(20, 2, True), first['sections'])
+    grown = build('stable', game_source(24, 2, True), first['sections'])
+    spilled = build('stable', game_source(20 + 0x1000 // structs.GQ_OP_SIZE, 2, True), first['sections'])
+    assert len(spilled['image']) > len(first['image'])
+
+    assert read_patch(check_patch(first['image'], again['image']))[0].sector_count == 0
+    assert read_patch(check_patch(first['image'], grown['image']))[0].sector_count == 2
+    check_patch(first['image'], spilled['image'])
+    check_patch(spilled['image'], first['image'])
+
+def test_patch_size_changes():
+    # Sizes that aren't whole sectors: anything past the end of the shorter
+    #  image is compared as erased flash.
+    old = np.random.default_rng(0).integers(0, 256, 3 * 0x1000 + 100, dtype=np.uint8).tobytes()
+    for new in (old + b'\x00', old + b'\xff' * 50, old + bytes(0x2000), old[:0x1000 + 7], old[:0x1000], old[:-1] + b'\x00', b''):
+        check_patch(old, new)
+        check_patch(new, old)
+    # Growing into the erased padding of the last sector rewrites nothing.
+    assert read_patch(make_patch(old, old + b'\xff' * 50))[0].sector_count == 0
+
+def test_patch_refuses_other_images():
+    old = bytes(range(256)) * 40
+    new = old[:0x1000] + b'\x01' + old[0x1001:]
+    patch = make_patch(old, new)
+    for other in (new, old[:-1], old[:-1] + b'\x00', b''):
+        with pytest.raises(ValueError):
+            apply_patch(other, patch)
+    with pytest.raises(ValueError):
+        apply_patch(old, patch[:-1])
+    corrupt = bytearray(patch)
+    corrupt[-1] ^= 0xff
+    with pytest.raises(ValueError):
+        apply_patch(old, bytes(corrupt))
@@ -0,0 +1,339 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+
+from context import gqc
+from gqc import encoding
+from gqc.datamodel import Frame, FrameEncoding, encode_deltas, encode_extended_formats, decode_frames, encode_frames, fold_pingpong, shutdown_encoder_pool, ENCODER_FRAMES_IN_FLIGHT
+
+# Round trips of the frame encodings through their reference decoders.
+
+@pytest.fixture
+def extended_formats(monkeypatch):
+    # Enables extended formats for the frames a test encodes.
+    def enable(*formats):
+        monkeypatch.setattr(Frame, 'extended_formats', frozenset(formats))
+    return enable
+
+def frame_of(pixels : np.ndarray) -> Frame:
+    return Frame(img=Image.fromarray(pixels * 255).convert('1'))
+
+def sprite_frames(count : int, width : int = 128, height : int = 64) -> list[np.ndarray]:
+    # A small square moving across a static noisy background, which is
+    #  expensive to store whole but XORs down to a few short runs from one
+    #  frame to the next.
+    background = np.random.default_rng(0).integers(0, 2, (height, width), dtype=np.uint8)
+    frames = []
+    for index in range(count):
+        pixels = background.copy()
+        x = 3 * index % (width - 10)
+        pixels[20:30, x:x + 10] = 1
+        frames.append(pixels)
+    return frames
+
+# The default formats, which every existing cart is made of, byte for byte
+#  against the per-pixel loops Frame used to encode them with.
+
+def reference_uncompressed_bytes(pixels : np.ndarray) -> bytes:
+    width = pixels.shape[1]
+    run = 0
+    val = 0
+    out_bytes = []
+    row_run = 0
+    for pixel in pixels.ravel():
+        if run == 8 or row_run == width:
+            out_bytes.append(val)
+            run = 0
+            val = 0
+            if row_run == width:
+                row_run = 0
+        if pixel:
+            val |= (0b10000000 >> run)
+        run += 1
+        row_run += 1
+    out_bytes.append(val)
+    return bytes(out_bytes)
+
+def reference_rle_bytes(pixels : np.ndarray, bits : int) -> bytes:
+    flat = [int(pixel) for pixel in pixels.ravel()]
+    run_max = (1 << bits) - 1
+    val_mask = run_max << (8 - bits)
+    val = flat[0]
+    run = 0
+    out_bytes = []
+    for pixel in flat[1:]:
+        if pixel == val:
+            if run == run_max:
+                run = 0
+                out_bytes.append(val_mask + val)
+            else:
+                run += 1
+        else:
+            out_bytes.append((run << (8 - bits)) + val)
+            run = 0
+            val = pixel
+    out_bytes.append((run << (8 - bits)) + val)
+    return bytes(out_bytes)
+
+def sample_images() -> list[Image.Image]:
+    # Blank and full frames (runs split at the maximum length), line art,
+    #  noise, and widths that aren't a multiple of 8 (row padding).
+    images = [Image.new('1', (128, 128), 0), Image.new('1', (128, 128), 1), Image.new('1', (13, 21), 1)]
+    for index in range(4):
+        img = Image.new('1', (128, 128), 0)
+        draw = ImageDraw.Draw(img)
+        draw.ellipse((8 * index, 8 * index, 127 - 4 * index, 127 - 2 * index), outline=1, width=3)
+        draw.rectangle((0, 100, 127, 127), fill=1)
+        images.append(img)
+    images.append(Image.effect_noise((128, 128), 64).convert('1'))
+    images.append(Image.effect_noise((37, 21), 64).convert('1'))
+    images.append(Image.effect_noise((130, 3), 64).convert('1'))
+    return images
+
+@pytest.mark.parametrize('index', range(len(sample_images())))
+def test_default_formats_match_per_pixel_loops(index):
+    pixels = encoding.unpack_pixels(sample_images()[index])
+    height, width = pixels.shape
+    assert encoding.uncompressed_bytes(pixels) == reference_uncompressed_bytes(pixels)
+    assert encoding.uncompressed_size(pixels) == len(reference_uncompressed_bytes(pixels))
+    for bits in (4, 7):
+        payload = encoding.rle_bytes(pixels, bits)
+        assert payload == reference_rle_bytes(pixels, bits)
+        assert encoding.rle_size(encoding.rle_runs(pixels)[1], bits) == len(payload)
+        assert np.array_equal(encoding.decode_rle(payload, bits, width, height), pixels)
+    assert np.array_equal(encoding.decode_uncompressed(encoding.uncompressed_bytes(pixels), width, height), pixels)
+
+def test_default_formats_golden_bytes():
+    # A 10x2 frame: alternating pixels ending in a run of two, then a blank
+    #  row; and 40 set pixels, split into maximum-length RLE4 runs.
+    pixels = np.array([[1, 0, 1, 0, 1, 0, 1, 0, 1, 1], [0] * 10], dtype=np.uint8)
+    assert encoding.uncompressed_bytes(pixels) == bytes([0xaa, 0xc0, 0x00, 0x00])
+    assert encoding.rle_bytes(pixels, 7) == bytes([0x01, 0x00] * 4 + [0x03, 0x12])
+    assert encoding.rle_bytes(pixels, 4) == bytes([0x01, 0x00] * 4 + [0x11, 0x90])
+    full = np.ones((4, 10), dtype=np.uint8)
+    assert encoding.rle_bytes(full, 4) == bytes([0xf1, 0xf1, 0x71])
+    assert encoding.rle_bytes(full, 7) == bytes([0x4f])
+
+def test_streamed_frames_are_read_as_they_are_encoded():
+    # A generator of frames is only read a few frames ahead of the encoded
+    #  frames coming back, and they come back in order.
+    originals = sprite_frames(40)
+    read = []
+    def sources():
+        for pixels in originals:
+            read.append(pixels)
+            yield Image.fromarray(pixels * 255).convert('1')
+
+    class ReadAhead:
+        def __init__(self):
+            self.frames = []
+        def update(self, task, advance):
+            self.frames.append(len(read) - len(self.frames) - 1)
+
+    read_ahead = ReadAhead()
+    try:
+        frames = encode_frames(sources(), jobs=2, progress=read_ahead, task=None)
+    finally:
+        shutdown_encoder_pool()
+    assert max(read_ahead.frames) <= 2 * ENCODER_FRAMES_IN_FLIGHT
+    for decoded, original in zip(decode_frames(frames), originals, strict=True):
+        assert np.array_equal(decoded, original)
+
+def test_delta_round_trip(extended_formats):
+    extended_formats('delta')
+    originals = sprite_frames(11)
+    frames = [frame_of(pixels) for pixels in originals]
+    encode_deltas(frames, 4)
+
+    types = [frame.compression_type_number for frame in frames]
+    assert FrameEncoding.DELTA_RLE7 in types
+    for index, frame_type in enumerate(types):
+        if index % 4 == 0:
+            assert frame_type != FrameEncoding.DELTA_RLE7
+
+    for decoded, original in zip(decode_frames(frames), originals):
+        assert np.array_equal(decoded, original)
+
+def test_delta_chains_restart_at_keyframes(extended_formats):
+    # Nothing decodes from further back than the last keyframe, so decoding
+    #  can start at any of them.
+    extended_formats('delta')
+    originals = sprite_frames(11)
+    frames = [frame_of(pixels) for pixels in originals]
+    encode_deltas(frames, 4)
+
+    for keyframe in range(0, len(frames), 4):
+        for decoded, original in zip(decode_frames(frames[keyframe:]), originals[keyframe:]):
+            assert np.array_equal(decoded, original)
+
+def test_delta_needs_previous_frame(extended_formats):
+    extended_formats('delta')
+    frames = [frame_of(pixels) for pixels in sprite_frames(3)]
+    encode_deltas(frames, 4)
+    assert frames[1].compression_type_number == FrameEncoding.DELTA_RLE7
+    with pytest.raises(ValueError):
+        frames[1].decode()
+
+ODD_SIZES = [(128, 128), (13, 21), (100, 37), (8, 8), (130, 3)]
+
+def patterned_frames(count : int, width : int, height : int) -> list[np.ndarray]:
+    # Repeating 8x8 patterns (which tile well), shifted a little every frame
+    #  so tiles are both shared and distinct, plus vertical bars.
+    y, x = np.mgrid[0:height, 0:width]
+    frames = []
+    for index in range(count):
+        pixels = (((x + index) // 4 + y // 4) % 2).astype(np.uint8)
+        pixels[:, index % width] = 1
+        frames.append(pixels)
+    return frames
+
+@pytest.mark.parametrize('width,height', ODD_SIZES)
+def test_column_rle_round_trip(width, height):
+    for pixels in patterned_frames(3, width, height):
+        payload = encoding.column_rle_bytes(pixels)
+        assert np.array_equal(encoding.decode_column_rle(payload, width, height), pixels)
+
+@pytest.mark.parametrize('width,height', ODD_SIZES)
+def test_tiles_round_trip(width, height):
+    originals = patterned_frames(5, width, height)
+    payloads = encoding.tile_bytes(originals)
+
+    dictionary, index_map = encoding.split_tile_dictionary(payloads[0])
+    assert np.array_equal(encoding.decode_tiles(index_map, dictionary, width, height), originals[0])
+    for payload, original in zip(payloads[1:], originals[1:]):
+        assert np.array_equal(encoding.decode_tiles(payload, dictionary, width, height), original)
+
+def test_tiles_round_trip_through_frames():
+    # The same, through the frames' own decoders, which find the dictionary
+    #  in the first frame.
+    originals = patterned_frames(5, 100, 37)
+    frames = [frame_of(pixels) for pixels in originals]
+    for frame, payload in zip(frames, encoding.tile_bytes(originals)):
+        frame.use_encoding('IMAGE_FMT_1BPP_TILE8', payload)
+    for decoded, original in zip(decode_frames(frames), originals):
+        assert np.array_equal(decoded, original)
+
+def test_tiles_round_trip_with_wide_indices():
+    # More than 256 distinct tiles need two-byte indices.
+    rng = np.random.default_rng(1)
+    originals = [rng.integers(0, 2, (133, 130), dtype=np.uint8) for _ in range(2)]
+    payloads = encoding.tile_bytes(originals)
+    dictionary, index_map = encoding.split_tile_dictionary(payloads[0])
+    assert len(dictionary) > 0x100
+    assert np.array_equal(encoding.decode_tiles(index_map, dictionary, 130, 133), originals[0])
+    assert np.array_equal(encoding.decode_tiles(payloads[1], dictionary, 130, 133), originals[1])
+
+def codec_frames() -> list[np.ndarray]:
+    # Patterns at every odd size, frames all of one color (including at odd
+    #  widths), noise, and rows long enough to need more than one PackBits
+    #  packet or RLE run each.
+    rng = np.random.default_rng(2)
+    frames = [pixels for width, height in ODD_SIZES for pixels in patterned_frames(2, width, height)]
+    for width, height in ((128, 128), (13, 21), (130, 3)):
+        frames.append(np.zeros((height, width), dtype=np.uint8))
+        frames.append(np.ones((height, width), dtype=np.uint8))
+    frames.append(rng.integers(0, 2, (37, 100), dtype=np.uint8))
+    wide = np.zeros((5, 1100), dtype=np.uint8)
+    wide[:, 300:] = 1
+    wide[2, ::3] = 0
+    frames.append(wide)
+    return frames
+
+@pytest.mark.parametrize('codec', Frame.codecs, ids=lambda codec: codec.name.removeprefix('IMAGE_FMT_1BPP_'))
+def test_codecs_round_trip_through_frames(codec):
+    # Every per-frame codec, through Frame.decode, for every frame it can
+    #  represent; its measured size is the size of what it encodes.
+    represented = 0
+    for pixels in codec_frames():
+        runs = encoding.rle_runs(pixels)
+        measure = codec.measure(pixels, runs)
+        if measure is None:
+            continue
+        represented += 1
+        frame = frame_of(pixels)
+        frame.use_encoding(codec.name, codec.encode(pixels, runs))
+        assert len(frame.bytes) == measure[0]
+        assert np.array_equal(frame.decode(), pixels)
+    assert represented
+
+def test_frames_choose_a_decodable_codec(extended_formats):
+    # With every format enabled, whichever codec wins decodes to the frame.
+    extended_formats('solid', 'columns', 'packbits', 'rows')
+    for pixels in codec_frames():
+        frame = frame_of(pixels)
+        if not pixels.any() or pixels.all():
+            assert frame.compression_type_name in ('IMAGE_FMT_1BPP_FILL_0', 'IMAGE_FMT_1BPP_FILL_1')
+        assert np.array_equal(frame.decode(), pixels)
+
+@pytest.mark.parametrize('width,height', ODD_SIZES)
+def test_row_indexed_clipped_decode(width, height):
+    # Decoding only some rows, as a blit clipped at the top or bottom of the
+    #  screen would, gives those rows of the uncompressed frame.
+    pixels = patterned_frames(1, width, height)[0]
+    expected = encoding.decode_uncompressed(encoding.uncompressed_bytes(pixels), width, height)
+    payload = encoding.row_indexed_bytes(pixels)
+    for y_start, y_end in ((0, height), (height // 2, height), (0, height // 2 + 1), (height - 1, height), (height // 3, 2 * height // 3 + 1)):
+        assert np.array_equal(encoding.decode_row_indexed(payload, width, height, y_start, y_end), expected[y_start:y_end])
+
+def test_row_seekable_frames(extended_formats):
+    # Only row-seekable animations are limited to row-seekable formats.
+    extended_formats('rows')
+    # Long runs, which plain RLE would be chosen for.
+    pixels = np.zeros((37, 100), dtype=np.uint8)
+    pixels[5:30, 20:70] = 1
+    image = Image.fromarray(pixels * 255).convert('1')
+    frame = Frame(img=image, row_seekable=True)
+    assert frame.compression_type_name in Frame.row_seekable_formats
+    assert np.array_equal(frame.decode(), pixels)
+    assert Frame(img=image).compression_type_name not in Frame.row_seekable_formats
+
+def test_row_seekable_animations_skip_deltas(extended_formats):
+    extended_formats('delta', 'rows')
+    originals = sprite_frames(6)
+
+    frames = [Frame(img=Image.fromarray(pixels * 255).convert('1'), row_seekable=True) for pixels in originals]
+    encode_extended_formats(frames, row_seekable=True)
+    assert all(frame.compression_type_name in Frame.row_seekable_formats for frame in frames)
+    for decoded, original in zip(decode_frames(frames), originals):
+        assert np.array_equal(decoded, original)
+
+    frames = [frame_of(pixels) for pixels in originals]
+    encode_extended_formats(frames)
+    assert any(frame.compression_type_number == FrameEncoding.DELTA_RLE7 for frame in frames)
+
+# Ping-pong loops, stored as just their forward half.
+
+def pingpong_frames(order : list[int]) -> list[Frame]:
+    # Frames of a moving sprite, in the given order of positions.
+    originals = sprite_frames(max(order) + 1)
+    return [frame_of(originals[index]) for index in order]
+
+@pytest.mark.parametrize('order,forward', [
+    ([0, 1, 2, 1], 3),
+    ([0, 1, 2, 3, 2, 1], 4),
+    ([0, 1, 2, 3, 4, 3, 2, 1], 5),
+])
+def test_pingpong_folds(order, forward):
+    frames = pingpong_frames(order)
+    assert fold_pingpong(frames) == frames[:forward]
+
+@pytest.mark.parametrize('order', [
+    # Palindromes of odd length repeat the first frame when looped, which
+    #  the folded loop wouldn't.
+    [0, 1, 2, 1, 0],
+    [0, 1, 2, 3, 2, 1, 0],
+    # Not palindromes at all.
+    [0, 1, 2, 3],
+    [0, 1, 2, 0],
+    [0, 1, 2, 3, 1, 2],
+    # Too short to save anything.
+    [0, 1],
+    [0],
+])
+def test_pingpong_stays_unfolded(order):
+    assert fold_pingpong(pingpong_frames(order)) is None
+
+def test_pingpong_compares_durations():
+    frames = pingpong_frames([0, 1, 2, 1])
+    frames[3].duration += 1
+    assert fold_pingpong(frames) is None
@@ -0,0 +1,183 @@
+import io
+import os
+import shutil
+import pathlib
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+from context import gqc
+from gqc import structs
+from gqc.symbols import SymbolIndex, parse_address
+
+# The symbol index saved next to a cart image: what's read back from it, and
+#  resolving addresses and names with it.
+
+SKEL = pathlib.Path(__file__).parent.parent / 'examples' / 'skel'
+
+GAME = '''
+game {
+    id = 0;
+    title := "Symbols test";
+    author := "duplico";
+    starting_stage = start;
+}
+
+persistent {
+    int high_score = 0;
+}
+
+volatile {
+    int score = 0;
+    str greeting := "hello";
+}
+
+animations {
+    hearts <- "heart_anim.gif";
+    pop <- "bwcircles.gif" {
+        frame_rate = 10;
+    }
+}
+
+lightcues {
+    flash <- "flash.gqcue";
+}
+
+menus {
+    restart {
+        1: "Yes";
+        0: "No";
+    }
+}
+
+stage start {
+    bganim hearts;
+    menu restart;
+    event enter {
+        score = 1;
+        cue flash;
+    }
+    event input(A) {
+        gostage pop;
+    }
+}
+
+stage pop {
+    bganim pop;
+    event enter {
+        score = score + 1;
+    }
+}
+'''
+
+def index_game(workspace : pathlib.Path, index_path : pathlib.Path) -> tuple[list, list]:
+    # Links the game, as gqc compile does, and writes its symbol index to
+    #  index_path; returns the symbols and sections the index was made with.
+    #  Runs in a process of its own, as the compiler's state is global.
+    #  Animations are converted in-process, so ffmpeg isn't needed.
+    from gqc import parser, linker
+    from gqc.datamodel import Game, Animation
+
+    os.chdir(workspace)
+    game_path = pathlib.Path('games') / 'symbols.gq'
+    game_path.write_text(GAME)
+    Game.game_name = 'symbols'
+    Animation.in_process = True
+    linker.create_reserved_variables()
+    with open(game_path, 'r') as f:
+        parser.parse(f)
+    linker.load_assets()
+    with contextlib.redirect_stdout(io.StringIO()):
+        symbol_table = linker.create_symbol_table(table_dest=io.StringIO(), cmd_dest=io.StringIO())
+
+    index = SymbolIndex.from_symbol_table(symbol_table)
+    index.write(index_path)
+    return [index.symbol(position) for position in range(len(index))], index.sections
+
+@pytest.fixture(scope='module')
+def indexed(tmp_path_factory):
+    workspace = tmp_path_factory.mktemp('symbols') / 'skel'
+    shutil.copytree(SKEL, workspace)
+    index_path = workspace / 'symbols.gqsym'
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        symbols, sections = executor.submit(index_game, workspace, index_path).result()
+    return SymbolIndex.read(index_path), symbols, sections, index_path
+
+def cart_symbols(symbols : list) -> list:
+    return [symbol for symbol in symbols if structs.gq_ptr_get_ns(symbol.addr) == structs.GQ_PTR_NS_CART]
+
+def test_round_trip(indexed):
+    index, symbols, sections, _ = indexed
+    assert len(index) == len(symbols)
+    assert [index.symbol(position) for position in range(len(index))] == symbols
+    assert index.sections == sections
+    assert [symbol.addr for symbol in symbols] == sorted(symbol.addr for symbol in symbols)
+
+def test_addresses_resolve_to_symbols(indexed):
+    # Every byte of a symbol resolves to it, from its first to its last.
+    index, symbols, _, _ = indexed
+    for symbol in symbols:
+        if symbol.size:
+            assert index.at(symbol.addr) == symbol
+            assert index.at(symbol.addr + symbol.size // 2) == symbol
+            assert index.at(symbol.addr + symbol.size - 1) == symbol
+            assert index.section(symbol.addr).name == symbol.section
+
+def test_addresses_outside_symbols(indexed):
+    # Addresses in the gaps between symbols (such as the padding before the
+    #  persistent section), past the end of the cart, or before any symbol
+    #  resolve to nothing.
+    index, symbols, _, _ = indexed
+    cart = cart_symbols(symbols)
+    gaps = [(symbol.addr + symbol.size, following.addr) for symbol, following in zip(cart, cart[1:]) if symbol.addr + symbol.size < following.addr]
+    assert gaps
+    for gap_start, gap_end in gaps:
+        assert index.at(gap_start) is None
+        assert index.at(gap_end - 1) is None
+    cart_end = max(symbol.addr + symbol.size for symbol in cart)
+    assert index.at(cart_end) is None
+    assert index.at(cart_end + 0x1000) is None
+    assert index.section(cart_end) is None
+    assert index.at(0) is None
+
+def test_lookup_by_name(indexed):
+    index, symbols, _, _ = indexed
+    hearts, = index.lookup('hearts')
+    assert hearts.section == '.anim'
+    assert index.at(hearts.addr) == hearts
+    frame, = index.lookup('hearts.frame0')
+    assert frame.section == '.frame'
+    # The menu may have been moved past the persistent section, to .rodata.
+    restart, = index.lookup('restart')
+    assert restart.section in ('.menu', '.rodata')
+    assert index.lookup('flash.frame0')
+    assert index.lookup('high_score')
+    # An animation and a stage can share a name; both are found, in address
+    #  order.
+    pops = index.lookup('pop')
+    assert len(pops) == 2
+    assert {symbol.section for symbol in pops} == {'.anim', '.stage'}
+    assert [symbol.addr for symbol in pops] == sorted(symbol.addr for symbol in pops)
+    assert index.lookup('nothing') == []
+    for symbol in symbols:
+        assert symbol in index.lookup(symbol.name)
+
+def test_damaged_index_is_refused(indexed, tmp_path):
+    _, _, _, index_path = indexed
+    data = index_path.read_bytes()
+    for damaged in (data[:-1], data + b'\0', b'GQSX' + data[4:], data[:4]):
+        damaged_path = tmp_path / 'damaged.gqsym'
+        damaged_path.write_bytes(damaged)
+        with pytest.raises(ValueError):
+            SymbolIndex.read(damaged_path)
+
+def test_parse_address():
+    cart = structs.gq_ptr_apply_ns(structs.GQ_PTR_NS_CART, 0)
+    assert parse_address('0x1234') == cart + 0x1234
+    assert parse_address('4660') == cart + 0x1234
+    assert parse_address(f'{cart + 0x1234:#x}') == cart + 0x1234
+    for text in ('-1', '0x100000000', 'start'):
+        with pytest.raises(ValueError):
+            parse_address(text)
@@ -0,0 +1,82 @@
+import shutil
+import pathlib
+
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+from rich.progress import Progress
+
+from context import gqc
+from gqc import anim
+from gqc.datamodel import encode_frames, encode_extended_formats, collapse_held_frames, decode_frames
+
+# Round trips of source-timed animations: a GIF with holds and uneven frame
+#  delays is converted with source_timing, its held frames collapsed, and the
+#  result decoded and played back tick by tick against the GIF's own frames
+#  and delays.
+
+HOLDS = [1, 1, 4, 1, 12, 2, 1, 30, 1]
+DELAYS = [40, 100, 40, 70, 100, 20, 250, 100, 40]
+
+def sample_gif_frames() -> list[tuple[Image.Image, int]]:
+    # (frame, delay in ms) pairs. Holds are stored as runs of frames that
+    #  differ only in shades that all quantize to the same black and white
+    #  frame, so the GIF writer can't merge them itself.
+    frames = []
+    for index, (hold, delay) in enumerate(zip(HOLDS, DELAYS)):
+        for shade in range(hold):
+            img = Image.new('L', (128, 128), shade % 32)
+            draw = ImageDraw.Draw(img)
+            draw.ellipse((4 * index, 6 * index, 127 - 3 * index, 127 - 5 * index), outline=255 - shade % 32, width=4)
+            draw.rectangle((0, 110 - 8 * index, 20 + 10 * index, 127), fill=224)
+            frames.append((img, delay))
+    return frames
+
+def playback(frames_pixels : list[np.ndarray], durations : list[int]) -> list[bytes]:
+    # The frame on screen at each tick.
+    ticks = []
+    for pixels, duration in zip(frames_pixels, durations):
+        ticks.extend([pixels.tobytes()] * duration)
+    return ticks
+
+@pytest.fixture
+def sample_gif(tmp_path) -> tuple[pathlib.Path, list[tuple[Image.Image, int]]]:
+    source = sample_gif_frames()
+    gif_path = tmp_path / 'timing.gif'
+    source[0][0].save(gif_path, save_all=True, append_images=[img for img, _ in source[1:]], duration=[delay for _, delay in source], loop=0)
+    return gif_path, source
+
+def convert_timed(gif_path : pathlib.Path, output_dir : pathlib.Path, in_process : bool):
+    with Progress(disable=True) as progress:
+        images = anim.make_animation(progress, gif_path, output_dir, write_frames=False, write_gif=False, source_timing=True, in_process=in_process)
+        frames = encode_frames(images)
+    frames = collapse_held_frames(frames, anim.frame_durations(output_dir))
+    encode_extended_formats(frames)
+    return frames
+
+@pytest.mark.parametrize('in_process', [
+    pytest.param(False, marks=pytest.mark.skipif(shutil.which('ffmpeg') is None, reason="ffmpeg isn't on the PATH")),
+    True,
+])
+def test_source_timing_round_trip(sample_gif, tmp_path, in_process):
+    gif_path, source = sample_gif
+    expected = playback(
+        [(np.asarray(img) >= 128).astype(np.uint8) for img, _ in source],
+        [delay * anim.TICKS_PER_SECOND // 1000 for _, delay in source]
+    )
+    timed = convert_timed(gif_path, tmp_path / 'timed', in_process)
+
+    # Each hold is stored once.
+    assert len(timed) == len(HOLDS)
+    assert playback(decode_frames(timed), [frame.duration for frame in timed]) == expected
+
+def test_frame_durations_round_boundaries(tmp_path):
+    # Frame boundaries, not durations, are rounded to ticks, so a run of
+    #  frames shorter than a tick doesn't drift.
+    with open(tmp_path / anim.FRAME_TIMING_FILE, 'w') as timing_file:
+        timing_file.write('#tb 0: 1/1000\n')
+        for index in range(10):
+            timing_file.write(f'0, {index * 15:10}, {index * 15:10}, {15:8}, {16:8}, 0x00000000\n')
+    durations = anim.frame_durations(tmp_path)
+    assert sum(durations) == 15
+    assert set(durations) == {1, 2}